@@ -1,26 +1,33 @@
+import time
+_RUN_T0 = time.perf_counter()
+
 import streamlit as st
-import pandas as pd
-from datetime import datetime, date
-from fpdf import FPDF
-import json
+from datetime import date
+from functools import partial
 import os
-import io
 import base64
-import math
-import random
-import re
-
-# Word Document Library
-from docx import Document
-from docx.shared import Pt, Inches, RGBColor
-from docx.enum.text import WD_ALIGN_PARAGRAPH
-
-# Optional: Number to Words
-try:
-    from num2words import num2words
-    HAS_NUM2WORDS = True
-except ImportError:
-    HAS_NUM2WORDS = False
+import tempfile
+import weakref
+
+from billing_core import (
+    LOGO_FULL_PATH, COMPANY_NAME, COMPANY_PHONE, COMPANY_ADDRESS, SIGNATORY_NAME, BANK_DETAILS,
+    WORK_CATALOG, GST_RATES, DEFAULT_TERMS, shared_store, new_record_id, number_to_words_safe, calculate_totals,
+    generate_next_id, generate_csv_bytes, render_cache, render_queue, pdf_job, pdf_key, receipt_key, receipt_job, receipts_zip_job, cached_docx_bytes,
+    bulk_jobs, bulk_count, BULK_RENDERERS, BULK_FORMATS, history_page, HISTORY_SORTS, ledger_frame,
+    record_payment, csv_export_file, bill_line_rows, payment_rows, BILL_LINE_FIELDS, PAYMENT_FIELDS,
+    gst_summary, category_revenue, unit_volumes,
+)
+from bulk_export import export_zip
+from storage import ConflictError, fiscal_start
+from perf import profiler
+
+# Time-to-first-paint budget for a session's first full render
+STARTUP_BUDGET_MS = float(os.environ.get("SN_STARTUP_BUDGET_MS", "1500"))
+ADMIN_USERS = {'chaitanyababu2603'}
+PERF_LOG_FILE = os.environ.get("SN_PERF_LOG") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "perf_log.jsonl")
+HISTORY_PAGE_SIZE = 25
+
+profiler.begin_run(label=st.session_state.get('user', ''))
 
 # --- PAGE CONFIG ---
 st.set_page_config(page_title="SN Associates Billing", layout="wide", page_icon="🏗️")
@@ -32,6 +39,7 @@ if 'authenticated' not in st.session_state:
 def check_login():
     if st.session_state.username == 'chaitanyababu2603' and st.session_state.password == 'myson@2501':
         st.session_state.authenticated = True
+        st.session_state.user = st.session_state.username
         st.session_state.login_error = False
     else:
         st.session_state.login_error = True
@@ -47,51 +55,12 @@ if not st.session_state.authenticated:
             st.error("Access Denied")
     st.stop()
 
-# --- CONSTANTS ---
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-LOGO_FULL_PATH = os.path.join(BASE_DIR, "Logo.png")
-DB_FILE = os.path.join(BASE_DIR, "sn_billing_db.json")
-
-# --- COMPANY DETAILS ---
-COMPANY_NAME = "SN ASSOCIATES"
-COMPANY_PHONE = "+91 91318 71696"
-COMPANY_GSTIN = "23AMAPT7272P1ZG"
-COMPANY_ADDRESS = "Chhatarpur, MP"
-SIGNATORY_NAME = "(Dheerendra Tiwari)"
-
-# --- BANK DETAILS ---
-BANK_DETAILS = {
-    "bank": "HDFC BANK",
-    "ac": "99999131871696",
-    "ifsc": "HDFC0004849",
-    "name": "SN Associates"
-}
-
-# --- WORK CATALOG ---
-WORK_CATALOG = [
-    "Site Visit",
-    "Architecture & Design",
-    "Structural Design",
-    "Electrical & Plumbing",
-    "2D & 3D",
-    "Elevation Drawing",
-    "Landscape Drawing",
-    "Vastu consultancy",
-    "Supply",
-    "Walkthrough"
-]
-
-GST_RATES = {"0%": 0.00, "5%": 0.05, "12%": 0.12, "18%": 0.18}
-
 # --- SESSION STATE ---
 if 'invoice_data' not in st.session_state:
     st.session_state.invoice_data = {
         "items": [],
         "schedule": [],
-        "meta": {"terms": """- 30% Advance prior to initiation of the work.
-- 2 extra changes will be provided free of cost. Further changes will be chargeable as per requirement.
-- Site visit will be chargeable (unless specified above).
-- The project is to be completed within six months. In case of delay, the agreed price will be revised by 10% for every additional two months."""}
+        "meta": {"terms": DEFAULT_TERMS}
     }
 
 if 'builder_c_name' not in st.session_state: st.session_state.builder_c_name = ""
@@ -99,361 +68,57 @@ if 'builder_c_mob' not in st.session_state: st.session_state.builder_c_mob = ""
 if 'builder_c_addr' not in st.session_state: st.session_state.builder_c_addr = ""
 if 'builder_dtype_idx' not in st.session_state: st.session_state.builder_dtype_idx = 0
 
-if 'schedule_df' not in st.session_state:
-    st.session_state.schedule_df = pd.DataFrame(columns=["Stage", "Amount", "Date"])
-
 # --- DB & HELPERS ---
-def save_db():
-    with open(DB_FILE, 'w') as f: json.dump(st.session_state.db, f)
-
-def load_db():
-    if os.path.exists(DB_FILE):
-        try:
-            with open(DB_FILE, 'r') as f: db = json.load(f)
-        except: db = {"invoices": [], "quotations": [], "payments": []}
-    else:
-        db = {"invoices": [], "quotations": [], "payments": []}
-    
-    needs_save = False
-    for rec in db.get('invoices', []):
-        if 'id' not in rec:
-            rec['id'] = f"LEGACY_{random.randint(1000,9999)}_{int(datetime.now().timestamp())}"
-            needs_save = True
-        if 'status' not in rec:
-            rec['status'] = "Pending"
-            needs_save = True
-        if 'invoice_no' not in rec:
-            rec['invoice_no'] = rec['id'] 
-            needs_save = True
-            
-    if 'payments' not in db:
-        db['payments'] = []
-        needs_save = True
-        
-    if needs_save:
-        with open(DB_FILE, 'w') as f: json.dump(db, f)
-    return db
-
-if 'db' not in st.session_state:
-    st.session_state.db = load_db()
-
-def sanitize_text(text):
-    if not isinstance(text, str): text = str(text)
-    replacements = {'₹': 'Rs. ', '\u20b9': 'Rs. ', '•': '-', '–': '-', '—': '-', '“': '"', '”': '"', '‘': "'", '’': "'", '…': '...'}
-    for old, new in replacements.items(): text = text.replace(old, new)
-    return text.encode('latin-1', 'ignore').decode('latin-1')
-
-def number_to_words_safe(amount):
-    if HAS_NUM2WORDS:
-        try:
-            txt = num2words(amount, lang='en_IN').title()
-            return sanitize_text(txt) + " Only"
-        except: return "Check Amount"
-    return f"{amount} (in words)"
-
-def calculate_totals(items, gst_rate_key):
-    sub = sum(item['qty'] * item['rate'] for item in items)
-    rate = GST_RATES.get(gst_rate_key, 0.0)
-    gst = sub * rate
-    grand = sub + gst
-    return sub, gst, grand
-
-# --- ID GENERATOR ---
-def generate_next_id(doc_type, date_obj):
-    year = str(date_obj.year)
-    prefix = "INV" if doc_type == "FINAL BILL" else "QUOT"
-    target_format = f"{prefix}-{year}-"
-    
-    record_list = st.session_state.db['invoices'] if doc_type == "FINAL BILL" else st.session_state.db['quotations']
-    max_seq = 0
-    for rec in record_list:
-        rec_no = rec.get('invoice_no') if doc_type == "FINAL BILL" else rec.get('quotation_no')
-        if rec_no and rec_no.startswith(target_format):
-            try:
-                seq_part = rec_no.split('-')[-1]
-                seq = int(seq_part)
-                if seq > max_seq: max_seq = seq
-            except: pass
-    new_seq = max_seq + 1
-    return f"{target_format}{new_seq:03d}"
-
-def generate_csv_bytes(items):
-    """Generate CSV bytes for a list of items"""
-    if not items:
-        return b""
-    df = pd.DataFrame(items)
-    # Reorder/Clean columns
-    cols_to_keep = ['desc', 'unit', 'qty', 'rate']
-    final_cols = [c for c in cols_to_keep if c in df.columns]
-    df = df[final_cols]
-    df.columns = ['Description', 'Unit', 'Qty', 'Rate']
-    df['Amount'] = df['Qty'] * df['Rate']
-    return df.to_csv(index=False).encode('utf-8')
-
-# --- RECEIPT PDF ---
-class ReceiptPDF(FPDF):
-    def header(self): pass
-    def footer(self): pass
-
-def generate_receipt_bytes(payment_data):
-    try:
-        pdf = ReceiptPDF(format='A5', orientation='L')
-        pdf.add_page()
-        pdf.set_draw_color(0,0,0); pdf.rect(5, 5, 200, 138)
-        if os.path.exists(LOGO_FULL_PATH): 
-            try: pdf.image(LOGO_FULL_PATH, 10, 10, 25)
-            except: pass
-        pdf.set_y(10); pdf.set_font('Times', 'B', 16)
-        pdf.set_text_color(0, 0, 128) 
-        pdf.cell(0, 8, sanitize_text(COMPANY_NAME), 0, 1, 'R')
-        pdf.set_text_color(0,0,0); pdf.set_font('Times', '', 9)
-        pdf.cell(0, 5, sanitize_text(COMPANY_ADDRESS), 0, 1, 'R')
-        pdf.cell(0, 5, sanitize_text(f"Ph: {COMPANY_PHONE}"), 0, 1, 'R')
-        pdf.ln(10); pdf.set_font('Times', 'B', 14); pdf.cell(0, 10, "PAYMENT RECEIPT", 0, 1, 'C'); pdf.ln(5)
-        pdf.set_font('Times', '', 12); pdf.set_x(20)
-        pdf.write(8, "Received with thanks from  ")
-        pdf.set_font('Times', 'B', 14); pdf.write(8, sanitize_text(payment_data['client_name']))
-        pdf.set_font('Times', '', 12); pdf.write(8, "\n\n")
-        pdf.set_x(20)
-        text = (f"The sum of  Rs. {payment_data['amount']:,.2f}\n"
-                f"({number_to_words_safe(payment_data['amount'])})\n\n"
-                f"Payment Date:  {payment_data['date']}\n"
-                f"Payment Mode:  {payment_data['mode']}\n"
-                f"Ref Invoice Date:  {payment_data.get('invoice_date', 'N/A')}")
-        pdf.multi_cell(0, 8, sanitize_text(text))
-        pdf.set_y(-35); pdf.set_x(130) 
-        pdf.set_font('Times', 'B', 10)
-        pdf.cell(60, 5, sanitize_text(SIGNATORY_NAME), 0, 1, 'C')
-        pdf.set_x(130)
-        pdf.cell(60, 5, "AUTHORIZED SIGNATORY", 0, 0, 'C')
-        return pdf.output(dest='S').encode('latin-1')
-    except Exception as e: return None
-
-# --- BILL PDF ---
-class PDF(FPDF):
-    def header(self): pass
-    def footer(self): pass
-
-def calculate_page_height(data, schedule_list):
-    min_height = 297; required_height = 160 
-    for item in data['items']:
-        desc_len = len(item['desc']); lines = math.ceil(desc_len / 60); row_h = max(8, lines * 5)
-        required_height += row_h
-    if schedule_list: required_height += 20 + (len(schedule_list) * 8)
-    term_lines = data['meta']['terms'].count('\n') + 3
-    required_height += (term_lines * 5)
-    return max(min_height, required_height)
-
-def generate_pdf_bytes(data, gst_rate_key, hide_gst, schedule_list, doc_no):
+# One store per server process, read in place by every session
+with profiler.span("load_db"):
+    store = shared_store()
+    store.refresh()
+
+def shown_rev(table, rec):
+    """Revision of `rec` this session last displayed; writes expect it so edits made elsewhere meanwhile are caught."""
+    key = f"_rev_{table}_{rec['id']}"
+    shown = st.session_state.get(key, rec.get('rev', 0))
+    st.session_state[key] = rec.get('rev', 0)
+    return shown
+
+@st.fragment(run_every=0.5)
+def _render_progress(job_id, file_name):
+    if render_queue.status(job_id) in ("queued", "running"): st.caption(f"⏳ Rendering {file_name}…")
+    else: st.rerun(scope="app")  # finished: the full run shows the outcome and this fragment stops polling
+
+def render_download(label, job_id, file_name, mime, **kwargs):
+    """Download button for a background render; polls with a 'Rendering…' note until the job is done."""
+    status = render_queue.status(job_id)
+    blob = render_queue.result(job_id) if status == "done" else None
+    if blob is not None: st.download_button(label, blob, file_name, mime, **kwargs)
+    elif status == "failed": st.error(f"Render failed: {render_queue.error(job_id)}")
+    elif status in ("queued", "running"): _render_progress(job_id, file_name)
+    else: st.caption(f"{file_name} was dropped from the render cache; it renders again on the next refresh.")
+
+def _remove_file(path):
+    if os.path.exists(path): os.remove(path)
+
+class SessionFile:
+    """A temp file owned by one session, removed by remove() or once the session's state is dropped."""
+    def __init__(self, suffix):
+        fd, self.path = tempfile.mkstemp(prefix="sn_export_", suffix=suffix); os.close(fd)
+        self.remove = weakref.finalize(self, _remove_file, self.path)
+
+def guarded_write(write):
+    """Run a store write; on a conflict explain it and return False."""
     try:
-        page_h = calculate_page_height(data, schedule_list)
-        pdf = PDF(unit='mm', format=(210, page_h))
-        pdf.set_auto_page_break(False); pdf.set_margins(10, 10, 10); pdf.add_page()
-        
-        if os.path.exists(LOGO_FULL_PATH): 
-            try: pdf.image(LOGO_FULL_PATH, 10, 10, 35)
-            except: pass
-        
-        pdf.set_xy(110, 12); pdf.set_font('Times', 'B', 22)
-        pdf.set_text_color(0, 0, 128)
-        pdf.cell(90, 8, sanitize_text(COMPANY_NAME), 0, 1, 'R')
-        pdf.set_xy(110, 20); pdf.set_text_color(0, 0, 0); pdf.set_font('Times', '', 10)
-        pdf.cell(90, 5, sanitize_text(COMPANY_ADDRESS), 0, 1, 'R')
-        pdf.set_xy(110, 25); pdf.cell(90, 5, sanitize_text(f"Ph: {COMPANY_PHONE}"), 0, 1, 'R')
-        if not hide_gst: pdf.set_xy(110, 30); pdf.cell(90, 5, sanitize_text(f"GST: {COMPANY_GSTIN}"), 0, 1, 'R')
-            
-        pdf.set_draw_color(0, 0, 0); pdf.line(10, 50, 200, 50)
-        
-        pdf.set_y(55); pdf.set_font('Times', 'B', 16)
-        display_type = "BILL" if data['meta']['type'] == "FINAL BILL" else data['meta']['type']
-        pdf.cell(0, 8, sanitize_text(display_type), 0, 1, 'C')
-        
-        y_info = 68
-        pdf.set_xy(10, y_info); pdf.set_font('Times', 'B', 10); pdf.cell(90, 5, "DOCUMENT DETAILS:", 0, 1)
-        pdf.set_font('Times', '', 10); pdf.set_x(10)
-        
-        lbl = "Invoice No" if data['meta']['type'] == "FINAL BILL" else "Quotation No"
-        pdf.cell(90, 5, sanitize_text(f"{lbl}: {doc_no}"), 0, 1)
-        
-        pdf.set_x(10); pdf.cell(90, 5, sanitize_text(f"Date: {data['meta']['date']}"), 0, 1)
-        
-        pdf.set_xy(110, y_info); pdf.set_font('Times', 'B', 10); pdf.cell(90, 5, "TO CLIENT:", 0, 1)
-        pdf.set_xy(110, y_info + 6); pdf.set_font('Times', 'B', 12)
-        pdf.cell(90, 6, sanitize_text(data['client']['name']), 0, 1)
-        pdf.set_xy(110, y_info + 12); pdf.set_font('Times', '', 10)
-        details = f"{data['client']['phone']}\n{data['client']['address']}"
-        pdf.multi_cell(90, 5, sanitize_text(details))
-        
-        y_table_start = max(pdf.get_y(), y_info + 25) + 5
-        pdf.set_xy(10, y_table_start)
-        
-        # 5 COLUMNS: Desc, Unit, Qty, Rate, Amount
-        cols = [105, 15, 15, 25, 30] 
-        pdf.set_fill_color(240, 240, 240); pdf.set_font('Times', 'B', 10)
-        headers = ["Description", "Unit", "Qty", "Rate", "Amount"]
-        for i, h in enumerate(headers):
-            align = 'L' if i == 0 else 'R'
-            pdf.cell(cols[i], 8, h, 1, 0, align, 1)
-        pdf.ln()
-        
-        pdf.set_font('Times', '', 10)
-        sub, gst, grand = calculate_totals(data['items'], gst_rate_key)
-        if hide_gst: gst=0; grand=sub
-
-        for item in data['items']:
-            start_x = pdf.get_x()
-            start_y = pdf.get_y()
-            
-            # Process Description
-            desc_lines = item['desc'].split('\n')
-            
-            line_heights = []
-            for line in desc_lines:
-                wrap_lines = math.ceil(len(line) / 55)
-                line_heights.append(max(5, wrap_lines * 5))
-            
-            total_h = sum(line_heights)
-            total_h = max(8, total_h)
-            
-            if start_y + total_h > page_h - 20:
-                pdf.add_page()
-                start_y = pdf.get_y()
-                start_x = pdf.get_x()
-            
-            current_y = start_y
-            pdf.set_xy(start_x, current_y)
-            pdf.rect(start_x, start_y, cols[0], total_h)
-            
-            for idx, line in enumerate(desc_lines):
-                h = line_heights[idx]
-                pdf.set_xy(start_x, current_y)
-                pdf.multi_cell(cols[0], 5, sanitize_text(line), 0, 'L')
-                
-                if idx < len(desc_lines) - 1:
-                    line_y = current_y + h
-                    pdf.line(start_x, line_y, start_x + cols[0], line_y)
-                    current_y += h
-                else:
-                    current_y += h
-
-            pdf.set_xy(start_x + cols[0], start_y)
-            pdf.cell(cols[1], total_h, sanitize_text(item['unit']), 1, 0, 'C')
-            
-            pdf.set_xy(start_x + cols[0] + cols[1], start_y)
-            pdf.cell(cols[2], total_h, str(item['qty']), 1, 0, 'C')
-            
-            pdf.set_xy(start_x + cols[0] + cols[1] + cols[2], start_y)
-            pdf.cell(cols[3], total_h, f"{item['rate']:.2f}", 1, 0, 'R')
-            
-            pdf.set_xy(start_x + cols[0] + cols[1] + cols[2] + cols[3], start_y)
-            pdf.cell(cols[4], total_h, f"{item['qty']*item['rate']:.2f}", 1, 0, 'R')
-            
-            pdf.set_y(start_y + total_h)
-
-        pdf.ln(2)
-        def print_total(label, val, bold=False):
-            if bold: pdf.set_font('Times', 'B', 11)
-            else: pdf.set_font('Times', '', 10)
-            pdf.cell(165, 6, label, 0, 0, 'R'); pdf.cell(25, 6, f"Rs. {val:,.2f}", 0, 1, 'R')
-
-        print_total("Subtotal:", sub)
-        if not hide_gst: print_total(f"GST ({gst_rate_key}):", gst)
-        print_total("Grand Total:", grand, bold=True)
-        pdf.ln(2); pdf.set_font('Times', 'I', 10)
-        pdf.cell(0, 6, number_to_words_safe(grand), 0, 1, 'R')
-        
-        if schedule_list and len(schedule_list) > 0:
-            pdf.ln(8); pdf.set_font('Times', 'B', 10); pdf.cell(0, 6, "PAYMENT SCHEDULE:", 0, 1, 'L')
-            pdf.set_fill_color(245, 245, 245)
-            pdf.cell(80, 6, "Stage", 1, 0, 'L', 1); pdf.cell(40, 6, "Amount", 1, 0, 'C', 1); pdf.cell(70, 6, "Date", 1, 1, 'L', 1)
-            pdf.set_font('Times', '', 9)
-            for r in schedule_list:
-                pdf.cell(80, 6, sanitize_text(str(r.get("Stage",""))), 1)
-                pdf.cell(40, 6, sanitize_text(str(r.get("Amount",""))), 1, 0, 'C')
-                pdf.cell(70, 6, sanitize_text(str(r.get("Date",""))), 1, 1)
-
-        pdf.ln(8); pdf.set_font('Times', 'B', 10); pdf.cell(0, 6, "TERMS & CONDITIONS:", 0, 1, 'L')
-        pdf.set_font('Times', '', 10); pdf.multi_cell(0, 5, sanitize_text(data['meta']['terms']))
-        
-        pdf.ln(10); pdf.set_draw_color(0, 0, 0); pdf.line(10, pdf.get_y(), 200, pdf.get_y()); pdf.ln(5)
-        y_foot = pdf.get_y(); pdf.set_font('Times', 'B', 10); pdf.cell(90, 5, "ACCOUNT DETAILS", 0, 1, 'L')
-        pdf.set_font('Times', '', 9)
-        pdf.cell(90, 5, sanitize_text(f"BANK: {BANK_DETAILS['bank']}"), 0, 1, 'L')
-        pdf.cell(90, 5, sanitize_text(f"A/C: {BANK_DETAILS['ac']}"), 0, 1, 'L')
-        pdf.cell(90, 5, sanitize_text(f"IFSC: {BANK_DETAILS['ifsc']}"), 0, 1, 'L')
-        pdf.cell(90, 5, sanitize_text(f"NAME: {BANK_DETAILS['name']}"), 0, 1, 'L')
-        
-        pdf.set_xy(130, y_foot + 15)
-        pdf.set_font('Times', 'B', 10)
-        pdf.cell(60, 5, sanitize_text(SIGNATORY_NAME), 0, 1, 'C')
-        pdf.set_xy(130, y_foot + 20)
-        pdf.cell(60, 5, "AUTHORIZED SIGNATORY", 0, 0, 'C')
-        return pdf.output(dest='S').encode('latin-1')
-    except Exception as e: return None
-
-# --- DOCX GENERATOR ---
-def generate_docx_bytes(data, gst_rate_key, hide_gst, schedule_list, doc_no):
-    doc = Document(); style = doc.styles['Normal']; style.font.name = 'Times New Roman'; style.font.size = Pt(10)
-    ht = doc.add_table(rows=1, cols=2); ht.autofit = False; ht.columns[0].width = Inches(2.5); ht.columns[1].width = Inches(4.0)
-    if os.path.exists(LOGO_FULL_PATH): 
-        try: ht.cell(0,0).paragraphs[0].add_run().add_picture(LOGO_FULL_PATH, width=Inches(2.0))
-        except: pass
-    p = ht.cell(0,1).paragraphs[0]; p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    r = p.add_run(COMPANY_NAME + "\n"); r.bold = True; r.font.size = Pt(18); r.font.color.rgb = RGBColor(0, 0, 128)
-    p.add_run(f"{COMPANY_ADDRESS}\nPh: {COMPANY_PHONE}")
-    if not hide_gst: p.add_run(f"\nGST: {COMPANY_GSTIN}")
-    doc.add_paragraph("_"*70)
-    display_type = "BILL" if data['meta']['type'] == "FINAL BILL" else data['meta']['type']
-    doc.add_paragraph(display_type).alignment = WD_ALIGN_PARAGRAPH.CENTER
-    t = doc.add_table(rows=1, cols=2); t.autofit = True
-    
-    lbl = "Invoice No" if data['meta']['type'] == "FINAL BILL" else "Quotation No"
-    t.cell(0,0).paragraphs[0].add_run(f"DETAILS:\n{lbl}: {doc_no}\nDate: {data['meta']['date']}")
-    
-    c_cell = t.cell(0,1)
-    c_cell.paragraphs[0].add_run("TO CLIENT:\n").bold = True
-    c_cell.paragraphs[0].add_run(f"{data['client']['name']}\n").bold = True
-    c_cell.paragraphs[0].add_run(f"{data['client']['phone']}\n{data['client']['address']}")
-    
-    doc.add_paragraph("\n")
-    # 5 COLUMNS in Word
-    tbl = doc.add_table(rows=1, cols=5); tbl.style = 'Table Grid'
-    hdrs = ["Description", "Unit", "Qty", "Rate", "Amount"]
-    for i,h in enumerate(hdrs): tbl.rows[0].cells[i].text = h
-    for item in data['items']:
-        rc = tbl.add_row().cells
-        rc[0].text=item['desc']
-        rc[1].text=item['unit']
-        rc[2].text=str(item['qty'])
-        rc[3].text=f"{item['rate']:.2f}"
-        rc[4].text=f"{item['qty']*item['rate']:.2f}"
-    sub, gst, grand = calculate_totals(data['items'], gst_rate_key)
-    if hide_gst: gst=0; grand=sub
-    p = doc.add_paragraph(); p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    p.add_run(f"\nSubtotal: {sub:,.2f}\n"); 
-    if not hide_gst: p.add_run(f"GST ({gst_rate_key}): {gst:,.2f}\n")
-    p.add_run(f"Grand Total: Rs. {grand:,.2f}").bold = True
-    p.add_run(f"\n{number_to_words_safe(grand)}").italic = True
-    if schedule_list:
-        doc.add_paragraph("\nPAYMENT SCHEDULE:").runs[0].bold = True
-        stbl = doc.add_table(rows=1, cols=3); stbl.style = 'Table Grid'; shdrs = ["Stage", "Amount", "Date"]
-        for i, h in enumerate(shdrs): stbl.rows[0].cells[i].text = h
-        for row in schedule_list:
-            rc = stbl.add_row().cells; rc[0].text=str(row.get("Stage","")); rc[1].text=str(row.get("Amount","")); rc[2].text=str(row.get("Date",""))
-    doc.add_paragraph("\nTERMS:\n"+data['meta']['terms']); doc.add_paragraph("_"*70)
-    ft = doc.add_table(rows=1, cols=2); ft.autofit = True
-    ft.cell(0,0).paragraphs[0].add_run(f"BANK DETAILS\nBANK: {BANK_DETAILS['bank']}\nA/C: {BANK_DETAILS['ac']}\nIFSC: {BANK_DETAILS['ifsc']}")
-    sig_cell = ft.cell(0,1).paragraphs[0]
-    sig_cell.alignment = WD_ALIGN_PARAGRAPH.RIGHT
-    sig_cell.add_run(f"\n\n{SIGNATORY_NAME}\nAUTHORIZED SIGNATORY").bold = True
-    f = io.BytesIO(); doc.save(f); f.seek(0); return f
+        write()
+        return True
+    except ConflictError as e:
+        st.error(f"{e}. The latest version is shown now; please check it and try again.")
+        return False
 
 # --- UI ---
 st.markdown(f"<h1 style='color:#000080;'>🏗️ {COMPANY_NAME} Billing</h1>", unsafe_allow_html=True)
 
 tab_b, tab_h, tab_t = st.tabs(["📝 Builder", "📂 History & Payments", "💰 Ledger"])
 
-with tab_b:
+with tab_b, profiler.span("tab:builder"):
     c1, c2, c3, c4 = st.columns(4)
     dtype = c1.selectbox("Type", ["QUOTATION", "FINAL BILL"], index=st.session_state.builder_dtype_idx)
     ddate = c2.date_input("Date", key="builder_date_picker")
@@ -495,7 +160,7 @@ with tab_b:
                             # ADD NUMBERING IF CHECKED
                             final_d = f"{i+1}. {d}" if add_numbering else d
                             st.session_state.invoice_data['items'].append({
-                                "category": "", 
+                                "category": d if d in WORK_CATALOG else "", 
                                 "desc": final_d, 
                                 "unit": unit, 
                                 "qty": qty, 
@@ -509,7 +174,7 @@ with tab_b:
                             final_desc = "\n".join(d_list)
 
                         st.session_state.invoice_data['items'].append({
-                            "category": "", 
+                            "category": descs[0] if descs else "", 
                             "desc": final_desc, 
                             "unit": unit, 
                             "qty": qty, 
@@ -518,14 +183,19 @@ with tab_b:
                     st.rerun()
         
         if st.session_state.invoice_data['items']:
-            st.dataframe(pd.DataFrame(st.session_state.invoice_data['items']), use_container_width=True)
+            st.dataframe(st.session_state.invoice_data['items'], use_container_width=True)
             if st.button("Clear Items"): st.session_state.invoice_data['items'] = []; st.rerun()
             
-        with st.expander("Payment Schedule (Optional)"):
-            if 'Date' not in st.session_state.schedule_df.columns:
-                st.session_state.schedule_df['Date'] = pd.Series(dtype='object')
+        # Runs only while open; the editor's frame is built from the draft's schedule on first open
+        sched_box = st.expander("Payment Schedule (Optional)", key="builder_sched_open", on_change="rerun")
+        if sched_box.open:
+            import pandas as pd
+            if 'schedule_df' not in st.session_state:
+                sched_df = pd.DataFrame(st.session_state.invoice_data['schedule'], columns=["Stage", "Amount", "Date"])
+                sched_df['Date'] = pd.to_datetime(sched_df['Date'], errors='coerce').dt.date
+                st.session_state.schedule_df = sched_df
                 
-            edited_sched = st.data_editor(
+            edited_sched = sched_box.data_editor(
                 st.session_state.schedule_df, 
                 num_rows="dynamic", 
                 use_container_width=True,
@@ -533,17 +203,18 @@ with tab_b:
                     "Date": st.column_config.DateColumn("Date", format="YYYY-MM-DD")
                 }
             )
-            edited_sched['Date'] = edited_sched['Date'].apply(lambda x: x.strftime('%Y-%m-%d') if hasattr(x, 'strftime') else str(x) if pd.notnull(x) else "")
-            
             st.session_state.schedule_df = edited_sched
-            st.session_state.invoice_data['schedule'] = edited_sched.to_dict('records')
+            
+            # The draft keeps dates as strings; the editor's frame keeps them as dates
+            sched_dates = edited_sched['Date'].apply(lambda x: "" if pd.isnull(x) else x.strftime('%Y-%m-%d') if hasattr(x, 'strftime') else str(x))
+            st.session_state.invoice_data['schedule'] = edited_sched.assign(Date=sched_dates).to_dict('records')
 
         term_txt = st.text_area("Terms", st.session_state.invoice_data['meta']['terms'], height=100)
 
     with cp:
         st.subheader("Live Preview")
         
-        preview_id = generate_next_id(dtype, ddate)
+        with profiler.span("generate_next_id"): preview_id = generate_next_id(store, dtype, ddate)
         
         items = st.session_state.invoice_data['items']
         sub, gst, grand = calculate_totals(items, grate)
@@ -586,14 +257,14 @@ with tab_b:
 </div>
 </div></div>"""
         
-        st.markdown(html, unsafe_allow_html=True)
+        with profiler.span("st.markdown(preview)"): st.markdown(html, unsafe_allow_html=True)
         
         if st.button("💾 Finalize", type="primary"):
             if c_name:
-                new_id = generate_next_id(dtype, ddate)
+                new_id = generate_next_id(store, dtype, ddate, allocate=True)
                 
                 rec = {
-                    "id": f"INV-{int(datetime.now().timestamp())}",
+                    "id": new_record_id("INV"),
                     "invoice_no": new_id,
                     "quotation_no": new_id if dtype == "QUOTATION" else None,
                     "date": str(ddate), 
@@ -611,41 +282,60 @@ with tab_b:
                     "terms": term_txt
                 }
                 t = 'invoices' if dtype == "FINAL BILL" else 'quotations'
-                st.session_state.db[t].append(rec); save_db(); st.toast(f"Saved: {new_id}")
+                store.insert(t, rec); st.toast(f"Saved: {new_id}")
             else: st.error("Name Required")
             
         fdata = {"meta": {"type": dtype, "date": str(ddate), "terms": term_txt}, "client": {"name": c_name, "phone": c_mob, "address": c_addr}, "items": items}
         
-        pdf_bytes = generate_pdf_bytes(fdata, grate, hgst, sched_data, preview_id)
         f_suffix = "Bill" if dtype == "FINAL BILL" else "Quotation"
         
-        if pdf_bytes:
-            st.download_button("📄 Download PDF", pdf_bytes, f"{c_name} {f_suffix}.pdf", "application/pdf", type="primary")
+        # Rendered on request only: the draft changes with every keystroke
+        pdf_id = pdf_key(fdata, grate, hgst, sched_data, preview_id)
+        if render_queue.status(pdf_id) in ("done", "queued", "running"):
+            render_download("📄 Download PDF", pdf_id, f"{c_name} {f_suffix}.pdf", "application/pdf", type="primary")
+        else:
+            if render_queue.status(pdf_id) == "failed": st.error(f"Render failed: {render_queue.error(pdf_id)}")
+            if st.button("📄 Prepare PDF", type="primary"):
+                pdf_job(fdata, grate, hgst, sched_data, preview_id, retry=True); st.rerun()
         
-        st.download_button("📝 Download Word", generate_docx_bytes(fdata, grate, hgst, sched_data, preview_id), f"{c_name} {f_suffix}.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-
-with tab_h:
+        st.download_button("📝 Download Word", partial(cached_docx_bytes, fdata, grate, hgst, sched_data, preview_id), f"{c_name} {f_suffix}.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+
+def history_table(table, statuses, sorts):
+    """Filter/sort/page controls and the visible page of a History table; returns the page's record ids."""
+    f1, f2, f3, f4, f5 = st.columns([3, 2, 2, 1, 1])
+    query = f1.text_input("Search", key=f"h_{table}_query", placeholder="Client, phone, address, number or item")
+    status = f2.selectbox("Status", ["All"] + statuses, key=f"h_{table}_status") if statuses else "All"
+    sort = f3.selectbox("Sort by", sorts, key=f"h_{table}_sort")
+    descending = f4.toggle("Desc", value=True, key=f"h_{table}_desc")
+    archived = f5.toggle("Closed FYs", key=f"h_{table}_archived", help="Also list and search closed fiscal years (read-only)")
+    page_key = f"h_{table}_page"
+    df, ids, total, pages = history_page(store, table, st.session_state.get(page_key, 1), HISTORY_PAGE_SIZE,
+                                         query=query, status=status, sort=sort, descending=descending, archived=archived)
+    # Clamp before the widget exists; a narrower filter can leave fewer pages
+    st.session_state[page_key] = min(max(st.session_state.get(page_key, 1), 1), pages)
+    st.dataframe(df.drop(columns=['id']), use_container_width=True, hide_index=True)
+    p1, p2 = st.columns([1, 3])
+    p1.number_input("Page", 1, pages, key=page_key)
+    p2.caption(f"{total} matching · page {st.session_state[page_key]} of {pages}")
+    return ids
+
+with tab_h, profiler.span("tab:history"):
     m = st.radio("View Mode", ["Quotations", "Bills & Payments"])
     
     if m == "Quotations":
-        if st.session_state.db['quotations']:
-            df_q = pd.DataFrame(st.session_state.db['quotations'])
-            
-            df_q['Items'] = df_q['items'].apply(lambda x: "; ".join([i['desc'] for i in x]))
-            df_q.insert(0, 'S.No.', range(1, len(df_q) + 1))
-            
-            st.dataframe(df_q[['S.No.', 'quotation_no', 'date', 'client_name', 'amount', 'Items']], use_container_width=True, hide_index=True)
-            
-            sel_q_idx = st.selectbox("Select Quotation", range(len(df_q)), format_func=lambda x: f"{df_q.iloc[x]['client_name']} ({df_q.iloc[x]['quotation_no']})")
-            selected_quote = df_q.iloc[sel_q_idx]
+        q_ids = history_table('quotations', [], ["Date", "Client"])
+        if q_ids:
+            sel_q_id = st.selectbox("Select Quotation", q_ids, format_func=lambda x: f"{store.get('quotations', x)['client_name']} ({store.get('quotations', x).get('quotation_no')})")
+            selected_quote = store.get('quotations', sel_q_id)
+            quote_rev = shown_rev('quotations', selected_quote)
             
             c1, c2, c3 = st.columns(3)
             
             if c1.button("✅ Confirm as Bill"):
-                st.session_state.invoice_data['items'] = selected_quote['items']
+                st.session_state.invoice_data['items'] = [dict(i) for i in selected_quote['items']]
                 if 'schedule' in selected_quote:
-                    st.session_state.invoice_data['schedule'] = selected_quote['schedule']
-                    st.session_state.schedule_df = pd.DataFrame(selected_quote['schedule'])
+                    st.session_state.invoice_data['schedule'] = [dict(x) for x in selected_quote['schedule']]
+                    st.session_state.pop('schedule_df', None)
                 
                 st.session_state.builder_c_name = selected_quote['client_name']
                 st.session_state.builder_c_mob = selected_quote.get('client_phone', '')
@@ -654,21 +344,21 @@ with tab_h:
                 
                 st.success("Data loaded into Builder tab. Click 'Finalize' there to generate Bill No.")
             
-            if c2.button("✏️ Edit Quote"):
-                st.session_state.invoice_data['items'] = selected_quote['items']
+            if store.is_archived('quotations', selected_quote['id']):
+                c2.caption("🗄️ Closed fiscal year (read-only)")
+            elif c2.button("✏️ Edit Quote"):
+                st.session_state.invoice_data['items'] = [dict(i) for i in selected_quote['items']]
                 st.session_state.builder_c_name = selected_quote['client_name']
                 st.session_state.builder_c_mob = selected_quote.get('client_phone', '')
                 st.session_state.builder_c_addr = selected_quote.get('client_address', '')
-                del st.session_state.db['quotations'][sel_q_idx]
-                save_db()
-                st.success("Loaded for Editing (Old deleted).")
-                st.rerun()
-
-            if c3.button("❌ Delete"):
-                del st.session_state.db['quotations'][sel_q_idx]
-                save_db()
-                st.success("Deleted.")
-                st.rerun()
+                if guarded_write(lambda: store.delete('quotations', selected_quote['id'], rev=quote_rev)):
+                    st.success("Loaded for Editing (Old deleted).")
+                    st.rerun()
+
+            if not store.is_archived('quotations', selected_quote['id']) and c3.button("❌ Delete"):
+                if guarded_write(lambda: store.delete('quotations', selected_quote['id'], rev=quote_rev)):
+                    st.success("Deleted.")
+                    st.rerun()
                 
             st.divider()
             st.write("📄 Download Copy:")
@@ -679,45 +369,26 @@ with tab_h:
             }
             
             doc_id = selected_quote.get('quotation_no', 'N/A')
-            pdf_bytes_h = generate_pdf_bytes(fdata_h, selected_quote.get('gst_rate', '18%'), selected_quote.get('hide_gst', False), selected_quote.get('schedule', []), doc_id)
+            pdf_id_h = pdf_job(fdata_h, selected_quote.get('gst_rate', '18%'), selected_quote.get('hide_gst', False), selected_quote.get('schedule', []), doc_id)
             
             c_d1, c_d2, c_d3 = st.columns(3)
-            if pdf_bytes_h:
-                c_d1.download_button("Download PDF", pdf_bytes_h, f"{selected_quote['client_name']} Quotation.pdf", "application/pdf")
-            else:
-                c_d1.error("PDF Fail")
+            with c_d1: render_download("Download PDF", pdf_id_h, f"{selected_quote['client_name']} Quotation.pdf", "application/pdf")
             
-            c_d2.download_button("Download Word", generate_docx_bytes(fdata_h, selected_quote.get('gst_rate', '18%'), selected_quote.get('hide_gst', False), selected_quote.get('schedule', []), doc_id), f"{selected_quote['client_name']} Quotation.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-            c_d3.download_button("Download CSV", generate_csv_bytes(selected_quote['items']), f"{selected_quote['client_name']} Items.csv", "text/csv")
+            c_d2.download_button("Download Word", partial(cached_docx_bytes, fdata_h, selected_quote.get('gst_rate', '18%'), selected_quote.get('hide_gst', False), selected_quote.get('schedule', []), doc_id), f"{selected_quote['client_name']} Quotation.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+            c_d3.download_button("Download CSV", partial(generate_csv_bytes, selected_quote['items']), f"{selected_quote['client_name']} Items.csv", "text/csv")
 
-        else: st.info("No active quotations.")
+        else: st.info("No matching quotations." if store.db['quotations'] else "No active quotations.")
 
     else: 
-        if st.session_state.db['invoices']:
-            df_i = pd.DataFrame(st.session_state.db['invoices'])
-            
-            def get_paid(iid): return sum([p['amount'] for p in st.session_state.db['payments'] if p.get('invoice_id') == iid])
-            
-            df_i['Paid'] = df_i['id'].apply(get_paid)
-            df_i['Pending'] = df_i['amount'] - df_i['Paid']
-            
-            for idx, row in df_i.iterrows():
-                if row['Pending'] <= 0 and row['status'] != "Completed":
-                    st.session_state.db['invoices'][idx]['status'] = "Completed"
-                    save_db()
-            
-            df_i.insert(0, 'S.No.', range(1, len(df_i) + 1))
-            
-            if 'invoice_no' not in df_i.columns: df_i['invoice_no'] = df_i['id']
-            
-            st.dataframe(df_i[['S.No.', 'invoice_no', 'date', 'client_name', 'amount', 'Paid', 'Pending', 'status']], use_container_width=True, hide_index=True)
-            
+        b_ids = history_table('invoices', ["Pending", "Completed"], list(HISTORY_SORTS))
+        if b_ids:
             st.divider()
             
             # --- DOWNLOAD BILL FROM HISTORY ---
-            sel_b_idx = st.selectbox("Select Bill", range(len(df_i)), format_func=lambda x: f"{df_i.iloc[x]['client_name']} ({df_i.iloc[x]['invoice_no']})")
-            db_record = st.session_state.db['invoices'][sel_b_idx]
-            selected_bill_df = df_i.iloc[sel_b_idx]
+            sel_b_id = st.selectbox("Select Bill", b_ids, format_func=lambda x: f"{store.get('invoices', x)['client_name']} ({store.get('invoices', x).get('invoice_no') or x})")
+            db_record = store.get('invoices', sel_b_id)
+            bill_rev = shown_rev('invoices', db_record)
+            bill_pending = db_record['amount'] - store.paid(db_record['id'])
             
             c1, c2 = st.columns(2)
             
@@ -728,27 +399,23 @@ with tab_h:
             }
             
             doc_id = db_record.get('invoice_no', 'N/A')
-            pdf_bytes_b = generate_pdf_bytes(fdata_b, db_record.get('gst_rate','18%'), db_record.get('hide_gst', False), db_record.get('schedule',[]), doc_id)
+            pdf_id_b = pdf_job(fdata_b, db_record.get('gst_rate','18%'), db_record.get('hide_gst', False), db_record.get('schedule',[]), doc_id)
             
             c_d1, c_d2, c_d3 = st.columns(3)
             
-            if pdf_bytes_b:
-                c_d1.download_button("📄 Download PDF", pdf_bytes_b, f"{db_record['client_name']} Bill.pdf", "application/pdf", type="primary")
-            else:
-                c_d1.error("PDF Fail")
+            with c_d1: render_download("📄 Download PDF", pdf_id_b, f"{db_record['client_name']} Bill.pdf", "application/pdf", type="primary")
                 
-            c_d2.download_button("📝 Download Word", generate_docx_bytes(fdata_b, db_record.get('gst_rate','18%'), db_record.get('hide_gst', False), db_record.get('schedule',[]), doc_id), f"{db_record['client_name']} Bill.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
-            c_d3.download_button("📊 Download CSV", generate_csv_bytes(db_record['items']), f"{db_record['client_name']} Items.csv", "text/csv")
+            c_d2.download_button("📝 Download Word", partial(cached_docx_bytes, fdata_b, db_record.get('gst_rate','18%'), db_record.get('hide_gst', False), db_record.get('schedule',[]), doc_id), f"{db_record['client_name']} Bill.docx", "application/vnd.openxmlformats-officedocument.wordprocessingml.document")
+            c_d3.download_button("📊 Download CSV", partial(generate_csv_bytes, db_record['items']), f"{db_record['client_name']} Items.csv", "text/csv")
             
             if db_record['status'] == "Pending":
                 if c2.button("✅ Mark as Complete (Force)"):
-                    st.session_state.db['invoices'][sel_b_idx]['status'] = "Completed (Manual)"
-                    save_db()
-                    st.rerun()
+                    if guarded_write(lambda: store.update('invoices', db_record['id'], {"status": "Completed (Manual)"}, rev=bill_rev)):
+                        st.rerun()
 
             st.markdown("### Payment History & Receipts")
             
-            bill_payments = [p for p in st.session_state.db['payments'] if p.get('invoice_id') == db_record['id']]
+            bill_payments = store.payments_for(db_record['id'])
             if bill_payments:
                 for idx, p in enumerate(bill_payments):
                     pc1, pc2, pc3, pc4 = st.columns([2,2,2,2])
@@ -756,110 +423,131 @@ with tab_h:
                     pc2.write(f"**Amt:** {p['amount']}")
                     pc3.write(f"**Mode:** {p['mode']}")
                     
-                    rec_bytes = generate_receipt_bytes(p)
-                    if rec_bytes:
-                        pc4.download_button(f"📥 Receipt {idx+1}", rec_bytes, f"Receipt_{p['date']}.pdf", "application/pdf", key=f"d_rec_{idx}")
-                    else:
-                        pc4.error("Err")
+                    # Receipts are only rendered on request, in the background, then served from the cache
+                    rec_id = receipt_key(p)
+                    if render_queue.status(rec_id) in ("done", "queued", "running"):
+                        with pc4: render_download(f"📥 Receipt {idx+1}", rec_id, f"Receipt_{p['date']}.pdf", "application/pdf", key=f"d_rec_{idx}")
+                    elif pc4.button(f"🧾 Prepare Receipt {idx+1}", key=f"mk_rec_{idx}"):
+                        receipt_job(p); st.rerun()
+
+                zip_id = receipts_zip_job(bill_payments) if st.session_state.get('zip_for') == db_record['id'] else None
+                if zip_id:
+                    render_download("📦 Download All Receipts (ZIP)", zip_id, f"{db_record['client_name']} Receipts.zip", "application/zip")
+                elif st.button("📦 Prepare All Receipts (ZIP)"):
+                    st.session_state.zip_for = db_record['id']; st.rerun()
             else:
                 st.caption("No payments recorded yet.")
 
             st.divider()
 
-            if db_record['status'] == "Pending" and selected_bill_df['Pending'] > 1.0:
+            if db_record['status'] == "Pending" and bill_pending > 1.0:
                 st.subheader("💰 Record New Payment")
                 with st.container(border=True):
                     c1, c2, c3 = st.columns(3)
-                    pay_amt = c1.number_input("Amount", max_value=float(selected_bill_df['Pending']), value=float(selected_bill_df['Pending']), key="pay_amt")
+                    pay_amt = c1.number_input("Amount", max_value=float(bill_pending), value=float(bill_pending), key="pay_amt")
                     pay_date = c2.date_input("Date", key="pay_date_picker")
                     pay_mode = c3.selectbox("Mode", ["UPI", "Cash", "Cheque", "Transfer"], key="pay_mode_sel")
                     
                     if st.button("Save Payment", type="primary"):
-                        p_rec = {
-                            "id": f"PAY-{int(datetime.now().timestamp())}",
-                            "invoice_id": db_record['id'],
-                            "client_name": db_record['client_name'],
-                            "invoice_date": db_record['date'],
-                            "amount": pay_amt,
-                            "date": str(pay_date),
-                            "mode": pay_mode
-                        }
-                        st.session_state.db['payments'].append(p_rec)
-                        save_db()
-                        st.session_state.last_pay = p_rec
-                        st.success("Payment Recorded!")
-                        st.rerun()
+                        if guarded_write(lambda: record_payment(store, db_record, pay_amt, pay_date, pay_mode, rev=bill_rev)):
+                            st.success("Payment Recorded!")
+                            st.rerun()
 
             else:
                 st.success("✅ This bill is Fully Paid / Completed.")
 
-with tab_t:
+with tab_t, profiler.span("tab:ledger"):
     st.header("Financial Ledger")
     
     # Date Filter
     c_d1, c_d2 = st.columns(2)
-    d_from = c_d1.date_input("From Date", date(date.today().year, 1, 1))
+    # Defaults to the live fiscal year, so no closed year is opened until the range reaches into one
+    d_from = c_d1.date_input("From Date", date.fromisoformat(fiscal_start(store.active_year)))
     d_to = c_d2.date_input("To Date", date.today())
     
-    invs = st.session_state.db.get('invoices', [])
-    pays = st.session_state.db.get('payments', [])
-    
-    def parse_date(d_str):
-        try: return datetime.strptime(d_str, '%Y-%m-%d').date()
-        except: return date.min
-    
-    invs_filtered = [i for i in invs if d_from <= parse_date(i['date']) <= d_to]
-    pays_filtered = [p for p in pays if d_from <= parse_date(p['date']) <= d_to]
+    invs_filtered = store.in_range('invoices', str(d_from), str(d_to))
+    pays_filtered = store.in_range('payments', str(d_from), str(d_to))
     
-    t_billed = sum(i['amount'] for i in invs_filtered)
-    t_rev = sum(p['amount'] for p in pays_filtered)
-    t_gst = sum(i['tax'] for i in invs_filtered)
+    t_billed, t_gst, t_rev = store.period_totals(d_from, d_to)
+    all_billed, _, all_received = store.all_time_totals()
     
     m1, m2, m3, m4 = st.columns(4)
     m1.metric("Total Work Billed", f"Rs. {t_billed:,.2f}")
     m2.metric("Actual Revenue", f"Rs. {t_rev:,.2f}")
-    m3.metric("Pending Dues (Total)", f"Rs. {sum(i['amount'] for i in invs) - sum(p['amount'] for p in pays):,.2f}")
+    m3.metric("Pending Dues (Total)", f"Rs. {all_billed - all_received:,.2f}")
     m4.metric("GST Liability", f"Rs. {t_gst:,.2f}")
     
     st.divider()
     st.subheader("Client Reports")
-    clients = sorted(list(set([i['client_name'] for i in invs])))
+    clients = store.client_names('invoices')
     sel_c = st.selectbox("Select Client", ["All"] + clients)
     
-    def clean_df(data_list, is_invoice=True):
-        if not data_list: return pd.DataFrame()
-        df = pd.DataFrame(data_list)
-        df.insert(0, 'S.No.', range(1, len(df) + 1))
-        # CHANGED: Items use desc, not category
-        if 'items' in df.columns:
-            df['Items'] = df['items'].apply(lambda x: "; ".join([i['desc'] for i in x]) if isinstance(x, list) else "")
-        if is_invoice and 'invoice_no' not in df.columns: df['invoice_no'] = df.get('id', '')
-        
-        if is_invoice:
-            cols = ['S.No.', 'invoice_no', 'date', 'client_name', 'amount', 'Items']
-        else:
-            cols = ['S.No.', 'date', 'amount', 'mode', 'client_name']
-            
-        return df[[c for c in cols if c in df.columns]]
-
     if sel_c != "All":
-        c_inv = [i for i in invs_filtered if i['client_name'] == sel_c]
-        c_pay = [p for p in pays_filtered if p['client_name'] == sel_c]
+        c_inv = store.in_range('invoices', str(d_from), str(d_to), sel_c)
+        c_pay = store.in_range('payments', str(d_from), str(d_to), sel_c)
         st.write(f"**Total Billed:** {sum(x['amount'] for x in c_inv):,.2f} | **Total Paid:** {sum(x['amount'] for x in c_pay):,.2f}")
         
         st.write("Bill History (Filtered):")
-        st.dataframe(clean_df(c_inv, True), use_container_width=True, hide_index=True)
+        st.dataframe(ledger_frame(store, 'invoices', str(d_from), str(d_to), sel_c), use_container_width=True, hide_index=True)
         
         st.write("Payment History (Filtered):")
-        st.dataframe(clean_df(c_pay, False), use_container_width=True, hide_index=True)
+        st.dataframe(ledger_frame(store, 'payments', str(d_from), str(d_to), sel_c), use_container_width=True, hide_index=True)
     else:
         st.write("All Bills (Filtered):")
-        st.dataframe(clean_df(invs_filtered, True), use_container_width=True, hide_index=True)
+        st.dataframe(ledger_frame(store, 'invoices', str(d_from), str(d_to)), use_container_width=True, hide_index=True)
         
         st.write("All Payments (Filtered):")
-        st.dataframe(clean_df(pays_filtered, False), use_container_width=True, hide_index=True)
+        st.dataframe(ledger_frame(store, 'payments', str(d_from), str(d_to)), use_container_width=True, hide_index=True)
         
     st.divider()
     c1, c2 = st.columns(2)
-    if invs_filtered: c1.download_button("📥 Export Bills CSV", pd.DataFrame(invs_filtered).to_csv(), "bills_filtered.csv")
-    if pays_filtered: c2.download_button("📥 Export Revenue CSV", pd.DataFrame(pays_filtered).to_csv(), "revenue_filtered.csv")
+    if invs_filtered: c1.download_button("📥 Export Bills CSV", partial(csv_export_file, BILL_LINE_FIELDS, bill_line_rows, invs_filtered), "bills_filtered.csv", "text/csv")
+    if pays_filtered: c2.download_button("📥 Export Revenue CSV", partial(csv_export_file, PAYMENT_FIELDS, payment_rows, pays_filtered), "revenue_filtered.csv", "text/csv")
+
+    if st.toggle("📊 GST & Revenue Analytics", key="show_analytics"):
+        a1, a2, a3 = st.tabs(["GST Summary", "Category Revenue", "Unit Volumes"])
+        with a1: st.dataframe(gst_summary(store, str(d_from), str(d_to)), use_container_width=True, hide_index=True)
+        with a2: st.dataframe(category_revenue(store, str(d_from), str(d_to)), use_container_width=True, hide_index=True)
+        with a3: st.dataframe(unit_volumes(store, str(d_from), str(d_to)), use_container_width=True, hide_index=True)
+
+    with st.expander("📦 Bulk Export (Auditor / GST Filing)"):
+        bulk_invs = invs_filtered if sel_c == "All" else c_inv
+        b1, b2 = st.columns(2)
+        bulk_formats = b1.multiselect("Bill Formats", list(BULK_FORMATS), default=["pdf"], format_func=BULK_FORMATS.get)
+        bulk_receipts = b2.checkbox("Include Receipts", value=True)
+        st.caption(f"{len(bulk_invs)} bills in the selected range{'' if sel_c == 'All' else ' for ' + sel_c}.")
+        if st.button("Build ZIP", disabled=not bulk_invs):
+            n_docs = bulk_count(store, bulk_invs, bulk_formats, bulk_receipts)
+            bar = st.progress(0.0, text="Rendering...")
+            if st.session_state.get('bulk_zip'): st.session_state.bulk_zip.remove()  # one export per session on disk
+            st.session_state.bulk_zip = None
+            export = SessionFile(".zip")
+            written, failed = export_zip(bulk_jobs(store, bulk_invs, bulk_formats, bulk_receipts), export.path, BULK_RENDERERS, total=n_docs,
+                                         progress=lambda done, total: bar.progress(done / max(total, 1), text=f"Rendered {done}/{total}"))
+            st.session_state.bulk_zip = export
+            if failed: st.warning(f"{len(failed)} documents failed: {', '.join(failed[:5])}")
+            st.success(f"Exported {written} documents.")
+        export = st.session_state.get('bulk_zip')
+        if export and os.path.exists(export.path):  # read on click only, not on every rerun
+            st.download_button("📥 Download ZIP", partial(open, export.path, 'rb'), f"SN_Export_{d_from}_{d_to}.zip", "application/zip")
+
+st.sidebar.caption(render_cache.stats())
+st.sidebar.caption(render_queue.stats())
+st.sidebar.caption(store.year_stats())
+
+run_ms = (time.perf_counter() - _RUN_T0) * 1000
+if 'startup_ms' not in st.session_state: st.session_state.startup_ms = run_ms
+startup_txt = f"Startup: {st.session_state.startup_ms:,.0f} ms (budget {STARTUP_BUDGET_MS:,.0f} ms) · this rerun: {run_ms:,.0f} ms"
+if st.session_state.startup_ms > STARTUP_BUDGET_MS: st.sidebar.warning(startup_txt)
+else: st.sidebar.caption(startup_txt)
+
+# --- PROFILING ---
+last_run = profiler.end_run()
+if st.session_state.get('user') in ADMIN_USERS and st.sidebar.toggle("🔬 Profiling Panel"):
+    import pandas as pd
+    log_on = st.sidebar.checkbox("Log reruns (JSON lines)", value=profiler.log_path is not None)
+    profiler.log_path = PERF_LOG_FILE if log_on else None
+    st.sidebar.caption(f"Last rerun: {last_run['total_ms']:,.0f} ms, {last_run['blocks']:+,} blocks")
+    st.sidebar.dataframe(pd.DataFrame(last_run['spans'])[['name', 'ms', 'blocks']].round(1) if last_run['spans'] else pd.DataFrame(), hide_index=True)
+    st.sidebar.write(f"Slowest spans (last {len(profiler.recent)} reruns):")
+    st.sidebar.dataframe(pd.DataFrame(profiler.slowest()).round(1), hide_index=True)
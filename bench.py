@@ -0,0 +1,157 @@
+"""Synthetic-data benchmarks for the billing hot paths.
+
+    python bench.py --sizes 10000 100000 --engine json -o bench_output.txt
+
+Generates a realistic sn_billing_db.json per size (WORK_CATALOG items,
+GST_RATES, multi-payment bills), then times loading, numbering, the bills
+table, search, Ledger filtering, clean_df, the line-item reports and
+document rendering, including a merged Word file. Results are written as
+CSV (or JSON lines with --format json) so runs from different versions
+can be diffed.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+import billing_core as core
+from storage import open_store
+
+UNITS = ["Sq.Ft", "Sq.Mt", "L/S", "Nos", "Job", "Sq.In", "Kg/Mt", "Secs"]
+MODES = ["UPI", "Cash", "Cheque", "Transfer"]
+FIELDS = ["version", "engine", "records", "benchmark", "ops", "best_s", "per_op_ms"]
+
+
+def make_dataset(n_invoices, seed=0):
+    """Invoices, half as many quotations, and 0-4 staged payments per invoice."""
+    rng = random.Random(seed)
+    start = date(2023, 4, 1)
+    clients = [f"Client {i}" for i in range(max(10, n_invoices // 20))]
+    db = {"invoices": [], "quotations": [], "payments": []}
+    seq = {}
+
+    def document(i, doc_type):
+        d = start + timedelta(days=rng.randrange(1100))
+        prefix = "INV" if doc_type == "FINAL BILL" else "QUOT"
+        seq[(prefix, d.year)] = seq.get((prefix, d.year), 0) + 1
+        no = f"{prefix}-{d.year}-{seq[(prefix, d.year)]:03d}"
+        items = []
+        for _ in range(rng.randint(1, 6)):
+            cat = rng.choice(core.WORK_CATALOG)
+            items.append({"category": cat, "desc": f"{cat} - {rng.choice(['Working drawing', 'Site work', 'Consultation'])}",
+                          "unit": rng.choice(UNITS), "qty": float(rng.randint(1, 50)), "rate": float(rng.randrange(500, 20000, 500))})
+        gst_key = rng.choice(list(core.GST_RATES))
+        sub, gst, grand = core.calculate_totals(items, gst_key)
+        client = rng.choice(clients)
+        return {"id": f"{prefix}-{i}", "invoice_no": no, "quotation_no": no if prefix == "QUOT" else None,
+                "date": str(d), "type": doc_type, "client_name": client, "client_phone": f"9{rng.randrange(10**9):09d}",
+                "client_address": f"{rng.randint(1, 999)} Main Road, Chhatarpur", "amount": grand, "tax": gst,
+                "items": items, "gst_rate": gst_key, "hide_gst": False, "status": "Pending",
+                "schedule": [{"Stage": "Advance", "Amount": round(grand * 0.3, 2), "Date": str(d)}], "terms": core.DEFAULT_TERMS}
+
+    for i in range(n_invoices):
+        inv = document(i, "FINAL BILL")
+        db["invoices"].append(inv)
+        remaining = inv["amount"]
+        for k in range(rng.randint(0, 4)):
+            amt = round(remaining * rng.uniform(0.2, 0.6), 2)
+            remaining -= amt
+            d = date.fromisoformat(inv["date"]) + timedelta(days=15 * (k + 1))
+            db["payments"].append({"id": f"PAY-{i}-{k}", "invoice_id": inv["id"], "client_name": inv["client_name"],
+                                   "invoice_date": inv["date"], "amount": amt, "date": str(d), "mode": rng.choice(MODES)})
+    for i in range(n_invoices // 2):
+        db["quotations"].append(document(i, "QUOTATION"))
+    return db
+
+
+def timed(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter(); fn(); best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def run_size(n, engine, repeat, renders, workdir):
+    db = make_dataset(n)
+    json_path = os.path.join(workdir, f"bench_{n}.json")
+    sqlite_path = os.path.join(workdir, f"bench_{n}.sqlite3")
+    with open(json_path, 'w') as f: json.dump(db, f)
+    for p in (sqlite_path, os.path.splitext(json_path)[0] + ".seq.json"):
+        if os.path.exists(p): os.remove(p)
+
+    store = open_store(engine, json_path, sqlite_path)
+    results = [("load_db", 1, timed(store.load, repeat)),
+               ("load_all_years", 1, timed(lambda: (store.load(), store.load_since()), repeat))]
+    # Every fiscal year stays open from here on, so the cases below cover the whole dataset
+    invoices = store.db['invoices']
+    year_from, year_to = "2024-04-01", "2025-03-31"
+    sample = invoices[len(invoices) // 2]
+    render_args = core.record_render_args(sample)
+
+    cases = [
+        ("generate_next_id", 100, lambda: [core.generate_next_id(store, "FINAL BILL", date(2024, 6, 1)) for _ in range(100)]),
+        ("bills_table_get_paid", 1, lambda: (store._derived.clear(), core.history_page(store, 'invoices', sort="Pending", archived=True))),
+        ("bills_table_cached", 1, lambda: core.history_page(store, 'invoices', 40, sort="Pending", archived=True)),
+        ("ledger_date_filter", 1, lambda: (store.in_range('invoices', year_from, year_to), store.in_range('payments', year_from, year_to))),
+        ("search_build", 1, lambda: (setattr(store, '_search', None), store.search(""))),
+        ("search_query", 100, lambda: [store.search(q) for q in ["client 1", "98", "consultation site", "INV-2024-01", "archtecture"] * 20]),
+        ("ledger_period_totals", 1, lambda: store.period_totals(date(2024, 4, 1), date(2025, 3, 31))),
+        ("clean_df_invoices", 1, lambda: core.clean_df(store.in_range('invoices', year_from, year_to), True)),
+        ("clean_df_payments", 1, lambda: core.clean_df(store.in_range('payments', year_from, year_to), False)),
+        ("line_items_frame", 1, lambda: (store._derived.clear(), core.line_items_frame(store))),
+        ("gst_summary", 1, lambda: (store._derived.clear(), core.gst_summary(store, year_from, year_to))),
+        ("category_revenue", 1, lambda: core.category_revenue(store, year_from, year_to)),
+        ("render_pdf", renders, lambda: [core.generate_pdf_bytes(*render_args) for _ in range(renders)]),
+        ("render_docx", renders, lambda: [core.generate_docx_bytes(*render_args) for _ in range(renders)]),
+        ("render_docx_merged", renders, lambda: core.merged_docx_bytes([render_args] * renders)),
+        ("render_receipt", renders, lambda: [core.generate_receipt_bytes(store.db['payments'][0]) for _ in range(renders)]),
+    ]
+    for name, ops, fn in cases:
+        results.append((name, ops, timed(fn, repeat)))
+    return results
+
+
+def git_version():
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=here, capture_output=True, text=True).stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000], help="invoice counts to generate")
+    parser.add_argument("--engine", choices=["json", "sqlite"], default="json")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark; the best is reported")
+    parser.add_argument("--renders", type=int, default=20, help="documents per rendering benchmark")
+    parser.add_argument("--format", choices=["csv", "json"], default="csv")
+    parser.add_argument("-o", "--output", help="file to write (default stdout)")
+    args = parser.parse_args(argv)
+
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    writer = csv.DictWriter(out, FIELDS) if args.format == "csv" else None
+    if writer: writer.writeheader()
+    version = git_version()
+    # Pay the lazy library imports up front so they don't skew the first timing
+    import pandas, docx  # noqa: F401
+    core.load_fpdf(); core.number_to_words_safe(1)
+    with tempfile.TemporaryDirectory(prefix="sn_bench_") as workdir:
+        for n in args.sizes:
+            for name, ops, best in run_size(n, args.engine, args.repeat, args.renders, workdir):
+                row = {"version": version, "engine": args.engine, "records": n, "benchmark": name,
+                       "ops": ops, "best_s": round(best, 6), "per_op_ms": round(best * 1000 / ops, 4)}
+                if writer: writer.writerow(row)
+                else: out.write(json.dumps(row) + "\n")
+                out.flush()
+    if args.output: out.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1132 @@
+"""SN Associates billing core: totals, numbering and document rendering.
+
+Importable without Streamlit, so scripts, cron jobs and tests can use it.
+Run `python billing_core.py --help` for the command-line interface.
+"""
+from datetime import datetime, date
+import argparse
+import copy
+import csv
+import functools
+import json
+import os
+import io
+import re
+import sys
+import hashlib
+import importlib.util
+import threading
+import uuid
+import zipfile
+from collections import OrderedDict
+
+from storage import Record, open_store
+from bulk_export import export_zip
+from perf import profiler
+from render_queue import RenderQueue
+
+# Heavy libraries (pandas, fpdf, python-docx, num2words) are imported inside
+# the functions that need them, so a session or CLI command only pays for
+# the features it actually uses.
+
+# Optional: Number to Words
+HAS_NUM2WORDS = importlib.util.find_spec("num2words") is not None
+
+# --- CONSTANTS ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+LOGO_FULL_PATH = os.path.join(BASE_DIR, "Logo.png")
+DB_FILE = os.path.join(BASE_DIR, "sn_billing_db.json")
+DB_SQLITE_FILE = os.path.join(BASE_DIR, "sn_billing_db.sqlite3")
+STORAGE_ENGINE = os.environ.get("SN_STORAGE_ENGINE", "json")  # "json" (journaled) or "sqlite"
+
+# --- COMPANY DETAILS ---
+COMPANY_NAME = "SN ASSOCIATES"
+COMPANY_PHONE = "+91 91318 71696"
+COMPANY_GSTIN = "23AMAPT7272P1ZG"
+COMPANY_ADDRESS = "Chhatarpur, MP"
+SIGNATORY_NAME = "(Dheerendra Tiwari)"
+
+# --- BANK DETAILS ---
+BANK_DETAILS = {
+    "bank": "HDFC BANK",
+    "ac": "99999131871696",
+    "ifsc": "HDFC0004849",
+    "name": "SN Associates"
+}
+
+# --- WORK CATALOG ---
+WORK_CATALOG = [
+    "Site Visit",
+    "Architecture & Design",
+    "Structural Design",
+    "Electrical & Plumbing",
+    "2D & 3D",
+    "Elevation Drawing",
+    "Landscape Drawing",
+    "Vastu consultancy",
+    "Supply",
+    "Walkthrough"
+]
+
+GST_RATES = {"0%": 0.00, "5%": 0.05, "12%": 0.12, "18%": 0.18}
+
+DEFAULT_TERMS = """- 30% Advance prior to initiation of the work.
+- 2 extra changes will be provided free of cost. Further changes will be chargeable as per requirement.
+- Site visit will be chargeable (unless specified above).
+- The project is to be completed within six months. In case of delay, the agreed price will be revised by 10% for every additional two months."""
+
+def open_default_store():
+    """Open and load the configured database (see STORAGE_ENGINE); loading writes nothing."""
+    store = open_store(STORAGE_ENGINE, DB_FILE, DB_SQLITE_FILE)
+    store.load()
+    return store
+
+_shared_store = None
+_shared_store_lock = threading.Lock()
+
+def shared_store():
+    """The one store every session in this process reads from, opened on first use.
+
+    Sessions read it in place rather than holding copies; call `refresh()`
+    to pick up writes from other processes. Writes take the store's lock.
+    """
+    global _shared_store
+    with _shared_store_lock:
+        if _shared_store is None: _shared_store = open_default_store()
+    return _shared_store
+
+def new_record_id(prefix):
+    """Unique id for a new record, e.g. "INV-3f2a…"; every index and revision check keys on it."""
+    return f"{prefix}-{uuid.uuid4().hex}"
+
+# --- PAYMENTS ---
+def record_payment(store, invoice, amount, pay_date, mode, rev=None):
+    """Save a payment; if it settles the bill, mark it Completed in the same commit.
+
+    The bill is updated with every payment, so two payments raced against
+    the same bill conflict (ConflictError) instead of both deciding from a
+    stale paid total. `rev` is the bill revision the user saw; it defaults
+    to the current one.
+    """
+    p_rec = {
+        "id": new_record_id("PAY"),
+        "invoice_id": invoice['id'],
+        "client_name": invoice['client_name'],
+        "invoice_date": invoice['date'],
+        "amount": amount,
+        "date": str(pay_date),
+        "mode": mode
+    }
+    settled = invoice['amount'] - (store.paid(invoice['id']) + amount) <= 0 and invoice.get('status') != "Completed"
+    store.commit([{"op": "insert", "t": "payments", "rec": p_rec},
+                  {"op": "update", "t": "invoices", "id": invoice['id'], "fields": {"status": "Completed"} if settled else {},
+                   "rev": invoice.get('rev', 0) if rev is None else rev}])
+    return p_rec
+
+def reconcile_statuses(store):
+    """Mark every fully paid bill Completed in one pass and one commit. Returns how many changed.
+
+    record_payment() keeps statuses current; this fixes up older data (`maintain` command).
+    """
+    ops = [{"op": "update", "t": "invoices", "id": inv['id'], "fields": {"status": "Completed"}}
+           for inv in store.db['invoices']
+           if inv['amount'] - store.paid(inv['id']) <= 0 and inv.get('status') != "Completed"]
+    store.commit(ops)
+    return len(ops)
+
+def sanitize_text(text):
+    if not isinstance(text, str): text = str(text)
+    replacements = {'₹': 'Rs. ', '\u20b9': 'Rs. ', '•': '-', '–': '-', '—': '-', '“': '"', '”': '"', '‘': "'", '’': "'", '…': '...'}
+    for old, new in replacements.items(): text = text.replace(old, new)
+    return text.encode('latin-1', 'ignore').decode('latin-1')
+
+def number_to_words_safe(amount):
+    if HAS_NUM2WORDS:
+        try:
+            from num2words import num2words
+            txt = num2words(amount, lang='en_IN').title()
+            return sanitize_text(txt) + " Only"
+        except: return "Check Amount"
+    return f"{amount} (in words)"
+
+def calculate_totals(items, gst_rate_key):
+    sub = sum(item['qty'] * item['rate'] for item in items)
+    rate = GST_RATES.get(gst_rate_key, 0.0)
+    gst = sub * rate
+    grand = sub + gst
+    return sub, gst, grand
+
+# --- ID GENERATOR ---
+def generate_next_id(store, doc_type, date_obj, allocate=False):
+    """Next INV-/QUOT- number for the year. Only allocate=True reserves it."""
+    year = str(date_obj.year)
+    prefix = "INV" if doc_type == "FINAL BILL" else "QUOT"
+    if allocate: new_seq = store.allocate_number(prefix, year)
+    else: new_seq = store.peek_number(prefix, year)
+    return f"{prefix}-{year}-{new_seq:03d}"
+
+@profiler.timed()
+def generate_csv_bytes(items):
+    """Generate CSV bytes for a list of items"""
+    if not items:
+        return b""
+    out = io.StringIO()
+    w = csv.writer(out, lineterminator="\n")
+    w.writerow(['Description', 'Unit', 'Qty', 'Rate', 'Amount'])
+    for i in items: w.writerow([i.get('desc'), i.get('unit'), i.get('qty'), i.get('rate'), i['qty'] * i['rate']])
+    return out.getvalue().encode('utf-8')
+
+def items_summary(rec):
+    # CHANGED: Items use desc, not category
+    items = rec.get('items')
+    return "; ".join(i['desc'] for i in items) if isinstance(items, list) else ""
+
+def _project(recs, columns):
+    """DataFrame of just the displayed columns; items, schedules and terms are never copied."""
+    import pandas as pd
+    getters = {'S.No.': lambda i, r: i, 'Items': lambda i, r: items_summary(r),
+               'invoice_no': lambda i, r: r.get('invoice_no') or r.get('id', '')}
+    data = {c: [getters[c](n, r) if c in getters else r.get(c) for n, r in enumerate(recs, 1)] for c in columns}
+    return pd.DataFrame(data, columns=columns)
+
+INVOICE_COLUMNS = ['S.No.', 'invoice_no', 'date', 'client_name', 'amount', 'Items']
+PAYMENT_COLUMNS = ['S.No.', 'date', 'amount', 'mode', 'client_name']
+
+@profiler.timed()
+def clean_df(data_list, is_invoice=True):
+    import pandas as pd
+    if not data_list: return pd.DataFrame()
+    return _project(data_list, INVOICE_COLUMNS if is_invoice else PAYMENT_COLUMNS)
+
+HISTORY_SORTS = {
+    "Date": lambda store, r: r.get('date') or "",
+    "Client": lambda store, r: (r.get('client_name') or "").lower(),
+    "Status": lambda store, r: r.get('status') or "",
+    "Pending": lambda store, r: r.get('amount', 0) - store.paid(r.get('id')),
+}
+QUOTATION_COLUMNS = ['S.No.', 'id', 'quotation_no', 'date', 'client_name', 'amount', 'Items']
+BILL_COLUMNS = ['S.No.', 'id', 'invoice_no', 'date', 'client_name', 'amount', 'status', 'Paid', 'Pending']
+
+def history_records(store, table, query="", status="All", sort="Date", descending=True, archived=False):
+    """Filtered and sorted records for a History table, cached until the store changes.
+
+    Only the live fiscal-year partition is listed unless `archived`, which
+    opens and includes every closed year.
+    """
+    if archived: store.load_since()
+    def build():
+        if query.strip():
+            recs = store.search(query, (table,))
+            if not archived: recs = [r for r in recs if not store.is_archived(table, r.get('id'))]
+        else:
+            recs = store.records(table) if archived else store.db[table]
+        if status != "All":
+            # A prefix match, so "Completed" also lists bills marked "Completed (Manual)"
+            recs = [r for r in recs if (r.get('status') or "Pending").startswith(status)]
+        key = HISTORY_SORTS[sort]
+        return sorted(recs, key=lambda r: key(store, r), reverse=descending)
+    return store.cached(('history', table, query.strip(), status, sort, descending, archived), build)
+
+@profiler.timed()
+def history_page(store, table, page=1, page_size=25, **filters):
+    """(frame, ids, total matches, page count) for one page of a History table.
+
+    Only the records on the requested page are turned into a DataFrame.
+    """
+    recs = history_records(store, table, **filters)
+    pages = max(1, -(-len(recs) // page_size))
+    page = min(max(page, 1), pages)
+    start = (page - 1) * page_size
+    chunk = recs[start:start + page_size]
+    if table == 'invoices':
+        df = _project(chunk, BILL_COLUMNS[:-2])
+        df['Paid'] = df['id'].map(store.paid)
+        df['Pending'] = df['amount'] - df['Paid']
+    else:
+        df = _project(chunk, QUOTATION_COLUMNS)
+    if len(df): df['S.No.'] += start
+    return df, [r['id'] for r in chunk], len(recs), pages
+
+@profiler.timed()
+def ledger_frame(store, table, d_from, d_to, client=None):
+    """Ledger table for a date range (ISO strings) and optional client."""
+    return store.cached(('ledger', table, d_from, d_to, client),
+                        lambda: clean_df(store.in_range(table, d_from, d_to, client), table == 'invoices'))
+
+# --- RECEIPT PDF ---
+PDF = ReceiptPDF = None  # FPDF subclasses, defined by load_fpdf() on first use
+
+def load_fpdf():
+    global PDF, ReceiptPDF
+    if PDF is None:
+        from fpdf import FPDF
+        class ReceiptPDF(FPDF):
+            def header(self): pass
+            def footer(self): pass
+        class PDF(FPDF):
+            def header(self): pass
+            def footer(self): pass
+    return PDF, ReceiptPDF
+
+# --- LETTERHEAD STAMPS ---
+# The logo, company block, bank details and signatory are the same on every
+# document. Each block is drawn once per process on a scratch page and its
+# page content is replayed on later documents; the logo PNG is decoded once.
+PDF_FONT_STYLES = ('', 'B', 'I')  # Times, registered in this order on every document
+
+_logo = []      # [fpdf image info, or None when there is no usable logo]
+_stamps = {}
+_stamps_lock = threading.RLock()
+
+def _logo_info():
+    with _stamps_lock:
+        if not _logo:
+            info = None
+            if os.path.exists(LOGO_FULL_PATH):
+                try:
+                    scratch = load_fpdf()[0](); scratch.add_page(); scratch.image(LOGO_FULL_PATH, 0, 0, 10)
+                    info = scratch.images[LOGO_FULL_PATH]
+                except: pass
+            _logo.append(info)
+        return _logo[0]
+
+def new_pdf(cls, **kwargs):
+    """An FPDF with its fonts and logo registered in a fixed order, so stamps apply as-is."""
+    pdf = cls(**kwargs)
+    for style in PDF_FONT_STYLES: pdf.set_font('Times', style)
+    info = _logo_info()
+    # A copy per document: output() writes its own object number into the info
+    if info: pdf.images[LOGO_FULL_PATH] = dict(info, i=1)
+    return pdf
+
+def stamp(pdf, name, dy=0):
+    """Replay the static block `name` on the current page, shifted `dy` mm down.
+
+    The block runs inside q/Q with black colours, so the page's graphics state
+    and FPDF's idea of it (font, colours, position) are the same afterwards.
+    """
+    with _stamps_lock:
+        if name not in _stamps:
+            page, draw = STAMPS[name]
+            scratch = new_pdf(load_fpdf()[0], **page); scratch.add_page()
+            start = len(scratch.pages[1])
+            draw(scratch)
+            _stamps[name] = scratch.pages[1][start:]
+        body = _stamps[name]
+    shift = f"1 0 0 1 0 {-dy * pdf.k:.2f} cm\n" if dy else ""
+    pdf._out(f"q 0 g 0 G\n{shift}{body}Q")
+
+def _draw_receipt_head(pdf):
+    pdf.set_draw_color(0,0,0); pdf.rect(5, 5, 200, 138)
+    if LOGO_FULL_PATH in pdf.images: pdf.image(LOGO_FULL_PATH, 10, 10, 25)
+    pdf.set_y(10); pdf.set_font('Times', 'B', 16)
+    pdf.set_text_color(0, 0, 128) 
+    pdf.cell(0, 8, sanitize_text(COMPANY_NAME), 0, 1, 'R')
+    pdf.set_text_color(0,0,0); pdf.set_font('Times', '', 9)
+    pdf.cell(0, 5, sanitize_text(COMPANY_ADDRESS), 0, 1, 'R')
+    pdf.cell(0, 5, sanitize_text(f"Ph: {COMPANY_PHONE}"), 0, 1, 'R')
+
+def _draw_receipt_signatory(pdf):
+    pdf.set_y(-35); pdf.set_x(130) 
+    pdf.set_font('Times', 'B', 10)
+    pdf.cell(60, 5, sanitize_text(SIGNATORY_NAME), 0, 1, 'C')
+    pdf.set_x(130)
+    pdf.cell(60, 5, "AUTHORIZED SIGNATORY", 0, 0, 'C')
+
+@profiler.timed()
+def generate_receipt_bytes(payment_data):
+    try:
+        pdf = new_pdf(load_fpdf()[1], format='A5', orientation='L')
+        pdf.add_page()
+        stamp(pdf, "receipt_head")
+        pdf.set_y(38); pdf.set_font('Times', 'B', 14); pdf.cell(0, 10, "PAYMENT RECEIPT", 0, 1, 'C'); pdf.ln(5)
+        pdf.set_font('Times', '', 12); pdf.set_x(20)
+        pdf.write(8, "Received with thanks from  ")
+        pdf.set_font('Times', 'B', 14); pdf.write(8, sanitize_text(payment_data['client_name']))
+        pdf.set_font('Times', '', 12); pdf.write(8, "\n\n")
+        pdf.set_x(20)
+        text = (f"The sum of  Rs. {payment_data['amount']:,.2f}\n"
+                f"({number_to_words_safe(payment_data['amount'])})\n\n"
+                f"Payment Date:  {payment_data['date']}\n"
+                f"Payment Mode:  {payment_data['mode']}\n"
+                f"Ref Invoice Date:  {payment_data.get('invoice_date', 'N/A')}")
+        pdf.multi_cell(0, 8, sanitize_text(text))
+        stamp(pdf, "receipt_signatory")
+        return pdf.output(dest='S').encode('latin-1')
+    except Exception as e: return None
+
+# --- BILL PDF ---
+PAGE_W, PAGE_H = 210, 297
+BODY_BOTTOM = PAGE_H - 15     # rows and blocks stop here; the page number sits below
+CONTD_TOP = 24                # first free y on continuation pages
+PDF_COLS = [105, 15, 15, 25, 30]  # Desc, Unit, Qty, Rate, Amount
+CARRY_H = 7
+LAYOUT_CACHE_SIZE = 64
+
+_layouts = OrderedDict()
+_layouts_lock = threading.Lock()
+
+def wrap_text(pdf, text, width):
+    """Lines of `text` that fit `width` mm in the current font, as multi_cell would break them."""
+    usable = width - 2 * pdf.c_margin
+    measured = {}
+    def sw(t):
+        if t not in measured: measured[t] = pdf.get_string_width(t)
+        return measured[t]
+    space = sw(" ")
+    lines = []
+    for para in text.split('\n'):
+        line, line_w = "", 0.0
+        for word in para.split(' '):
+            w = sw(word)
+            while w > usable:  # a word wider than the column is broken by characters
+                cut = 1
+                while cut < len(word) and pdf.get_string_width(word[:cut + 1]) <= usable: cut += 1
+                if line: lines.append(line); line, line_w = "", 0.0
+                lines.append(word[:cut]); word = word[cut:]; w = sw(word)
+            if line and line_w + space + w > usable:
+                lines.append(line); line, line_w = word, w
+            elif line:
+                line += " " + word; line_w += space + w
+            else:
+                line, line_w = word, w
+        lines.append(line)
+    return lines
+
+def pdf_layout(data, gst_rate_key, hide_gst, schedule_list):
+    """Page-by-page placement of every block of a bill, measured with the real fonts.
+
+    The layout does not depend on the document number or date, so the
+    Builder preview and the finalized render share one cached layout.
+    """
+    key = RenderCache.key("layout", data['items'], data['meta']['terms'], data['client'], gst_rate_key, hide_gst, schedule_list)
+    with _layouts_lock:
+        if key in _layouts:
+            _layouts.move_to_end(key)
+            return _layouts[key]
+    layout = _compute_layout(data, gst_rate_key, hide_gst, schedule_list)
+    with _layouts_lock:
+        _layouts[key] = layout
+        while len(_layouts) > LAYOUT_CACHE_SIZE: _layouts.popitem(last=False)
+    return layout
+
+def _split_paras(paras, n):
+    """(first n lines, the rest) of a row's wrapped paragraphs, each as [(lines, height)]."""
+    head, tail = [], []
+    for lines, _ in paras:
+        if n >= len(lines): head.append(lines)
+        elif n > 0: head.append(lines[:n]); tail.append(lines[n:])
+        else: tail.append(lines)
+        n = max(0, n - len(lines))
+    return [(l, 5 * len(l)) for l in head], [(l, 5 * len(l)) for l in tail]
+
+@profiler.timed()
+def _compute_layout(data, gst_rate_key, hide_gst, schedule_list):
+    pdf = load_fpdf()[0](unit='mm', format='A4')
+    pdf.set_font('Times', '', 10)
+    client_lines = wrap_text(pdf, sanitize_text(f"{data['client']['phone']}\n{data['client']['address']}"), 90)
+    fit = int((BODY_BOTTOM - 80) // 5)  # address lines the letterhead has room for
+    pages = [[("letterhead", 0, client_lines[:fit])]]
+    y = max(80 + 5 * len(client_lines[:fit]), 93) + 5
+
+    def new_page():
+        pages.append([("contd", 0)])
+        return CONTD_TOP
+
+    def place(op, h):
+        nonlocal y
+        if y + h > BODY_BOTTOM: y = new_page()
+        pages[-1].append((op[0], y) + op[1:]); y += h
+
+    if client_lines[fit:]:  # the rest continues in the same column
+        for line in client_lines[fit:]: place(("client_line", line), 5)
+        y += 5
+    if y + 8 + 8 + CARRY_H > BODY_BOTTOM: y = new_page()  # keep the table header with a row
+
+    def break_table():
+        nonlocal y, on_page
+        pages[-1].append(("carry", y, "Carried forward", running))
+        y = new_page()
+        pages[-1].append(("thead", y)); y += 8
+        pages[-1].append(("carry", y, "Brought forward", running)); y += CARRY_H
+        on_page = 0
+
+    pages[-1].append(("thead", y)); y += 8
+    fresh = BODY_BOTTOM - (CONTD_TOP + 8 + CARRY_H)  # room for rows on a continuation page
+    running, on_page, items = 0.0, 0, data['items']
+    for k, item in enumerate(items):
+        paras = [(lines, max(5, len(lines) * 5)) for lines in
+                 (wrap_text(pdf, sanitize_text(p), PDF_COLS[0]) for p in item['desc'].split('\n'))]
+        h = max(8, sum(ph for _, ph in paras))
+        reserve = CARRY_H if k < len(items) - 1 else 0
+        if on_page and y + h + reserve > BODY_BOTTOM and h + reserve <= fresh: break_table()
+        first = True  # the part of the row that shows unit, qty, rate and amount
+        while y + h + reserve > BODY_BOTTOM:  # taller than a page: split it by lines
+            part, paras = _split_paras(paras, int((BODY_BOTTOM - CARRY_H - y) // 5))
+            if not part or not paras:
+                paras = part + paras
+                break_table()
+                continue
+            part_h = sum(ph for _, ph in part)
+            pages[-1].append(("row", y, part_h, k, part, first)); y += part_h
+            if first: running += item['qty'] * item['rate']; first = False
+            on_page += 1
+            break_table()
+            h = max(8, sum(ph for _, ph in paras))
+        pages[-1].append(("row", y, h, k, paras, first)); y += h
+        if first: running += item['qty'] * item['rate']
+        on_page += 1
+
+    place(("totals",), 2 + 6 * (2 if hide_gst else 3) + 2 + 6)
+    if schedule_list:
+        if y + 8 + 6 + 6 + 6 > BODY_BOTTOM: y = new_page()  # keep the title and header with a row
+        place(("schedule",), 8 + 6 + 6)
+        for k in range(len(schedule_list)):
+            if y + 6 > BODY_BOTTOM:
+                y = new_page()
+                pages[-1].append(("sched_thead", y)); y += 6
+            place(("sched_row", k), 6)
+    term_lines = wrap_text(pdf, sanitize_text(data['meta']['terms']), PAGE_W - 20)
+    if y + 14 + 5 > BODY_BOTTOM: y = new_page()  # keep the title with its first line
+    place(("terms_title",), 14)
+    for line in term_lines: place(("terms_line", line), 5)
+    place(("footer",), 10 + 5 + 25)
+    return pages
+
+def _draw_letterhead(pdf, hide_gst):
+    if LOGO_FULL_PATH in pdf.images: pdf.image(LOGO_FULL_PATH, 10, 10, 35)
+    pdf.set_xy(110, 12); pdf.set_font('Times', 'B', 22)
+    pdf.set_text_color(0, 0, 128)
+    pdf.cell(90, 8, sanitize_text(COMPANY_NAME), 0, 1, 'R')
+    pdf.set_xy(110, 20); pdf.set_text_color(0, 0, 0); pdf.set_font('Times', '', 10)
+    pdf.cell(90, 5, sanitize_text(COMPANY_ADDRESS), 0, 1, 'R')
+    pdf.set_xy(110, 25); pdf.cell(90, 5, sanitize_text(f"Ph: {COMPANY_PHONE}"), 0, 1, 'R')
+    if not hide_gst: pdf.set_xy(110, 30); pdf.cell(90, 5, sanitize_text(f"GST: {COMPANY_GSTIN}"), 0, 1, 'R')
+    pdf.set_draw_color(0, 0, 0); pdf.line(10, 50, 200, 50)
+
+def _draw_footer(pdf):
+    """Bank details and signatory, drawn from the top of the page; the "footer" stamp moves it into place."""
+    pdf.set_margins(10, 10, 10)
+    pdf.set_draw_color(0, 0, 0); pdf.line(10, 10, 200, 10)
+    pdf.set_xy(10, 15); pdf.set_font('Times', 'B', 10); pdf.cell(90, 5, "ACCOUNT DETAILS", 0, 1, 'L')
+    pdf.set_font('Times', '', 9)
+    pdf.cell(90, 5, sanitize_text(f"BANK: {BANK_DETAILS['bank']}"), 0, 1, 'L')
+    pdf.cell(90, 5, sanitize_text(f"A/C: {BANK_DETAILS['ac']}"), 0, 1, 'L')
+    pdf.cell(90, 5, sanitize_text(f"IFSC: {BANK_DETAILS['ifsc']}"), 0, 1, 'L')
+    pdf.cell(90, 5, sanitize_text(f"NAME: {BANK_DETAILS['name']}"), 0, 1, 'L')
+    pdf.set_xy(130, 30)
+    pdf.set_font('Times', 'B', 10)
+    pdf.cell(60, 5, sanitize_text(SIGNATORY_NAME), 0, 1, 'C')
+    pdf.set_xy(130, 35)
+    pdf.cell(60, 5, "AUTHORIZED SIGNATORY", 0, 0, 'C')
+
+# name: (page format of the scratch document, drawing function)
+STAMPS = {
+    "letterhead": (dict(unit='mm', format='A4'), lambda pdf: _draw_letterhead(pdf, False)),
+    "letterhead_no_gst": (dict(unit='mm', format='A4'), lambda pdf: _draw_letterhead(pdf, True)),
+    "footer": (dict(unit='mm', format='A4'), _draw_footer),
+    "receipt_head": (dict(format='A5', orientation='L'), _draw_receipt_head),
+    "receipt_signatory": (dict(format='A5', orientation='L'), _draw_receipt_signatory),
+}
+
+@profiler.timed()
+def generate_pdf_bytes(data, gst_rate_key, hide_gst, schedule_list, doc_no):
+    try:
+        pages = pdf_layout(data, gst_rate_key, hide_gst, schedule_list)
+        pdf = new_pdf(load_fpdf()[0], unit='mm', format='A4')
+        pdf.set_auto_page_break(False); pdf.set_margins(10, 10, 10)
+        cols = PDF_COLS
+        display_type = "BILL" if data['meta']['type'] == "FINAL BILL" else data['meta']['type']
+        sub, gst, grand = calculate_totals(data['items'], gst_rate_key)
+        if hide_gst: gst=0; grand=sub
+
+        def print_total(label, val, bold=False):
+            if bold: pdf.set_font('Times', 'B', 11)
+            else: pdf.set_font('Times', '', 10)
+            pdf.cell(165, 6, label, 0, 0, 'R'); pdf.cell(25, 6, f"Rs. {val:,.2f}", 0, 1, 'R')
+
+        def schedule_head(y):
+            pdf.set_xy(10, y); pdf.set_font('Times', 'B', 10); pdf.set_fill_color(245, 245, 245)
+            pdf.cell(80, 6, "Stage", 1, 0, 'L', 1); pdf.cell(40, 6, "Amount", 1, 0, 'C', 1); pdf.cell(70, 6, "Date", 1, 1, 'L', 1)
+
+        for page_no, ops in enumerate(pages, 1):
+            pdf.add_page()
+            for op in ops:
+                kind, y = op[0], op[1]
+                if kind == "letterhead":
+                    stamp(pdf, "letterhead_no_gst" if hide_gst else "letterhead")
+                    pdf.set_y(55); pdf.set_font('Times', 'B', 16)
+                    pdf.cell(0, 8, sanitize_text(display_type), 0, 1, 'C')
+                    y_info = 68
+                    pdf.set_xy(10, y_info); pdf.set_font('Times', 'B', 10); pdf.cell(90, 5, "DOCUMENT DETAILS:", 0, 1)
+                    pdf.set_font('Times', '', 10); pdf.set_x(10)
+                    lbl = "Invoice No" if data['meta']['type'] == "FINAL BILL" else "Quotation No"
+                    pdf.cell(90, 5, sanitize_text(f"{lbl}: {doc_no}"), 0, 1)
+                    pdf.set_x(10); pdf.cell(90, 5, sanitize_text(f"Date: {data['meta']['date']}"), 0, 1)
+                    pdf.set_xy(110, y_info); pdf.set_font('Times', 'B', 10); pdf.cell(90, 5, "TO CLIENT:", 0, 1)
+                    pdf.set_xy(110, y_info + 6); pdf.set_font('Times', 'B', 12)
+                    pdf.cell(90, 6, sanitize_text(data['client']['name']), 0, 1)
+                    pdf.set_font('Times', '', 10)
+                    for i, line in enumerate(op[2]):
+                        pdf.set_xy(110, y_info + 12 + 5 * i); pdf.cell(90, 5, line)
+                elif kind == "client_line":
+                    pdf.set_xy(110, y); pdf.set_font('Times', '', 10); pdf.cell(90, 5, op[2])
+                elif kind == "contd":
+                    pdf.set_xy(10, 10); pdf.set_font('Times', 'B', 12); pdf.set_text_color(0, 0, 128)
+                    pdf.cell(95, 6, sanitize_text(COMPANY_NAME), 0, 0, 'L')
+                    pdf.set_text_color(0, 0, 0); pdf.set_font('Times', '', 10)
+                    pdf.cell(95, 6, sanitize_text(f"{display_type} {doc_no} (contd.)"), 0, 0, 'R')
+                    pdf.set_draw_color(0, 0, 0); pdf.line(10, 18, 200, 18)
+                elif kind == "thead":
+                    pdf.set_xy(10, y); pdf.set_fill_color(240, 240, 240); pdf.set_font('Times', 'B', 10)
+                    for i, h in enumerate(["Description", "Unit", "Qty", "Rate", "Amount"]):
+                        pdf.cell(cols[i], 8, h, 1, 0, 'L' if i == 0 else 'R', 1)
+                elif kind == "carry":
+                    pdf.set_xy(10, y); pdf.set_font('Times', 'I', 10)
+                    pdf.cell(sum(cols[:4]), CARRY_H, op[2], 1, 0, 'R'); pdf.cell(cols[4], CARRY_H, f"{op[3]:.2f}", 1, 0, 'R')
+                elif kind == "row":
+                    total_h, item, paras, first = op[2], data['items'][op[3]], op[4], op[5]
+                    pdf.set_font('Times', '', 10)
+                    pdf.rect(10, y, cols[0], total_h)
+                    current_y = y
+                    for idx, (lines, h) in enumerate(paras):
+                        for n, line in enumerate(lines):
+                            pdf.set_xy(10, current_y + 5 * n); pdf.cell(cols[0], 5, line, 0, 0, 'L')
+                        current_y += h
+                        if idx < len(paras) - 1: pdf.line(10, current_y, 10 + cols[0], current_y)
+                    x = 10 + cols[0]
+                    for w, text, align in ((cols[1], sanitize_text(item['unit']), 'C'), (cols[2], str(item['qty']), 'C'),
+                                           (cols[3], f"{item['rate']:.2f}", 'R'), (cols[4], f"{item['qty']*item['rate']:.2f}", 'R')):
+                        pdf.set_xy(x, y); pdf.cell(w, total_h, text if first else "", 1, 0, align); x += w
+                elif kind == "totals":
+                    pdf.set_xy(10, y + 2)
+                    print_total("Subtotal:", sub)
+                    if not hide_gst: print_total(f"GST ({gst_rate_key}):", gst)
+                    print_total("Grand Total:", grand, bold=True)
+                    pdf.ln(2); pdf.set_font('Times', 'I', 10)
+                    pdf.cell(0, 6, number_to_words_safe(grand), 0, 1, 'R')
+                elif kind == "schedule":
+                    pdf.set_xy(10, y + 8); pdf.set_font('Times', 'B', 10); pdf.cell(0, 6, "PAYMENT SCHEDULE:", 0, 1, 'L')
+                    schedule_head(y + 14)
+                elif kind == "sched_thead":
+                    schedule_head(y)
+                elif kind == "sched_row":
+                    r = schedule_list[op[2]]
+                    pdf.set_xy(10, y); pdf.set_font('Times', '', 9)
+                    pdf.cell(80, 6, sanitize_text(str(r.get("Stage",""))), 1)
+                    pdf.cell(40, 6, sanitize_text(str(r.get("Amount",""))), 1, 0, 'C')
+                    pdf.cell(70, 6, sanitize_text(str(r.get("Date",""))), 1, 1)
+                elif kind == "terms_title":
+                    pdf.set_xy(10, y + 8); pdf.set_font('Times', 'B', 10); pdf.cell(0, 6, "TERMS & CONDITIONS:", 0, 1, 'L')
+                elif kind == "terms_line":
+                    pdf.set_xy(10, y); pdf.set_font('Times', '', 10); pdf.cell(0, 5, op[2], 0, 0, 'L')
+                elif kind == "footer":
+                    stamp(pdf, "footer", y)
+            if len(pages) > 1:
+                pdf.set_xy(10, PAGE_H - 10); pdf.set_font('Times', 'I', 8)
+                pdf.cell(0, 5, f"Page {page_no} of {len(pages)}", 0, 0, 'C')
+        return pdf.output(dest='S').encode('latin-1')
+    except Exception as e: return None
+
+# --- DOCX GENERATOR ---
+# Word documents start from a base .docx holding the styles, letterhead and
+# footer, built once per process. Each render parses those bytes and lays
+# out only the client, items, totals, schedule and terms between copies of
+# the letterhead and footer blocks.
+
+_docx_base = []  # [base .docx bytes], built on first use
+_docx_lock = threading.Lock()
+
+def docx_base():
+    with _docx_lock:
+        if not _docx_base:
+            from docx import Document
+            from docx.shared import Pt, Inches, RGBColor
+            from docx.enum.text import WD_ALIGN_PARAGRAPH
+            doc = Document(); style = doc.styles['Normal']; style.font.name = 'Times New Roman'; style.font.size = Pt(10)
+            ht = doc.add_table(rows=1, cols=2); ht.autofit = False; ht.columns[0].width = Inches(2.5); ht.columns[1].width = Inches(4.0)
+            if os.path.exists(LOGO_FULL_PATH): 
+                try: ht.cell(0,0).paragraphs[0].add_run().add_picture(LOGO_FULL_PATH, width=Inches(2.0))
+                except: pass
+            p = ht.cell(0,1).paragraphs[0]; p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+            r = p.add_run(COMPANY_NAME + "\n"); r.bold = True; r.font.size = Pt(18); r.font.color.rgb = RGBColor(0, 0, 128)
+            p.add_run(f"{COMPANY_ADDRESS}\nPh: {COMPANY_PHONE}")
+            p.add_run(f"\nGST: {COMPANY_GSTIN}")  # the last run; dropped for hide_gst documents
+            doc.add_paragraph("_"*70)
+            doc.add_paragraph("_"*70)
+            ft = doc.add_table(rows=1, cols=2); ft.autofit = True
+            ft.cell(0,0).paragraphs[0].add_run(f"BANK DETAILS\nBANK: {BANK_DETAILS['bank']}\nA/C: {BANK_DETAILS['ac']}\nIFSC: {BANK_DETAILS['ifsc']}")
+            sig_cell = ft.cell(0,1).paragraphs[0]
+            sig_cell.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+            sig_cell.add_run(f"\n\n{SIGNATORY_NAME}\nAUTHORIZED SIGNATORY").bold = True
+            f = io.BytesIO(); doc.save(f); _docx_base.append(f.getvalue())
+        return _docx_base[0]
+
+def _docx_content(doc, data, gst_rate_key, hide_gst, schedule_list, doc_no):
+    from docx.enum.text import WD_ALIGN_PARAGRAPH
+    display_type = "BILL" if data['meta']['type'] == "FINAL BILL" else data['meta']['type']
+    doc.add_paragraph(display_type).alignment = WD_ALIGN_PARAGRAPH.CENTER
+    t = doc.add_table(rows=1, cols=2); t.autofit = True
+    
+    lbl = "Invoice No" if data['meta']['type'] == "FINAL BILL" else "Quotation No"
+    t.cell(0,0).paragraphs[0].add_run(f"DETAILS:\n{lbl}: {doc_no}\nDate: {data['meta']['date']}")
+    
+    c_cell = t.cell(0,1)
+    c_cell.paragraphs[0].add_run("TO CLIENT:\n").bold = True
+    c_cell.paragraphs[0].add_run(f"{data['client']['name']}\n").bold = True
+    c_cell.paragraphs[0].add_run(f"{data['client']['phone']}\n{data['client']['address']}")
+    
+    doc.add_paragraph("\n")
+    # 5 COLUMNS in Word
+    tbl = doc.add_table(rows=1, cols=5); tbl.style = 'Table Grid'
+    hdrs = ["Description", "Unit", "Qty", "Rate", "Amount"]
+    for i,h in enumerate(hdrs): tbl.rows[0].cells[i].text = h
+    for item in data['items']:
+        rc = tbl.add_row().cells
+        rc[0].text=item['desc']
+        rc[1].text=item['unit']
+        rc[2].text=str(item['qty'])
+        rc[3].text=f"{item['rate']:.2f}"
+        rc[4].text=f"{item['qty']*item['rate']:.2f}"
+    sub, gst, grand = calculate_totals(data['items'], gst_rate_key)
+    if hide_gst: gst=0; grand=sub
+    p = doc.add_paragraph(); p.alignment = WD_ALIGN_PARAGRAPH.RIGHT
+    p.add_run(f"\nSubtotal: {sub:,.2f}\n"); 
+    if not hide_gst: p.add_run(f"GST ({gst_rate_key}): {gst:,.2f}\n")
+    p.add_run(f"Grand Total: Rs. {grand:,.2f}").bold = True
+    p.add_run(f"\n{number_to_words_safe(grand)}").italic = True
+    if schedule_list:
+        doc.add_paragraph("\nPAYMENT SCHEDULE:").runs[0].bold = True
+        stbl = doc.add_table(rows=1, cols=3); stbl.style = 'Table Grid'; shdrs = ["Stage", "Amount", "Date"]
+        for i, h in enumerate(shdrs): stbl.rows[0].cells[i].text = h
+        for row in schedule_list:
+            rc = stbl.add_row().cells; rc[0].text=str(row.get("Stage","")); rc[1].text=str(row.get("Amount","")); rc[2].text=str(row.get("Date",""))
+    doc.add_paragraph("\nTERMS:\n"+data['meta']['terms'])
+
+_docx_local = threading.local()
+
+def _docx_blank():
+    """This thread's parsed copy of the base, its body emptied, and the letterhead and footer blocks."""
+    if not hasattr(_docx_local, 'doc'):
+        from docx import Document
+        doc = Document(io.BytesIO(docx_base()))
+        body = doc.element.body
+        blocks = [el for el in body.iterchildren() if el is not body.sectPr]
+        for el in blocks: body.remove(el)
+        _docx_local.doc = doc
+        _docx_local.blocks = blocks[:2], blocks[2:]  # letterhead table and rule; footer rule and table
+    return _docx_local.doc, _docx_local.blocks
+
+def merged_docx_bytes(documents):
+    """One Word file holding every (data, gst key, hide_gst, schedule, doc no) in
+    `documents`, a page each, filled into a copy of the base document."""
+    from docx.enum.text import WD_BREAK
+    doc, (head, foot) = _docx_blank()
+    body = doc.element.body
+    picture_ids = 0
+    try:
+        for k, (data, gst_rate_key, hide_gst, schedule_list, doc_no) in enumerate(documents):
+            if k: doc.add_paragraph().add_run().add_break(WD_BREAK.PAGE)
+            letterhead, rule = (copy.deepcopy(el) for el in head)
+            for pic in letterhead.xpath('.//wp:docPr'):  # Word wants every drawing id unique
+                picture_ids += 1; pic.set('id', str(picture_ids))
+            if hide_gst:
+                gst_run = letterhead.xpath('./w:tr/w:tc[2]/w:p/w:r')[-1]; gst_run.getparent().remove(gst_run)
+            body.sectPr.addprevious(letterhead); body.sectPr.addprevious(rule)
+            _docx_content(doc, data, gst_rate_key, hide_gst, schedule_list, doc_no)
+            for el in foot: body.sectPr.addprevious(copy.deepcopy(el))
+        f = io.BytesIO(); doc.save(f); f.seek(0); return f
+    finally:
+        for el in [el for el in body.iterchildren() if el is not body.sectPr]: body.remove(el)
+
+@profiler.timed()
+def generate_docx_bytes(data, gst_rate_key, hide_gst, schedule_list, doc_no):
+    return merged_docx_bytes([(data, gst_rate_key, hide_gst, schedule_list, doc_no)])
+
+# --- RENDER CACHE ---
+def _key_part(obj):
+    # Stored records hash like the dicts the Builder passes for the same document
+    return obj.to_dict() if isinstance(obj, Record) else str(obj)
+
+class RenderCache:
+    """Rendered documents keyed by a hash of their inputs, LRU-evicted by total bytes."""
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0; self.hits = 0; self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(json.dumps(parts, sort_keys=True, default=_key_part).encode()).hexdigest()
+
+    def get_or_render(self, key, render):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key); self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        out = render()
+        if out is not None: self.put(key, out)
+        return out
+
+    def get(self, key):
+        """Cached bytes or None, without rendering."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key); self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, blob):
+        with self._lock:
+            if key in self._entries: self.size -= len(self._entries.pop(key))
+            self._entries[key] = blob; self.size += len(blob)
+            while self.size > self.max_bytes and len(self._entries) > 1:
+                _, old = self._entries.popitem(last=False); self.size -= len(old)
+
+    def __contains__(self, key):
+        with self._lock: return key in self._entries
+
+    def stats(self):
+        return f"Render cache: {self.hits} hits / {self.misses} misses, {len(self._entries)} docs, {self.size / 1024:,.0f} KB"
+
+# One cache and one render queue per process, shared by every session
+render_cache = RenderCache()
+render_queue = RenderQueue(render_cache)
+
+# Each document kind has a job (id, render) pair. pdf_job() etc. queue it in
+# the background and return the id; cached_*_bytes() wait for the bytes.
+# Both join an identical job already in flight.
+def _pdf_render(data, gst_rate_key, hide_gst, schedule_list, doc_no):
+    return (RenderCache.key("pdf", data, gst_rate_key, hide_gst, schedule_list, doc_no),
+            lambda: generate_pdf_bytes(data, gst_rate_key, hide_gst, schedule_list, doc_no))
+
+def _docx_render(data, gst_rate_key, hide_gst, schedule_list, doc_no):
+    return (RenderCache.key("docx", data, gst_rate_key, hide_gst, schedule_list, doc_no),
+            lambda: generate_docx_bytes(data, gst_rate_key, hide_gst, schedule_list, doc_no).getvalue())
+
+def receipt_key(payment): return RenderCache.key("receipt", payment)
+
+def pdf_key(data, gst_rate_key, hide_gst, schedule_list, doc_no):
+    """Job id pdf_job() would use, without queueing anything."""
+    return _pdf_render(data, gst_rate_key, hide_gst, schedule_list, doc_no)[0]
+
+def pdf_job(data, gst_rate_key, hide_gst, schedule_list, doc_no, retry=False):
+    return render_queue.submit(*_pdf_render(data, gst_rate_key, hide_gst, schedule_list, doc_no), retry=retry)
+
+def receipt_job(payment):
+    # Only queued on request, so a failed receipt may be retried
+    return render_queue.submit(receipt_key(payment), lambda: generate_receipt_bytes(payment), retry=True)
+
+def cached_pdf_bytes(data, gst_rate_key, hide_gst, schedule_list, doc_no):
+    return render_queue.wait(*_pdf_render(data, gst_rate_key, hide_gst, schedule_list, doc_no))
+
+def cached_docx_bytes(data, gst_rate_key, hide_gst, schedule_list, doc_no):
+    return render_queue.wait(*_docx_render(data, gst_rate_key, hide_gst, schedule_list, doc_no))
+
+def cached_receipt_bytes(payment):
+    return render_queue.wait(receipt_key(payment), lambda: generate_receipt_bytes(payment))
+
+def receipts_zip_bytes(payments):
+    """All receipts for a bill in one ZIP, rendered in a single batch."""
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for idx, p in enumerate(payments):
+            rec_bytes = cached_receipt_bytes(p)
+            if rec_bytes: zf.writestr(f"Receipt_{idx+1}_{p['date']}.pdf", rec_bytes)
+    return buf.getvalue()
+
+def receipts_zip_job(payments):
+    return render_queue.submit(RenderCache.key("receipts-zip", payments), lambda: receipts_zip_bytes(payments))
+
+# --- BULK EXPORT ---
+# Module-level functions, so export_zip() can pickle them to its workers
+def bulk_pdf(args): return generate_pdf_bytes(*args)
+def bulk_docx(args): return generate_docx_bytes(*args).getvalue()
+def bulk_merged_docx(docs): return merged_docx_bytes(docs).getvalue()
+
+BULK_RENDERERS = {"pdf": bulk_pdf, "docx": bulk_docx, "merged-docx": bulk_merged_docx, "receipt": generate_receipt_bytes}
+BULK_FORMATS = {"pdf": "PDF per bill", "docx": "Word per bill", "merged-docx": "One Word file, all bills"}
+
+def record_render_args(rec):
+    """(fdata, gst key, hide_gst, schedule, doc no) for a stored invoice or quotation."""
+    doc_no = rec.get('quotation_no') if rec.get('type') == "QUOTATION" else rec.get('invoice_no')
+    return (record_fdata(rec), rec.get('gst_rate','18%'), rec.get('hide_gst', False), rec.get('schedule',[]), doc_no or rec['id'])
+
+def safe_filename(name): return re.sub(r'[\\/:*?"<>|]', '_', name)
+
+def record_fdata(rec):
+    return {
+        "meta": {"type": rec['type'], "date": rec['date'], "terms": rec.get('terms', "")},
+        "client": {"name": rec['client_name'], "phone": rec.get('client_phone',''), "address": rec.get('client_address','')},
+        "items": rec['items']
+    }
+
+def bulk_jobs(store, invoices, formats, with_receipts):
+    """(arcname, kind, payload) for every document of the given bills, built lazily.
+
+    "merged-docx" is a single job at the end whose payload is every bill's render args.
+    """
+    merged = []
+    for rec in invoices:
+        args = record_render_args(rec)
+        base = safe_filename(f"{args[-1]} {rec['client_name']}")
+        for kind in formats:
+            if kind == "merged-docx": merged.append(args)
+            else: yield (f"bills/{base}.{kind}", kind, args)
+        if with_receipts:
+            for idx, p in enumerate(store.payments_for(rec['id'])):
+                yield (f"receipts/{base} Receipt {idx+1}.pdf", "receipt", p)
+    if merged: yield ("bills/All Bills.docx", "merged-docx", merged)
+
+def bulk_count(store, invoices, formats, with_receipts):
+    """How many jobs bulk_jobs() yields, for progress reporting."""
+    n = len(invoices) * sum(kind != "merged-docx" for kind in formats) + bool(invoices and "merged-docx" in formats)
+    if with_receipts: n += sum(len(store.payments_for(i['id'])) for i in invoices)
+    return n
+
+# --- CSV EXPORT ---
+BILL_LINE_FIELDS = ["invoice_no", "date", "client_name", "client_phone", "status", "gst_rate", "bill_amount", "tax",
+                    "line", "category", "desc", "unit", "qty", "rate", "line_amount"]
+PAYMENT_FIELDS = ["id", "date", "invoice_id", "invoice_date", "client_name", "amount", "mode"]
+
+def bill_line_rows(invoices):
+    """One flat row per line item, led by its bill's keys; bills without items get one row."""
+    for rec in invoices:
+        head = [rec.get('invoice_no') or rec.get('id'), rec.get('date'), rec.get('client_name'), rec.get('client_phone', ''),
+                rec.get('status', ''), rec.get('gst_rate', ''), rec.get('amount'), rec.get('tax')]
+        items = rec.get('items') or [{}]
+        for n, i in enumerate(items, 1):
+            amount = i['qty'] * i['rate'] if 'qty' in i and 'rate' in i else ""
+            yield head + [n, i.get('category', ''), i.get('desc', ''), i.get('unit', ''), i.get('qty', ''), i.get('rate', ''), amount]
+
+def payment_rows(payments):
+    for p in payments: yield [p.get(f, '') for f in PAYMENT_FIELDS]
+
+def write_csv(out, header, rows, chunk_rows=2000):
+    """Write `rows` to binary file `out` as UTF-8 CSV, one write per chunk.
+
+    Only one chunk of text is held at a time, so memory stays flat however
+    many rows the iterator yields. Returns the number of rows written.
+    """
+    buf = io.StringIO()
+    w = csv.writer(buf, lineterminator="\n")
+    w.writerow(header)
+    n = 0
+    for row in rows:
+        w.writerow(row); n += 1
+        if n % chunk_rows == 0:
+            out.write(buf.getvalue().encode('utf-8'))
+            buf.seek(0); buf.truncate()
+    out.write(buf.getvalue().encode('utf-8'))
+    return n
+
+@profiler.timed()
+def csv_export_file(header, rows_of, records):
+    """Stream `rows_of(records)` into an anonymous temp file, rewound for reading; removed when closed.
+
+    Takes the row generator's function rather than a generator, so a deferred
+    download bound with partial() writes every row each time it runs.
+    """
+    import tempfile
+    # Unbuffered: write_csv already writes in chunks, and download_button takes raw files
+    f = tempfile.TemporaryFile(prefix="sn_csv_", buffering=0)
+    write_csv(f, header, rows_of(records))
+    f.seek(0)
+    return f
+
+# --- ANALYTICS ---
+@functools.lru_cache(maxsize=4096)
+def catalog_category(desc):
+    """The WORK_CATALOG entry an item description starts with, for items saved without a category."""
+    text = re.sub(r"^\d+\.\s*", "", str(desc or "")).lower()  # "1. Site Visit" from "Add Numbering"
+    return max((c for c in WORK_CATALOG if text.startswith(c.lower())), key=len, default="")
+
+@profiler.timed()
+def line_items_frame(store):
+    """Every live invoice line as one DataFrame row, with amount and tax; rebuilt only when the store changes."""
+    def build():
+        import numpy as np
+        import pandas as pd
+        lines = store.line_items(catalog_category)
+        with store.reading():  # a snapshot; commits append to the columns meanwhile
+            c = {name: list(col) for name, col in lines.cols.items()}
+            alive, dead = list(lines.alive), lines.dead
+        gst_keys = list(GST_RATES) + sorted(set(c['gst_rate']) - GST_RATES.keys())
+        df = pd.DataFrame({
+            "invoice_id": c['invoice_id'],
+            "date": pd.to_datetime(pd.Series(c['date'], dtype=object), format="%Y-%m-%d", errors="coerce"),
+            "month": pd.Categorical(c['month']),
+            "category": pd.Categorical(c['category']),
+            "unit": pd.Categorical(c['unit']),
+            "qty": np.asarray(c['qty'], dtype=float),
+            "rate": np.asarray(c['rate'], dtype=float),
+            "gst_rate": pd.Categorical(c['gst_rate'], categories=gst_keys),
+        })
+        pct = np.array([GST_RATES.get(k, 0.0) for k in gst_keys])[df['gst_rate'].cat.codes]
+        df['amount'] = df['qty'] * df['rate']
+        df['tax'] = df['amount'] * pct * ~np.asarray(c['hide_gst'], dtype=bool)
+        if dead: df = df[np.asarray(alive, dtype=bool)].reset_index(drop=True)
+        return df
+    return store.cached(('line_items',), build)
+
+def _report(store, name, d_from, d_to, build):
+    """Cached report over the line items dated within [d_from, d_to] (ISO strings, or None for all)."""
+    store.load_since(d_from)
+    def run():
+        df = line_items_frame(store)
+        if d_from or d_to:
+            import pandas as pd
+            dates = df['date']
+            mask = dates.notna()
+            if d_from: mask &= dates >= pd.Timestamp(d_from)
+            if d_to: mask &= dates <= pd.Timestamp(d_to)
+            df = df[mask]
+        return build(df)
+    return store.cached(('report', name, d_from, d_to), run)
+
+@profiler.timed()
+def gst_summary(store, d_from=None, d_to=None):
+    """GSTR-style summary: taxable value and CGST/SGST per month and GST rate."""
+    def build(df):
+        g = df.groupby(['month', 'gst_rate'], observed=True).agg(
+            invoices=('invoice_id', 'nunique'), lines=('amount', 'size'), taxable=('amount', 'sum'), tax=('tax', 'sum')).reset_index()
+        g['cgst'] = g['tax'] / 2; g['sgst'] = g['tax'] / 2  # intra-state supply: split equally
+        g['total'] = g['taxable'] + g['tax']
+        return g[['month', 'gst_rate', 'invoices', 'lines', 'taxable', 'cgst', 'sgst', 'tax', 'total']]
+    return _report(store, 'gst', d_from, d_to, build)
+
+@profiler.timed()
+def category_revenue(store, d_from=None, d_to=None):
+    """Revenue (pre-tax) per WORK_CATALOG category, one column per month."""
+    def build(df):
+        p = df.pivot_table(index='category', columns='month', values='amount', aggfunc='sum', fill_value=0, observed=True)
+        p['Total'] = p.sum(axis=1)
+        return p.sort_values('Total', ascending=False).reset_index()
+    return _report(store, 'category', d_from, d_to, build)
+
+@profiler.timed()
+def unit_volumes(store, d_from=None, d_to=None):
+    """Quantity billed per category and unit, with line count and average rate."""
+    def build(df):
+        g = df.groupby(['category', 'unit'], observed=True).agg(
+            lines=('qty', 'size'), qty=('qty', 'sum'), amount=('amount', 'sum')).reset_index()
+        g['avg_rate'] = (g['amount'] / g['qty'].where(g['qty'] != 0)).round(2)
+        return g.sort_values('amount', ascending=False, ignore_index=True)
+    return _report(store, 'units', d_from, d_to, build)
+
+REPORTS = {"gst": gst_summary, "category": category_revenue, "units": unit_volumes}
+
+# --- CLI ---
+def find_document(store, doc_no):
+    """Look in the live partition first, then open the closed years."""
+    for opened in (False, True):
+        if opened: store.load_since()
+        for t in ('invoices', 'quotations'):
+            for rec in store.records(t) if opened else store.db[t]:
+                if doc_no in (rec.get('invoice_no'), rec.get('quotation_no'), rec.get('id')): return rec
+    return None
+
+def cmd_render(store, args):
+    rec = find_document(store, args.doc_no)
+    if rec is None: sys.exit(f"No invoice or quotation {args.doc_no}")
+    render_args = record_render_args(rec)
+    if args.format == "pdf": blob = generate_pdf_bytes(*render_args)
+    elif args.format == "docx": blob = generate_docx_bytes(*render_args).getvalue()
+    else: blob = generate_csv_bytes(rec['items'])
+    if blob is None: sys.exit("Render failed")
+    out = args.output or safe_filename(f"{render_args[-1]} {rec['client_name']}.{args.format}")
+    with open(out, 'wb') as f: f.write(blob)
+    print(out)
+
+def cmd_export_ledger(store, args):
+    """Bills in range with paid and pending amounts, as CSV."""
+    invs = store.in_range('invoices', args.date_from, args.date_to, args.client)
+    if args.lines:
+        out = open(args.output, 'wb') if args.output else sys.stdout.buffer
+        try: write_csv(out, BILL_LINE_FIELDS, bill_line_rows(invs))
+        finally:
+            if args.output: out.close()
+        return
+    out = open(args.output, 'w', newline='') if args.output else sys.stdout
+    try:
+        w = csv.writer(out)
+        w.writerow(["invoice_no", "date", "client_name", "amount", "tax", "paid", "pending", "status"])
+        for i in invs:
+            paid = store.paid(i['id'])
+            w.writerow([i.get('invoice_no', i['id']), i['date'], i['client_name'], i['amount'], i['tax'], paid, i['amount'] - paid, i.get('status', '')])
+    finally:
+        if args.output: out.close()
+
+def cmd_bulk_export(store, args):
+    invs = store.in_range('invoices', args.date_from, args.date_to, args.client)
+    n_docs = bulk_count(store, invs, args.formats, args.receipts)
+    progress = lambda done, total: print(f"\r{done}/{total}", end="", file=sys.stderr, flush=True)
+    written, failed = export_zip(bulk_jobs(store, invs, args.formats, args.receipts), args.output, BULK_RENDERERS,
+                                 total=n_docs, workers=args.workers, progress=progress)
+    print(f"\n{written} documents written to {args.output}", file=sys.stderr)
+    for name in failed: print(f"failed: {name}", file=sys.stderr)
+
+def cmd_report(store, args):
+    df = REPORTS[args.report](store, args.date_from, args.date_to)
+    df.to_csv(args.output or sys.stdout, index=False)
+
+def cmd_next_id(store, args):
+    doc_type = "FINAL BILL" if args.type == "bill" else "QUOTATION"
+    print(generate_next_id(store, doc_type, datetime.strptime(args.date, '%Y-%m-%d').date()))
+
+def cmd_maintain(store, args):
+    """Fix bill statuses, archive closed fiscal years and compact; the writes loads leave out."""
+    n = reconcile_statuses(store)
+    store.maintain()
+    print(f"{n} bills marked Completed. {store.year_stats()}")
+
+def main(argv=None):
+    today = str(date.today())
+    parser = argparse.ArgumentParser(prog="billing_core", description="SN Associates billing without the UI.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("render", help="render one invoice or quotation")
+    p.add_argument("doc_no", help="invoice_no, quotation_no or record id")
+    p.add_argument("--format", choices=["pdf", "docx", "csv"], default="pdf")
+    p.add_argument("-o", "--output")
+    p.set_defaults(func=cmd_render)
+
+    for name, func, help_txt in (("export-ledger", cmd_export_ledger, "bills with paid/pending as CSV"),
+                                 ("bulk-export", cmd_bulk_export, "bills and receipts into a ZIP")):
+        p = sub.add_parser(name, help=help_txt)
+        p.add_argument("--from", dest="date_from", default=f"{date.today().year}-01-01")
+        p.add_argument("--to", dest="date_to", default=today)
+        p.add_argument("--client")
+        p.set_defaults(func=func)
+        if name == "export-ledger":
+            p.add_argument("-o", "--output")
+            p.add_argument("--lines", action="store_true", help="one row per line item instead of per bill")
+        else:
+            p.add_argument("-o", "--output", required=True)
+            p.add_argument("--formats", nargs="+", choices=list(BULK_FORMATS), default=["pdf"])
+            p.add_argument("--receipts", action="store_true")
+            p.add_argument("--workers", type=int)
+
+    p = sub.add_parser("report", help="GST summary, category revenue or unit volumes as CSV")
+    p.add_argument("report", choices=list(REPORTS))
+    p.add_argument("--from", dest="date_from")
+    p.add_argument("--to", dest="date_to")
+    p.add_argument("-o", "--output")
+    p.set_defaults(func=cmd_report)
+
+    p = sub.add_parser("next-id", help="preview the next document number")
+    p.add_argument("type", choices=["bill", "quotation"])
+    p.add_argument("--date", default=today)
+    p.set_defaults(func=cmd_next_id)
+
+    p = sub.add_parser("maintain", help="mark paid bills Completed, archive closed years, compact")
+    p.set_defaults(func=cmd_maintain)
+
+    args = parser.parse_args(argv)
+    args.func(open_default_store(), args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+# kind -> callable(payload) -> bytes, in a worker process. Workers are never
+# forked from the caller, which may be a threaded server holding locks, so
+# the renderers reach them pickled: they must be module-level functions.
+_renderers = {}
+
+
+def _init_worker(renderers):
+    global _renderers
+    _renderers = renderers
+
+
+def _render(job, renderers=None):
+    name, kind, payload = job
+    try: blob = (renderers or _renderers)[kind](payload)
+    except Exception: blob = None
+    return name, blob
+
+
+def export_zip(jobs, out_path, renderers, total=None, workers=None, progress=None):
+    """Render `jobs` across a process pool and stream the results into a ZIP.
+
+    `jobs` is an iterable of (arcname, kind, payload); it is consumed lazily
+    and at most two jobs per worker are in flight, so memory stays bounded
+    however many documents are exported. `progress(done, total)` is called
+    after each document. Returns (written, failed names).
+
+    Workers come from a fork server (or are spawned where there is none),
+    so they start clean rather than as copies of this process.
+    """
+    workers = workers or os.cpu_count() or 1
+    written, failed, done = 0, [], 0
+
+    with zipfile.ZipFile(out_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        def collect(name, blob):
+            nonlocal written, done
+            if blob: zf.writestr(name, blob); written += 1
+            else: failed.append(name)
+            done += 1
+            if progress: progress(done, total)
+
+        if workers == 1:
+            for job in jobs: collect(*_render(job, renderers))
+            return written, failed
+
+        jobs = iter(jobs)
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            ctx = multiprocessing.get_context('forkserver')
+            # Import the renderers' modules once in the server, not in every worker
+            ctx.set_forkserver_preload(sorted({f.__module__ for f in renderers.values()} - {'__main__'}))
+        else:
+            ctx = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=ctx, initializer=_init_worker, initargs=(renderers,)) as pool:
+            pending = set()
+            for job in jobs:
+                pending.add(pool.submit(_render, job))
+                if len(pending) >= workers * 2:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in finished: collect(*fut.result())
+            for fut in pending: collect(*fut.result())
+    return written, failed
@@ -0,0 +1,89 @@
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+class Profiler:
+    """Named timing spans grouped per Streamlit rerun.
+
+    Call `begin_run()` at the top of the script and `end_run()` at the
+    bottom; everything between is recorded in `span()` blocks or in
+    functions decorated with `timed()`. Outside a run (CLI, workers) spans
+    cost almost nothing and record nothing. Allocation counts are the net
+    change in live interpreter memory blocks across a span.
+    """
+
+    def __init__(self, log_path=None, keep=50, max_log_bytes=10 * 1024 * 1024):
+        self.log_path = log_path
+        self.max_log_bytes = max_log_bytes
+        self.recent = deque(maxlen=keep)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def begin_run(self, label=""):
+        self._local.run = {"label": label, "t0": time.perf_counter(), "blocks0": sys.getallocatedblocks(), "spans": []}
+        self._local.depth = 0
+
+    @contextmanager
+    def span(self, name):
+        run = getattr(self._local, 'run', None)
+        if run is None:
+            yield
+            return
+        t0 = time.perf_counter(); b0 = sys.getallocatedblocks()
+        depth = self._local.depth; self._local.depth += 1
+        try:
+            yield
+        finally:
+            self._local.depth = depth
+            run["spans"].append({"name": name, "depth": depth, "ms": (time.perf_counter() - t0) * 1000,
+                                 "blocks": sys.getallocatedblocks() - b0})
+
+    def timed(self, name=None):
+        def wrap(fn):
+            label = name or fn.__name__
+            @functools.wraps(fn)
+            def inner(*args, **kwargs):
+                with self.span(label): return fn(*args, **kwargs)
+            return inner
+        return wrap
+
+    def end_run(self):
+        """Close the current run, keep it in `recent` and log it. Returns the run record."""
+        run = getattr(self._local, 'run', None)
+        if run is None: return None
+        self._local.run = None
+        rec = {"ts": time.time(), "label": run["label"], "total_ms": (time.perf_counter() - run["t0"]) * 1000,
+               "blocks": sys.getallocatedblocks() - run["blocks0"], "spans": run["spans"]}
+        with self._lock:
+            self.recent.append(rec)
+            if self.log_path: self._write(rec)
+        return rec
+
+    def slowest(self, n=15):
+        """Per-span aggregates over the recent runs, slowest worst case first."""
+        agg = {}
+        with self._lock: runs = list(self.recent)
+        for run in runs:
+            for s in run["spans"]:
+                a = agg.setdefault(s["name"], {"span": s["name"], "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "blocks": 0})
+                a["calls"] += 1; a["total_ms"] += s["ms"]; a["max_ms"] = max(a["max_ms"], s["ms"]); a["blocks"] += s["blocks"]
+        for a in agg.values(): a["mean_ms"] = a["total_ms"] / a["calls"]
+        return sorted(agg.values(), key=lambda a: a["max_ms"], reverse=True)[:n]
+
+    def _write(self, rec):
+        try:
+            if os.path.exists(self.log_path) and os.path.getsize(self.log_path) > self.max_log_bytes:
+                os.replace(self.log_path, self.log_path + ".1")
+            with open(self.log_path, 'a') as f: f.write(json.dumps(rec) + "\n")
+        except OSError:
+            pass
+
+
+# One profiler per process, shared by every session
+profiler = Profiler(log_path=os.environ.get("SN_PERF_LOG"))
@@ -0,0 +1,102 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+class RenderQueue:
+    """Background document rendering with job ids and status.
+
+    A job id is the document's render-cache key, so asking for a document
+    that is already queued or rendering joins that job instead of starting
+    another, and one that has finished is served from the cache. Finished
+    bytes go into the cache; failures are remembered for `failure_ttl`
+    seconds (so a transient error is retried on a later request) or until
+    resubmitted with `retry=True`, and only the latest `max_failed` of them.
+    """
+
+    def __init__(self, cache, workers=2, failure_ttl=30.0, max_failed=256):
+        self.cache = cache
+        self.merged = 0
+        self.failure_ttl = failure_ttl
+        self.max_failed = max_failed
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="render")
+        self._jobs = {}     # job id -> Future, while queued or running
+        self._failed = OrderedDict()  # job id -> (error message, when), oldest first
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def submit(self, job_id, render, retry=False):
+        """Queue `render()` under `job_id` unless it is done, in flight or (without retry) failed."""
+        if job_id in self.cache: return job_id
+        fut = None
+        with self._lock:
+            if job_id in self._jobs:
+                self.merged += 1
+            elif self._failure(job_id) is None or retry:
+                self._failed.pop(job_id, None)
+                fut = self._pool.submit(self._run, render)
+                self._jobs[job_id] = fut
+        # Outside the lock: a job that has already finished runs the callback right here
+        if fut is not None: fut.add_done_callback(lambda f: self._finish(job_id, f))
+        return job_id
+
+    def status(self, job_id):
+        """'done', 'queued', 'running', 'failed' or None for an unknown job."""
+        if job_id in self.cache: return "done"
+        with self._lock:
+            fut = self._jobs.get(job_id)
+            if fut is not None: return "running" if fut.running() else "queued"
+            if self._failure(job_id) is not None: return "failed"
+        return None
+
+    def error(self, job_id):
+        with self._lock: return self._failure(job_id)
+
+    def _failure(self, job_id):
+        """Error message of a recent failure, else None; forgets expired ones. Caller holds the lock."""
+        hit = self._failed.get(job_id)
+        if hit is None: return None
+        if time.monotonic() - hit[1] > self.failure_ttl:
+            del self._failed[job_id]
+            return None
+        return hit[0]
+
+    def result(self, job_id):
+        """Bytes of a finished job, or None."""
+        return self.cache.get(job_id)
+
+    def wait(self, job_id, render):
+        """Render synchronously, joining an identical job if one is already in flight."""
+        blob = self.cache.get(job_id)
+        if blob is not None: return blob
+        if getattr(self._local, 'worker', False):
+            # Already on a worker: waiting on the pool could deadlock it
+            blob = render()
+            if blob is not None: self.cache.put(job_id, blob)
+            return blob
+        self.submit(job_id, render, retry=True)
+        with self._lock: fut = self._jobs.get(job_id)
+        if fut is None: return self.cache.get(job_id)
+        try: return fut.result()
+        except Exception: return None
+
+    def stats(self):
+        with self._lock: active, failed = len(self._jobs), len(self._failed)
+        return f"Render queue: {active} active, {failed} failed, {self.merged} merged"
+
+    def _run(self, render):
+        self._local.worker = True
+        blob = render()
+        if blob is None: raise RuntimeError("renderer returned nothing")
+        return blob
+
+    def _finish(self, job_id, fut):
+        error = fut.exception()
+        if error is None: self.cache.put(job_id, fut.result())
+        with self._lock:
+            self._jobs.pop(job_id, None)
+            if error is not None:
+                self._failed[job_id] = (str(error), time.monotonic())
+                self._failed.move_to_end(job_id)
+                while len(self._failed) > self.max_failed: self._failed.popitem(last=False)
@@ -0,0 +1,1412 @@
+import bisect
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import zlib
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+TABLES = ("invoices", "quotations", "payments")
+# Document-number prefix -> (table, number field) the sequence is rebuilt from
+SEQ_SOURCES = {"INV": ("invoices", "invoice_no"), "QUOT": ("quotations", "quotation_no")}
+
+_process_lock = threading.RLock()  # re-entered when a commit reloads under it
+
+
+class ConflictError(Exception):
+    """A write expected a record revision that someone else has since changed."""
+
+
+class JournalError(Exception):
+    """The snapshot, or a complete journal record, cannot be read: the file is corrupt."""
+
+
+class ArchivedError(ConflictError):
+    """A write targeted a record of a closed fiscal year, which is read-only.
+
+    A ConflictError so the engines and the UI refuse it the same way.
+    """
+
+
+@contextmanager
+def file_lock(path):
+    """Exclusive lock shared by every session and process using `path`."""
+    with _process_lock, open(path, 'a') as f:
+        if fcntl: fcntl.flock(f, fcntl.LOCK_EX)
+        try: yield
+        finally:
+            if fcntl: fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def empty_db():
+    return {t: [] for t in TABLES}
+
+
+# --- RECORDS ---
+# Only low-cardinality values are shared: enum-like strings are interned,
+# terms texts and item rates go through these tables. Free text (descriptions,
+# client details) is stored as given. The tables start over at _SHARED_MAX
+# entries and on every reload (see BaseStore._publish), so values of deleted
+# records are not kept alive.
+TERMS = {}  # terms text -> the one copy every record with that text shares
+_RATES = {}  # item qty/rate float -> shared copy; a catalogue has few distinct values
+_SHARED_MAX = 4096
+
+
+def _shared(table, v):
+    hit = table.get(v)
+    if hit is not None: return hit
+    if len(table) >= _SHARED_MAX: table.clear()
+    table[v] = v
+    return v
+
+
+def _forget_shared():
+    TERMS.clear()
+    _RATES.clear()
+
+
+def _text(v):
+    return sys.intern(v) if isinstance(v, str) else v
+
+
+def _terms(v):
+    return _shared(TERMS, v) if isinstance(v, str) else v
+
+
+def _number(v):
+    if isinstance(v, str): return float(v)
+    if v is None or isinstance(v, (int, float)): return v
+    raise ValueError(f"not a number: {v!r}")
+
+
+def _rate(v):
+    v = _number(v)
+    return _shared(_RATES, v) if isinstance(v, float) else v
+
+
+def _flag(v):
+    return bool(v) if isinstance(v, int) else v
+
+
+class Record:
+    """Base of the slotted record types: a small mapping over fixed fields.
+
+    Records answer the dict calls the rest of the code makes (`rec['x']`,
+    `get`, `in`, item assignment, `update`, `keys`, `dict(rec)`), so they
+    stand in for the dicts they replace at a fraction of the size. An unset
+    slot is a missing key. Values are checked and low-cardinality strings
+    interned once, as they are set; keys outside FIELDS go to `_extra`, which stays
+    None for the usual record. Equality is identity, as the indexes expect.
+    """
+    __slots__ = ("_extra",)
+    FIELDS = ()
+    CONVERT = {}  # field -> converter applied on assignment
+
+    def __init_subclass__(cls):
+        cls._fields = frozenset(cls.FIELDS)
+
+    def __init__(self, data=()):
+        self._extra = None
+        if data: self.update(data)
+
+    def __getitem__(self, key):
+        if key in self._fields:
+            try: return getattr(self, key)
+            except AttributeError: raise KeyError(key) from None
+        if self._extra is None: raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        self._assign(((key, value),))
+
+    def _assign(self, pairs):
+        fields, convert, key = self._fields, self.CONVERT, None
+        try:
+            for key, value in pairs:
+                if key in fields:
+                    c = convert.get(key)
+                    setattr(self, key, value if c is None else c(value))
+                else:
+                    if self._extra is None: self._extra = {}
+                    self._extra[key] = value
+        except (TypeError, ValueError) as e:
+            raise ValueError(f"{type(self).__name__} {key}: {e}") from None
+
+    def __contains__(self, key):
+        if key in self._fields: return hasattr(self, key)
+        return self._extra is not None and key in self._extra
+
+    def get(self, key, default=None):
+        try: return self[key]
+        except KeyError: return default
+
+    def keys(self):
+        out = [f for f in self.FIELDS if hasattr(self, f)]
+        if self._extra: out.extend(self._extra)
+        return out
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def update(self, other):
+        self._assign(other.items() if isinstance(other, dict) else ((k, other[k]) for k in other.keys()))
+
+    def to_dict(self):
+        """Plain dict (nested rows included), for JSON and anything else that needs one."""
+        out = {}
+        for k in self.keys():
+            v = self[k]
+            out[k] = [r.to_dict() if isinstance(r, Record) else r for r in v] if isinstance(v, list) else v
+        return out
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.to_dict()!r})"
+
+
+class ItemRow(Record):
+    FIELDS = ("category", "desc", "unit", "qty", "rate")
+    __slots__ = FIELDS
+    CONVERT = {"category": _text, "unit": _text, "qty": _rate, "rate": _rate}
+
+
+class ScheduleRow(Record):
+    FIELDS = ("Stage", "Amount", "Date")
+    __slots__ = FIELDS
+    CONVERT = {"Date": _text}
+
+
+def _rows(row_type):
+    def convert(v):
+        if v is None: return v
+        return [r if isinstance(r, row_type) else row_type(r) for r in v]
+    return convert
+
+
+class Document(Record):
+    """An invoice or quotation."""
+    FIELDS = ("id", "invoice_no", "quotation_no", "date", "type", "client_name", "client_phone", "client_address",
+              "amount", "tax", "gst_rate", "hide_gst", "status", "terms", "items", "schedule", "rev")
+    __slots__ = FIELDS
+    CONVERT = {"date": _text, "type": _text, "amount": _number, "tax": _number, "gst_rate": _text,
+               "hide_gst": _flag, "status": _text, "terms": _terms, "items": _rows(ItemRow),
+               "schedule": _rows(ScheduleRow)}
+
+
+class Payment(Record):
+    FIELDS = ("id", "invoice_id", "client_name", "invoice_date", "amount", "date", "mode", "rev")
+    __slots__ = FIELDS
+    CONVERT = {"invoice_date": _text, "amount": _number, "date": _text, "mode": _text}
+
+
+RECORD_TYPES = {"invoices": Document, "quotations": Document, "payments": Payment}
+
+
+def as_record(table, data):
+    return data if isinstance(data, Record) else RECORD_TYPES[table](data)
+
+
+def to_records(db):
+    """Convert a loaded dict-of-lists to records in place; also fills in missing tables."""
+    for t in TABLES: db[t] = [as_record(t, r) for r in db.get(t, ())]
+    return db
+
+
+def plain(obj):
+    """json `default` hook that writes records as plain objects."""
+    if isinstance(obj, Record): return obj.to_dict()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+def _legacy_id(n, rec):
+    """Id for a record saved without one; derived from its content, so every load gives the same id."""
+    return f"LEGACY_{n}_{zlib.crc32(json.dumps(rec, sort_keys=True, default=plain).encode()):08x}"
+
+
+def upgrade_legacy(db):
+    """Fill in fields older files may lack. Returns True if anything changed.
+
+    Nothing is written here; the engine saves the result with its next write.
+    """
+    changed = False
+    for t in TABLES:
+        if t not in db:
+            db[t] = []
+            changed = True
+    for n, rec in enumerate(db['invoices']):
+        if 'id' not in rec:
+            rec['id'] = _legacy_id(n, rec)
+            changed = True
+        if 'status' not in rec:
+            rec['status'] = "Pending"
+            changed = True
+        if 'invoice_no' not in rec:
+            rec['invoice_no'] = rec['id']
+            changed = True
+    for n, rec in enumerate(db['quotations']):
+        if 'id' not in rec:
+            rec['id'] = _legacy_id(n, rec)
+            changed = True
+    return changed
+
+
+def max_seq(numbers):
+    """Highest trailing sequence in numbers like INV-2026-007."""
+    best = 0
+    for no in numbers:
+        try: best = max(best, int(no.split('-')[-1]))
+        except: pass
+    return best
+
+
+# --- INDEXES ---
+class DateIndex:
+    """Records kept sorted by their ISO `date` string, for bisect range queries."""
+
+    def __init__(self):
+        self.keys = []   # (date, insertion counter), sorted
+        self.recs = []   # parallel to keys
+        self._key_of = {}
+        self._counter = 0
+
+    def add(self, rec):
+        key = (rec.get('date') or "", self._counter); self._counter += 1
+        i = bisect.bisect_right(self.keys, key)
+        self.keys.insert(i, key); self.recs.insert(i, rec)
+        self._key_of[id(rec)] = key
+
+    def extend(self, recs):
+        """Add many records with one sort rather than a list insert each."""
+        pairs = list(zip(self.keys, self.recs))
+        for rec in recs:
+            key = (rec.get('date') or "", self._counter); self._counter += 1
+            self._key_of[id(rec)] = key
+            pairs.append((key, rec))
+        pairs.sort(key=lambda p: p[0])
+        self.keys = [k for k, _ in pairs]
+        self.recs = [r for _, r in pairs]
+
+    def remove(self, rec):
+        i = bisect.bisect_left(self.keys, self._key_of.pop(id(rec)))
+        del self.keys[i]; del self.recs[i]
+
+    def range(self, d_from, d_to):
+        lo = bisect.bisect_left(self.keys, (d_from,))
+        hi = bisect.bisect_left(self.keys, (d_to + "\uffff",))
+        return self.recs[lo:hi]
+
+
+class SearchIndex:
+    """Token index over client details, document numbers and item text.
+
+    Query words match indexed words by prefix, or failing that by trigram
+    similarity, so typos and partial phone numbers still find documents.
+    Documents are keyed (table, id) and can be added and removed one at a
+    time as the store changes; internally each key gets a small integer so
+    the posting sets hash cheaply.
+    """
+    FIELDS = ("client_name", "client_phone", "client_address", "invoice_no", "quotation_no")
+    _word = re.compile(r"[a-z0-9]+")
+
+    def __init__(self, min_similarity=0.4):
+        self.min_similarity = min_similarity
+        self.words = []       # distinct indexed words, sorted, for prefix bisects
+        self.postings = {}    # word -> {doc number}
+        self.grams = {}       # trigram -> {word}
+        self._doc_words = {}  # doc number -> words it was indexed under
+        self._keys = []       # doc number -> (table, id)
+        self._numbers = {}    # (table, id) -> doc number
+
+    @staticmethod
+    def trigrams(word):
+        w = f"  {word} "
+        return {w[i:i + 3] for i in range(len(w) - 2)}
+
+    def tokens(self, text):
+        return self._word.findall(str(text).lower())
+
+    def _number(self, table, rec):
+        key = (table, rec.get('id'))
+        n = self._numbers.get(key)
+        if n is None:
+            n = self._numbers[key] = len(self._keys)
+            self._keys.append(key)
+        return n
+
+    def _words_of(self, rec):
+        parts = [rec.get(f) or "" for f in self.FIELDS] + [i.get('desc', "") for i in rec.get('items') or ()]
+        return set(self.tokens(" ".join(map(str, parts))))
+
+    def build(self, docs):
+        """Index many (table, rec) pairs at once; far cheaper than add() per record."""
+        postings, grams = defaultdict(set), defaultdict(set)
+        for table, rec in docs:
+            n = self._number(table, rec)
+            words = self._doc_words[n] = self._words_of(rec)
+            for w in words: postings[w].add(n)
+        self.postings = dict(postings)
+        self.words = sorted(postings)
+        for w in self.words:
+            for g in self.trigrams(w): grams[g].add(w)
+        self.grams = dict(grams)
+
+    def add(self, table, rec):
+        n = self._number(table, rec)
+        words = self._doc_words[n] = self._words_of(rec)
+        for w in words:
+            docs = self.postings.get(w)
+            if docs is None:
+                docs = self.postings[w] = set()
+                bisect.insort(self.words, w)
+                for g in self.trigrams(w): self.grams.setdefault(g, set()).add(w)
+            docs.add(n)
+
+    def remove(self, table, rec):
+        n = self._numbers.get((table, rec.get('id')))
+        for w in self._doc_words.pop(n, ()):
+            docs = self.postings[w]
+            docs.discard(n)
+            if not docs:
+                del self.postings[w]
+                del self.words[bisect.bisect_left(self.words, w)]
+                for g in self.trigrams(w):
+                    self.grams[g].discard(w)
+                    if not self.grams[g]: del self.grams[g]
+
+    def _matches(self, q):
+        """{indexed word: score} for one query word; 1.0 for prefix matches."""
+        lo = bisect.bisect_left(self.words, q)
+        hi = bisect.bisect_left(self.words, q + "\uffff")
+        if lo < hi or len(q) < 3: return dict.fromkeys(self.words[lo:hi], 1.0)
+        q_grams = self.trigrams(q)
+        shared = {}
+        for g in q_grams:
+            for w in self.grams.get(g, ()): shared[w] = shared.get(w, 0) + 1
+        out = {}
+        for w, n in shared.items():
+            sim = n / (len(q_grams) + len(w) + 1 - n)  # Jaccard over trigram sets
+            if sim >= self.min_similarity: out[w] = sim
+        return out
+
+    def search(self, query, tables=None, limit=None):
+        """Doc keys matching every query word, best first.
+
+        Prefix matches all score alike, so those words are resolved with
+        set unions and intersections; only fuzzy words carry per-doc scores.
+        """
+        hits = []
+        for q in set(self.tokens(query)):
+            matches = self._matches(q)
+            if not matches: return []
+            if len(matches) == 1: docs = self.postings[next(iter(matches))]
+            else: docs = set().union(*(self.postings[w] for w in matches))
+            fuzzy = matches if any(sim < 1.0 for sim in matches.values()) else None
+            hits.append((docs, fuzzy))
+        if not hits: return []
+        hits.sort(key=lambda h: len(h[0]))
+        keys = set(hits[0][0])
+        for docs, _ in hits[1:]:
+            keys &= docs
+            if not keys: return []
+        if tables is not None: keys = {n for n in keys if self._keys[n][0] in tables}
+        scored = [fuzzy for _, fuzzy in hits if fuzzy]
+        if scored:
+            def score(n):
+                return sum(max(sim for w, sim in fuzzy.items() if n in self.postings[w]) for fuzzy in scored)
+            keys = sorted(keys, key=score, reverse=True)
+        return [self._keys[n] for n in keys][:limit]
+
+
+class LineItems:
+    """Invoice line items as parallel column lists, the source for vectorised reports.
+
+    Items of a removed (or about to be updated) invoice are only marked
+    dead; the columns are rebuilt without them once they outnumber the
+    live rows. Repeated strings are interned so a million rows share a
+    handful of category, unit and month objects.
+
+    Items saved without a category get `categorize(desc)` instead, when given.
+    """
+    COLUMNS = ("invoice_id", "date", "month", "category", "unit", "qty", "rate", "gst_rate", "hide_gst")
+
+    def __init__(self, categorize=None):
+        self.categorize = categorize
+        self.cols = {c: [] for c in self.COLUMNS}
+        self.alive = []
+        self.dead = 0
+        self._rows = {}  # invoice id -> (start, stop) row range
+
+    def __len__(self):
+        return len(self.alive) - self.dead
+
+    def add(self, rec):
+        c, intern, categorize = self.cols, sys.intern, self.categorize
+        start = len(self.alive)
+        day = rec.get('date') or ""
+        month, gst, hide = intern(day[:7]), intern(str(rec.get('gst_rate') or "")), bool(rec.get('hide_gst'))
+        for it in rec.get('items') or ():
+            c['invoice_id'].append(rec.get('id')); c['date'].append(day); c['month'].append(month)
+            category = it.get('category') or (categorize(it.get('desc')) if categorize else "")
+            c['category'].append(intern(str(category or ""))); c['unit'].append(intern(str(it.get('unit') or "")))
+            c['qty'].append(it.get('qty') or 0); c['rate'].append(it.get('rate') or 0)
+            c['gst_rate'].append(gst); c['hide_gst'].append(hide)
+            self.alive.append(True)
+        self._rows[rec.get('id')] = (start, len(self.alive))
+
+    def remove(self, rec):
+        start, stop = self._rows.pop(rec.get('id'), (0, 0))
+        for i in range(start, stop): self.alive[i] = False
+        self.dead += stop - start
+        if self.dead > len(self) and self.dead > 1000: self._compact()
+
+    def _compact(self):
+        keep = [i for i, a in enumerate(self.alive) if a]
+        self.cols = {name: [col[i] for i in keep] for name, col in self.cols.items()}
+        self.alive = [True] * len(keep)
+        self.dead = 0
+        self._rows = {}
+        for n, inv in enumerate(self.cols['invoice_id']):
+            start, _ = self._rows.get(inv, (n, n))
+            self._rows[inv] = (start, n + 1)
+
+
+# --- FISCAL YEARS ---
+# Indian fiscal years run April-March and are named by their starting year.
+# The live partition holds the current year plus every bill still open
+# (and its payments); closed years are archived read-only with a summary.
+_DATED = re.compile(r"\d{4}-\d{2}")
+CLOSED_STATUSES = ("Completed", "Completed (Manual)")  # bill statuses that let a bill be archived
+
+
+def fiscal_year(day):
+    """Starting year of the fiscal year containing `day` (a date or ISO string)."""
+    s = str(day)
+    year, month = int(s[:4]), int(s[5:7])
+    return year if month >= 4 else year - 1
+
+
+def fiscal_label(fy):
+    return f"FY {fy}-{(fy + 1) % 100:02d}"
+
+
+def fiscal_start(fy):
+    return f"{fy}-04-01"
+
+
+def _dated_before(rec, start):
+    d = rec.get('date')
+    return isinstance(d, str) and bool(_DATED.match(d)) and d < start
+
+
+def closed_records(db, start):
+    """{fiscal year: db} of the records in `db` that belong to a year ended before `start`.
+
+    Quotations go by date alone. Bills go once completed (CLOSED_STATUSES), and payments
+    once their bill has gone, so open bills keep their whole history live.
+    """
+    def old(rec): return _dated_before(rec, start)
+    out = {}
+    def put(table, rec): out.setdefault(fiscal_year(rec['date']), empty_db())[table].append(rec)
+    live_bills = set()
+    for rec in db['invoices']:
+        if old(rec) and rec.get('status') in CLOSED_STATUSES: put('invoices', rec)
+        else: live_bills.add(rec.get('id'))
+    for rec in db['quotations']:
+        if old(rec): put('quotations', rec)
+    for rec in db['payments']:
+        if old(rec) and rec.get('invoice_id') not in live_bills: put('payments', rec)
+    return out
+
+
+def summarize_year(db):
+    """The small summary kept for an archived year: what the store needs without loading it.
+
+    Daily [billed, gst, received] feed the rollups; client names feed the
+    Ledger filter; the highest document number per counter keeps numbering
+    right when a counter has to be rebuilt.
+    """
+    daily = {}
+    for rec in db['invoices']:
+        b = daily.setdefault(rec.get('date') or "", [0.0, 0.0, 0.0]); b[0] += rec['amount']; b[1] += rec['tax']
+    for rec in db['payments']:
+        daily.setdefault(rec.get('date') or "", [0.0, 0.0, 0.0])[2] += rec['amount']
+    seq = {}
+    for prefix, (table, field) in SEQ_SOURCES.items():
+        for rec in db[table]:
+            parts = (rec.get(field) or "").split('-')
+            if len(parts) >= 3 and parts[0] == prefix:
+                key = f"{prefix}-{parts[1]}"
+                seq[key] = max(seq.get(key, 0), max_seq([rec[field]]))
+    return {"daily": daily, "seq": seq,
+            "clients": {t: sorted({r.get('client_name') for r in db[t]} - {None}) for t in TABLES}}
+
+
+def _month_end(d):
+    nxt = date(d.year + d.month // 12, d.month % 12 + 1, 1)
+    return nxt - timedelta(days=1)
+
+
+# --- QUERIES ---
+class BaseStore:
+    """In-memory state, derived indexes and read queries shared by the engines.
+
+    `self.db` is the dict-of-lists the UI reads. Mutations go through
+    `_apply()`, which keeps the derived indexes in step, so lookups such
+    as `paid()` never rescan the tables. Queries without an index scan
+    `self.db`; engines with their own indexes override them.
+
+    `self.db` is the live partition only. Closed fiscal years start out as
+    their summaries, which are folded into the rollups, client lists and
+    numbering; `load_since()` opens them (newest first, so an open year's
+    later payments are always loaded too) into the indexes, read-only.
+    """
+
+    def _apply(self, op):
+        """Apply one mutation to `self.db`; returns the record touched."""
+        with self._index_lock:
+            self.version += 1
+            recs = self.db.setdefault(op['t'], [])
+            if op['op'] == "insert":
+                rec = as_record(op['t'], op['rec'])
+                recs.append(rec)
+                self._index(op['t'], rec, 1)
+                return rec
+            for i, rec in enumerate(recs):
+                if rec.get('id') == op['id']:
+                    self._index(op['t'], rec, -1)
+                    if op['op'] == "delete":
+                        del recs[i]
+                        return rec
+                    rec.update(op['fields'])
+                    self._index(op['t'], rec, 1)
+                    return rec
+
+    def reading(self):
+        """Lock to hold while iterating the indexes (client counts, search, line items).
+
+        Commits change those in place under it; reloads publish fresh ones
+        instead (see _publish), so readers never need the write lock.
+        Do not open closed years (load_since) while holding it.
+        """
+        return self._index_lock
+
+    # Indexes
+    def _reindex(self):
+        self.version = getattr(self, 'version', 0) + 1  # never reused, so no cached value outlives a reload
+        self._derived = OrderedDict()
+        self.__dict__.setdefault('_derived_lock', threading.Lock())
+        self.__dict__.setdefault('_index_lock', threading.RLock())
+        self._pay_by_invoice = {}
+        self._paid = {}
+        self._by_date = {t: DateIndex() for t in TABLES}
+        self._by_id = {t: {} for t in TABLES}
+        self._clients = {t: {} for t in TABLES}  # client name -> record count
+        self._search = None  # built on first search()
+        self._lines = None   # built on first line_items()
+        # [billed, gst, received] per 'YYYY-MM-DD', per 'YYYY-MM' and overall
+        self._daily = {}
+        self._monthly = {}
+        self._totals = [0.0, 0.0, 0.0]
+        for fy, summary in self._summaries.items():
+            if fy not in self._archives: self._attach(summary, 1)  # opened years are indexed as records
+        for t in TABLES:
+            recs = self.records(t)
+            self._by_date[t].extend(recs)
+            for rec in recs: self._index(t, rec, 1, by_date=False)
+
+    def _open_partitions(self, year, summaries):
+        """Start over from the live partition of fiscal `year`, with closed years known by `summaries`."""
+        self.active_year = year
+        self._summaries = summaries
+        self._archives = {}  # fiscal year -> db, for closed years opened so far
+        self._frozen = {t: set() for t in TABLES}  # ids of opened archive records
+
+    def _attach(self, summary, sign):
+        """Fold a closed year's summary into the rollups (sign=1), or take it back out."""
+        for day, deltas in summary['daily'].items(): self._roll(day, [sign * v for v in deltas])
+
+    def _index(self, table, rec, sign, by_date=True):
+        """Add (sign=1) or remove (sign=-1) one record from the derived indexes."""
+        if sign > 0:
+            if by_date: self._by_date[table].add(rec)
+            self._by_id[table][rec.get('id')] = rec
+        else: self._by_date[table].remove(rec); self._by_id[table].pop(rec.get('id'), None)
+        name = rec.get('client_name')
+        counts = self._clients[table]
+        counts[name] = counts.get(name, 0) + sign
+        if not counts[name]: del counts[name]
+        if self._lines is not None and table == 'invoices':
+            if sign > 0: self._lines.add(rec)
+            else: self._lines.remove(rec)
+        if self._search is not None and table != 'payments':
+            if sign > 0: self._search.add(table, rec)
+            else: self._search.remove(table, rec)
+        if table == 'payments':
+            iid = rec.get('invoice_id')
+            if sign > 0: self._pay_by_invoice.setdefault(iid, []).append(rec)
+            else: self._pay_by_invoice[iid].remove(rec)
+            self._paid[iid] = self._paid.get(iid, 0) + sign * rec['amount']
+            self._roll(rec.get('date') or "", (0, 0, sign * rec['amount']))
+        elif table == 'invoices':
+            self._roll(rec.get('date') or "", (sign * rec['amount'], sign * rec['tax'], 0))
+
+    def _roll(self, day, deltas):
+        for bucket in (self._daily.setdefault(day, [0.0, 0.0, 0.0]),
+                       self._monthly.setdefault(day[:7], [0.0, 0.0, 0.0]), self._totals):
+            for i, v in enumerate(deltas): bucket[i] += v
+
+    def cached(self, key, build, keep=32):
+        """Value derived from the data, rebuilt only after a commit bumps `version`.
+
+        Sessions call this concurrently; the lock covers the LRU bookkeeping,
+        not `build()`. A value built while a commit lands is stored under
+        the older version, so it is simply rebuilt on the next call.
+        """
+        derived, version = self._derived, self.version
+        with self._derived_lock:
+            hit = derived.get(key)
+            if hit is not None and hit[0] == version:
+                derived.move_to_end(key)
+                return hit[1]
+        value = build()
+        with self._derived_lock:
+            derived[key] = (version, value)
+            derived.move_to_end(key)
+            while len(derived) > keep: derived.popitem(last=False)
+        return value
+
+    def _publish(self, build):
+        """Run `build(store)` on a copy of this store, then swap the copy's state in at once.
+
+        Sessions read the store without locks. A reload assigns fresh
+        tables and indexes on the copy, so readers meanwhile keep the old
+        state, then see the new one whole, never half-built indexes.
+        Callers hold the engine's write lock. The shared terms and rate
+        copies start over here, so a reload drops those of deleted records.
+        """
+        _forget_shared()
+        shadow = object.__new__(type(self))
+        shadow.__dict__.update(self.__dict__)
+        result = build(shadow)
+        self.__dict__ = shadow.__dict__
+        return result
+
+    def _prepare(self, ops):
+        """Check expected revisions (an op's `rev`) and bump the revision of updated records.
+
+        Runs under the engine's write lock after catching up with other
+        writers, so a stale expectation is always detected.
+        """
+        for op in ops:
+            if op['op'] == "insert": continue
+            if op['id'] in self._frozen[op['t']]:
+                raise ArchivedError(f"{op['t'][:-1].capitalize()} {op['id']} belongs to a closed fiscal year and is read-only")
+            cur = self.get(op['t'], op['id'])
+            if 'rev' in op and (cur is None or cur.get('rev', 0) != op['rev']):
+                raise ConflictError(f"{op['t'][:-1].capitalize()} {op['id']} was changed or removed by another session")
+            if op['op'] == "update" and cur is not None:
+                op['fields'] = dict(op['fields'], rev=cur.get('rev', 0) + 1)
+
+    def get(self, table, rec_id):
+        """One record by id, or None."""
+        return self._by_id[table].get(rec_id)
+
+    def paid(self, invoice_id):
+        """Running total received against one invoice."""
+        return self._paid.get(invoice_id, 0)
+
+    def doc_numbers(self, table, field, prefix):
+        return [r[field] for r in self.db[table] if (r.get(field) or "").startswith(prefix)]
+
+    def _rebuild_seq(self, prefix, year):
+        """Highest number in the data for a counter that was never persisted.
+
+        Memoised, since new documents only ever take allocated numbers.
+        """
+        memo = self.__dict__.setdefault('_rebuilt', {})
+        if (prefix, year) not in memo:
+            table, field = SEQ_SOURCES[prefix]
+            archived = (s['seq'].get(f"{prefix}-{year}", 0) for s in self._summaries.values())
+            memo[(prefix, year)] = max([max_seq(self.doc_numbers(table, field, f"{prefix}-{year}-")), *archived])
+        return memo[(prefix, year)]
+
+    def payments_for(self, invoice_id):
+        return list(self._pay_by_invoice.get(invoice_id, ()))
+
+    def in_range(self, table, d_from, d_to, client=None):
+        """Records dated within [d_from, d_to] (ISO strings) in date order, optionally for one client.
+
+        Opens any closed fiscal year the range reaches into.
+        """
+        self.load_since(d_from)
+        with self._index_lock: recs = self._by_date[table].range(d_from, d_to)
+        if client is None: return recs
+        return [r for r in recs if r.get('client_name') == client]
+
+    def period_totals(self, d_from, d_to):
+        """(billed, gst, received) between two dates, summed from the rollups.
+
+        Whole months inside the range use the monthly rollup and the edges
+        use daily ones, so the cost follows the number of periods, not records.
+        """
+        out = [0.0, 0.0, 0.0]
+        cur = d_from
+        while cur <= d_to:
+            if cur.day == 1 and _month_end(cur) <= d_to:
+                bucket = self._monthly.get(cur.strftime('%Y-%m'))
+                cur = _month_end(cur) + timedelta(days=1)
+            else:
+                bucket = self._daily.get(str(cur))
+                cur += timedelta(days=1)
+            if bucket:
+                for i, v in enumerate(bucket): out[i] += v
+        return tuple(out)
+
+    def all_time_totals(self):
+        """(billed, gst, received) over every record."""
+        return tuple(self._totals)
+
+    def client_names(self, table):
+        def build():
+            with self._index_lock: names = {n for n in self._clients[table] if n is not None}
+            for fy, summary in self._summaries.items():
+                if fy not in self._archives: names.update(summary['clients'][table])
+            return sorted(names)
+        return self.cached(('clients', table), build)
+
+    def line_items(self, categorize=None):
+        """Columnar line items of every loaded invoice (see LineItems), kept current from then on.
+
+        `categorize` is used when the columns are first built (e.g. after a reload).
+        Commits keep appending to the columns: copy them under reading().
+        """
+        with self._index_lock:
+            if self._lines is None:
+                lines = LineItems(categorize)
+                for rec in self.records('invoices'): lines.add(rec)
+                self._lines = lines
+            return self._lines
+
+    def search(self, query, tables=("invoices", "quotations"), limit=None):
+        """Loaded documents matching a free-text query on client details, numbers and item text, best first."""
+        with self._index_lock:
+            if self._search is None:
+                index = SearchIndex()
+                index.build((t, rec) for t in ("invoices", "quotations") for rec in self.records(t))
+                self._search = index
+            return [self._by_id[t][i] for t, i in self._search.search(query, tables, limit)]
+
+    # Fiscal years
+    def records(self, table):
+        """Live records plus those of every opened closed year, oldest year first."""
+        if not self._archives: return self.db[table]
+        return [r for fy in sorted(self._archives) for r in self._archives[fy][table]] + self.db[table]
+
+    def is_archived(self, table, rec_id):
+        return rec_id in self._frozen[table]
+
+    def load_since(self, day=None):
+        """Open every closed fiscal year from the one containing `day` (default: all) onwards.
+
+        Called from read paths by any session, so opening happens under the
+        process lock and re-checks which years are still closed: a year
+        opened twice would take its summary out of the rollups twice.
+        """
+        first = fiscal_year(day) if day and _DATED.match(str(day)) else None
+        def wanted():
+            return [fy for fy in self._summaries if (first is None or fy >= first) and fy not in self._archives]
+        if not wanted(): return
+        with _process_lock:
+            years = wanted()
+            if years: self._publish(lambda store: store._open_years(years))
+
+    def _open_years(self, years):
+        """Read closed `years` into the archives and reindex; runs on the copy _publish() swaps in."""
+        archives = dict(self._archives)
+        frozen = {t: set(ids) for t, ids in self._frozen.items()}
+        for fy in sorted(years, reverse=True):  # newest first: a record is kept from the newest place it appears
+            db = self._read_year(fy)
+            for t in TABLES:  # e.g. a bill settled since the live partition was read is still live here
+                db[t] = [r for r in db[t] if r.get('id') not in self._by_id[t] and r.get('id') not in frozen[t]]
+                frozen[t].update(r.get('id') for r in db[t])
+            archives[fy] = db
+        self._archives, self._frozen = archives, frozen
+        self._reindex()
+
+    def year_stats(self):
+        closed = len(self._summaries)
+        return f"Fiscal years: {fiscal_label(self.active_year)} live, {len(self._archives)}/{closed} closed years open"
+
+
+
+# --- JOURNAL STORE ---
+class JournalStore(BaseStore):
+    """Snapshot file plus an append-only journal of mutations.
+
+    Every change is appended to the journal as one small JSON line, so the
+    cost of a save follows the size of the change. On load the snapshot is
+    read and the journal replayed on top. Once the journal holds
+    `compact_every` records it is folded into a fresh snapshot.
+
+    The snapshot and journal are the live partition. Records of a closed
+    fiscal year found there move to that year's own file
+    (`<name>.fy2024.json`, written only then) and its summary to
+    `<name>.years.json` on the next commit or `maintain()`; loads only read.
+    """
+
+    def __init__(self, snapshot_path, journal_path=None, compact_every=500):
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path or os.path.splitext(snapshot_path)[0] + ".journal"
+        self.seq_path = os.path.splitext(snapshot_path)[0] + ".seq.json"
+        self.lock_path = os.path.splitext(snapshot_path)[0] + ".lock"
+        self.years_path = os.path.splitext(snapshot_path)[0] + ".years.json"
+        self.compact_every = compact_every
+        self.journal_len = 0
+        self._op_seq = 0     # number of the last journal entry applied
+        self._covered = -1   # entries numbered up to this are already in the snapshot
+        self.db = empty_db()
+        self._open_partitions(fiscal_year(date.today()), {})
+        self._seq = {}
+        self._seq_mtime = None
+        self._seen = None  # (snapshot stat, journal offset) this copy reflects
+        self._maintenance_due = False  # records to archive or upgrade were loaded; see _maintain()
+
+    def load(self):
+        with file_lock(self.lock_path): return self._load()
+
+    def refresh(self):
+        """Pick up changes other processes have written. Cheap when there are none."""
+        if self._disk_state() != self._seen:
+            with file_lock(self.lock_path): self._catch_up()
+
+    def _disk_state(self):
+        try: snap = os.stat(self.snapshot_path); snap = (snap.st_ino, snap.st_mtime_ns)
+        except OSError: snap = None
+        try: size = os.path.getsize(self.journal_path)
+        except OSError: size = 0
+        return snap, size
+
+    def _catch_up(self):
+        """Replay journal lines appended since our last read; reload after another process compacted."""
+        snap, size = self._disk_state()
+        if self._seen is None or snap != self._seen[0] or size < self._seen[1]:
+            self._load()
+        elif size > self._seen[1]:
+            self._seen = (snap, self._replay(self._seen[1]))
+
+    def _replay(self, offset):
+        """Apply complete journal lines from `offset`; returns the offset after the last one.
+
+        Runs under the file lock, so no writer is mid-append: a last line
+        without its newline was torn by a crash. It is not applied, and the
+        next commit cuts it off before appending. A complete line that does not
+        parse is corruption, not something to skip. Entries the snapshot
+        already holds (see _compact) are skipped.
+        """
+        with open(self.journal_path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"): break
+                try: op = json.loads(line)
+                except ValueError:
+                    raise JournalError(f"{self.journal_path}: unreadable record at byte {offset}") from None
+                offset += len(line)
+                n = op.get('n', 0)  # entries written before numbering count as 0
+                if n > self._covered: self._apply(op)
+                self._op_seq = max(self._op_seq, n)
+                self.journal_len += 1
+        return offset
+
+    def _load(self):
+        return self._publish(JournalStore._read_all)
+
+    def _read_all(self):
+        """Read the snapshot and journal from scratch; see _publish()."""
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, 'r') as f: db = json.load(f)
+            except ValueError as e:  # never carry on with an empty db: the next compaction would save it
+                raise JournalError(f"{self.snapshot_path}: unreadable snapshot ({e})") from None
+        else:
+            db = empty_db()
+        self._covered = db.pop('journal_seq', -1)
+        self._op_seq = max(self._covered, 0)
+        upgraded = upgrade_legacy(db)  # before indexing, so LEGACY_ ids are found like any other
+        self.db = to_records(db)
+        self._open_partitions(fiscal_year(date.today()), self._read_summaries())
+        self._reindex()
+
+        self.journal_len = 0
+        snap, _ = self._disk_state()
+        offset = self._replay(0) if os.path.exists(self.journal_path) else 0
+        self._seen = (snap, offset)
+
+        # Loads never write: closed-year records and upgraded legacy records
+        # stay as they are in memory and are saved by the next commit (or maintain())
+        self._maintenance_due = upgraded or bool(closed_records(self.db, fiscal_start(self.active_year)))
+        return self.db
+
+    # Mutations
+    def insert(self, table, rec):
+        self._commit({"op": "insert", "t": table, "rec": rec})
+
+    def delete(self, table, rec_id, rev=None):
+        self._commit(_with_rev({"op": "delete", "t": table, "id": rec_id}, rev))
+
+    def update(self, table, rec_id, fields, rev=None):
+        self._commit(_with_rev({"op": "update", "t": table, "id": rec_id, "fields": fields}, rev))
+
+    def commit(self, ops):
+        """Apply several mutations and journal them with a single write."""
+        if ops: self._commit(*ops)
+
+    def compact(self):
+        with file_lock(self.lock_path):
+            self._catch_up()
+            self._compact()
+
+    def maintain(self):
+        """Archive closed-year records and fold the journal into the snapshot."""
+        with file_lock(self.lock_path):
+            self._catch_up()
+            self._maintain(compact=True)
+
+    def _maintain(self, compact):
+        """Archive closed-year records (which compacts), else compact if asked; under the file lock."""
+        closed = closed_records(self.db, fiscal_start(self.active_year))
+        if closed: self._publish(lambda store: store._archive(closed))
+        elif compact: self._compact()
+        self._maintenance_due = False
+
+    def _compact(self):
+        """Write the whole database as a new snapshot and empty the journal.
+
+        The snapshot records the number of the last entry it holds, so if
+        the journal is not emptied (a crash in between) those entries are
+        not applied twice.
+        """
+        _write_json(self.snapshot_path, dict(self.db, journal_seq=self._op_seq))
+        self._covered = self._op_seq
+        open(self.journal_path, 'w').close()
+        self.journal_len = 0
+        self._seen = self._disk_state()
+
+    # Fiscal years
+    def _year_path(self, fy):
+        return f"{os.path.splitext(self.snapshot_path)[0]}.fy{fy}.json"
+
+    def _read_summaries(self):
+        try:
+            with open(self.years_path, 'r') as f: return {int(fy): s for fy, s in json.load(f).items()}
+        except (OSError, ValueError): return {}
+
+    def _read_year(self, fy):
+        with open(self._year_path(fy), 'r') as f: return to_records(json.load(f))
+
+    def _archive(self, closed):
+        """Move closed-year records from the live partition into their year files.
+
+        Year files and summaries are written before the snapshot drops the
+        records, and merging replaces records by id, so a crash in between
+        only repeats the move next time.
+        """
+        summaries = self._read_summaries()
+        for fy, part in closed.items():
+            db = self._read_year(fy) if os.path.exists(self._year_path(fy)) else empty_db()
+            for t in TABLES:
+                moving = {r.get('id') for r in part[t]}
+                db[t] = [r for r in db[t] if r.get('id') not in moving] + part[t]
+            _write_json(self._year_path(fy), db)
+            summaries[fy] = summarize_year(db)
+        _write_json(self.years_path, {str(fy): s for fy, s in sorted(summaries.items())})
+        moved = {id(r) for part in closed.values() for t in TABLES for r in part[t]}
+        for t in TABLES: self.db[t] = [r for r in self.db[t] if id(r) not in moved]
+        self._compact()
+        self._open_partitions(self.active_year, summaries)
+        self._reindex()
+
+    # Document numbers
+    def peek_number(self, prefix, year):
+        """Next number that would be allocated; a preview, not a reservation."""
+        key = f"{prefix}-{year}"
+        self._read_seq()
+        if key not in self._seq:
+            return self._rebuild_seq(prefix, year) + 1
+        return self._seq[key] + 1
+
+    def allocate_number(self, prefix, year):
+        """Atomically take the next number for (prefix, year)."""
+        key = f"{prefix}-{year}"
+        with file_lock(self.lock_path):
+            self._seq_mtime = None
+            self._read_seq()
+            seq = self._seq[key] if key in self._seq else self._rebuild_seq(prefix, year)
+            self._seq[key] = seq + 1
+            tmp = self.seq_path + ".tmp"
+            with open(tmp, 'w') as f: json.dump(self._seq, f)
+            os.replace(tmp, self.seq_path)
+            self._seq_mtime = os.stat(self.seq_path).st_mtime_ns
+        return seq + 1
+
+    def _read_seq(self):
+        """Refresh the counters if another session has written them."""
+        try: mtime = os.stat(self.seq_path).st_mtime_ns
+        except OSError: return
+        if mtime != self._seq_mtime:
+            with open(self.seq_path, 'r') as f: self._seq = json.load(f)
+            self._seq_mtime = mtime
+
+    # Internals
+    def _commit(self, *ops):
+        with file_lock(self.lock_path):
+            self._catch_up()
+            self._prepare(ops)
+            start, closing = fiscal_start(self.active_year), False
+            for op in ops:
+                self._op_seq += 1
+                op['n'] = self._op_seq
+                rec = self._apply(op)
+                closing = closing or (rec is not None and op['op'] != "delete" and _dated_before(rec, start))
+            if self._disk_state()[1] > self._seen[1]:  # a torn last line, see _replay()
+                os.truncate(self.journal_path, self._seen[1])
+            with open(self.journal_path, 'ab') as f:
+                f.write("".join(json.dumps(op, default=plain) + "\n" for op in ops).encode())
+                f.flush(); os.fsync(f.fileno())
+                self._seen = (self._seen[0], f.tell())
+            self.journal_len += len(ops)
+            if self._maintenance_due or closing:  # e.g. an old bill was just completed
+                self._maintain(compact=self._maintenance_due or self.journal_len >= self.compact_every)
+            elif self.journal_len >= self.compact_every: self._compact()
+
+def _write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, 'w') as f: json.dump(data, f, default=plain)
+    os.replace(tmp, path)
+
+def _with_rev(op, rev):
+    if rev is not None: op['rev'] = rev
+    return op
+
+
+# --- SQLITE STORE ---
+DOC_TABLES = ("invoices", "quotations")
+DOC_COLUMNS = ("id", "invoice_no", "quotation_no", "date", "type", "client_name", "client_phone",
+               "client_address", "amount", "tax", "gst_rate", "hide_gst", "status", "terms")
+ITEM_COLUMNS = ("category", "desc", "unit", "qty", "rate")
+SCHEDULE_COLUMNS = ("Stage", "Amount", "Date")
+PAYMENT_COLUMNS = ("id", "invoice_id", "client_name", "invoice_date", "amount", "date", "mode")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS invoices (
+    rid INTEGER PRIMARY KEY, id TEXT, invoice_no TEXT, quotation_no TEXT, date TEXT, type TEXT,
+    client_name TEXT, client_phone TEXT, client_address TEXT, amount REAL, tax REAL,
+    gst_rate TEXT, hide_gst INTEGER, status TEXT, terms TEXT, extra TEXT);
+CREATE TABLE IF NOT EXISTS quotations (
+    rid INTEGER PRIMARY KEY, id TEXT, invoice_no TEXT, quotation_no TEXT, date TEXT, type TEXT,
+    client_name TEXT, client_phone TEXT, client_address TEXT, amount REAL, tax REAL,
+    gst_rate TEXT, hide_gst INTEGER, status TEXT, terms TEXT, extra TEXT);
+CREATE TABLE IF NOT EXISTS items (
+    doc_table TEXT, doc_id TEXT, pos INTEGER, category TEXT, "desc" TEXT, unit TEXT, qty REAL, rate REAL);
+CREATE TABLE IF NOT EXISTS schedules (
+    doc_table TEXT, doc_id TEXT, pos INTEGER, stage, amount, date);
+CREATE TABLE IF NOT EXISTS sequences (key TEXT PRIMARY KEY, value INTEGER);
+CREATE TABLE IF NOT EXISTS payments (
+    rid INTEGER PRIMARY KEY, id TEXT, invoice_id TEXT, client_name TEXT, invoice_date TEXT,
+    amount REAL, date TEXT, mode TEXT, extra TEXT);
+CREATE INDEX IF NOT EXISTS ix_invoices_id ON invoices(id);
+CREATE INDEX IF NOT EXISTS ix_invoices_no ON invoices(invoice_no);
+CREATE INDEX IF NOT EXISTS ix_invoices_date ON invoices(date);
+CREATE INDEX IF NOT EXISTS ix_invoices_client ON invoices(client_name);
+CREATE INDEX IF NOT EXISTS ix_quotations_id ON quotations(id);
+CREATE INDEX IF NOT EXISTS ix_quotations_no ON quotations(quotation_no);
+CREATE INDEX IF NOT EXISTS ix_quotations_date ON quotations(date);
+CREATE INDEX IF NOT EXISTS ix_quotations_client ON quotations(client_name);
+CREATE INDEX IF NOT EXISTS ix_items_doc ON items(doc_table, doc_id);
+CREATE INDEX IF NOT EXISTS ix_schedules_doc ON schedules(doc_table, doc_id);
+CREATE INDEX IF NOT EXISTS ix_payments_id ON payments(id);
+CREATE INDEX IF NOT EXISTS ix_payments_invoice ON payments(invoice_id);
+CREATE INDEX IF NOT EXISTS ix_payments_date ON payments(date);
+CREATE INDEX IF NOT EXISTS ix_payments_client ON payments(client_name);
+"""
+
+# Rows of a fiscal year closed before :start; the same rules as closed_records()
+_OLD = "IFNULL(date, '') GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]*' AND date < :start"
+_CLOSED_BILL = f"{_OLD} AND IFNULL(status, '') IN ({', '.join(repr(s) for s in CLOSED_STATUSES)})"
+CLOSED_WHERE = {
+    "invoices": _CLOSED_BILL,
+    "quotations": _OLD,
+    "payments": f"{_OLD} AND IFNULL(invoice_id, '') NOT IN (SELECT id FROM invoices WHERE id IS NOT NULL AND NOT ({_CLOSED_BILL}))",
+}
+LIVE_WHERE = {t: f"NOT ({w})" for t, w in CLOSED_WHERE.items()}
+
+
+class SqliteStore(BaseStore):
+    """Normalised SQLite database with indexes on the fields the tabs filter by.
+
+    `load()` still materialises the familiar dict-of-lists for the UI.
+    Document numbers, date ranges (the Ledger and exports) and client lists
+    are answered by SQL on the indexed columns, and map back to the loaded
+    records. Lookups by id, payments, search, paging and totals use the
+    shared in-memory indexes, which `load()` builds from the same rows.
+
+    All years stay in the one database; `load()` reads only the live
+    partition's rows, and closed years are summarised with GROUP BY
+    queries and read on demand.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self.db = empty_db()
+        self._data_version = None
+        self._open_partitions(fiscal_year(date.today()), {})
+
+    def load(self):
+        with _process_lock: return self._publish(SqliteStore._read_all)
+
+    def _read_all(self):
+        """Read the live partition and the closed-year summaries; see _publish()."""
+        self._data_version = self._disk_version()
+        year = fiscal_year(date.today())
+        start = fiscal_start(year)
+        self.db = self._select(LIVE_WHERE, {"start": start})
+        self._open_partitions(year, self._closed_summaries(start))
+        self._reindex()
+        return self.db
+
+    def _select(self, where, params):
+        """Dict-of-lists of the rows matching the per-table `where` clauses."""
+        db = empty_db()
+        children = {}
+        for t in DOC_TABLES:
+            docs = f"doc_table = '{t}' AND doc_id IN (SELECT id FROM {t} WHERE {where[t]})"
+            for row in self.conn.execute(f'SELECT doc_id, category, "desc", unit, qty, rate FROM items WHERE {docs} ORDER BY doc_id, pos', params):
+                children.setdefault((t, row[0]), {"items": [], "schedule": []})["items"].append(dict(zip(ITEM_COLUMNS, row[1:])))
+            for row in self.conn.execute(f'SELECT doc_id, stage, amount, date FROM schedules WHERE {docs} ORDER BY doc_id, pos', params):
+                children.setdefault((t, row[0]), {"items": [], "schedule": []})["schedule"].append(dict(zip(SCHEDULE_COLUMNS, row[1:])))
+            for row in self.conn.execute(f"SELECT * FROM {t} WHERE {where[t]} ORDER BY rid", params):
+                db[t].append(self._doc_from_row(row, children.get((t, row['id']), {"items": [], "schedule": []})))
+        for row in self.conn.execute(f"SELECT * FROM payments WHERE {where['payments']} ORDER BY rid", params):
+            db['payments'].append(self._from_row(row, PAYMENT_COLUMNS))
+        return db
+
+    def _closed_summaries(self, start):
+        """summarize_year() for every closed year, from aggregates rather than rows.
+
+        Numbering needs no per-year maxima here: doc_numbers() queries every row.
+        """
+        out = {}
+        def year(day):
+            return out.setdefault(fiscal_year(day), {"daily": {}, "seq": {}, "clients": {t: set() for t in TABLES}})
+        params = {"start": start}
+        for day, billed, gst in self.conn.execute(f"SELECT date, SUM(amount), SUM(tax) FROM invoices WHERE {CLOSED_WHERE['invoices']} GROUP BY date", params):
+            year(day)["daily"][day] = [billed or 0.0, gst or 0.0, 0.0]
+        for day, received in self.conn.execute(f"SELECT date, SUM(amount) FROM payments WHERE {CLOSED_WHERE['payments']} GROUP BY date", params):
+            year(day)["daily"].setdefault(day, [0.0, 0.0, 0.0])[2] = received or 0.0
+        for t in TABLES:
+            for day, name in self.conn.execute(f"SELECT DISTINCT date, client_name FROM {t} WHERE {CLOSED_WHERE[t]}", params):
+                clients = year(day)["clients"][t]
+                if name is not None: clients.add(name)
+        for s in out.values(): s["clients"] = {t: sorted(names) for t, names in s["clients"].items()}
+        return out
+
+    def _read_year(self, fy):
+        where = {t: f"({w}) AND date >= :lo AND date < :hi" for t, w in CLOSED_WHERE.items()}
+        return self._select(where, {"start": fiscal_start(self.active_year), "lo": fiscal_start(fy), "hi": fiscal_start(fy + 1)})
+
+    # Mutations
+    def insert(self, table, rec):
+        self.commit([{"op": "insert", "t": table, "rec": rec}])
+
+    def delete(self, table, rec_id, rev=None):
+        self.commit([_with_rev({"op": "delete", "t": table, "id": rec_id}, rev)])
+
+    def update(self, table, rec_id, fields, rev=None):
+        self.commit([_with_rev({"op": "update", "t": table, "id": rec_id, "fields": fields}, rev)])
+
+    def commit(self, ops):
+        """Apply several mutations in one transaction."""
+        if not ops: return
+        with _process_lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._disk_version() != self._data_version: self.load()
+                self._prepare(ops)
+                for op in ops:
+                    if op['op'] == "insert": self._insert(op['t'], op['rec'])
+                    elif op['op'] == "delete": self._delete(op['t'], op['id'])
+                    rec = self._apply(op)
+                    if op['op'] == "update" and rec is not None: self._replace(op['t'], rec)
+                self.conn.commit()
+            except ConflictError:
+                self.conn.rollback()
+                raise
+            except:
+                self.conn.rollback()
+                self.load()  # memory may hold part of the failed transaction
+                raise
+
+    def refresh(self):
+        """Reload if another connection has committed since we last read."""
+        if self._disk_version() != self._data_version:
+            self.load()
+
+    def _disk_version(self):
+        # Changes whenever a *different* connection commits to the file
+        return self.conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def compact(self):
+        self.conn.execute("VACUUM")
+
+    def maintain(self):
+        """Closed years are a query here, so there is nothing to move; just VACUUM."""
+        self.compact()
+
+    # Document numbers
+    def peek_number(self, prefix, year):
+        row = self.conn.execute("SELECT value FROM sequences WHERE key = ?", (f"{prefix}-{year}",)).fetchone()
+        return (row[0] if row else self._rebuild_seq(prefix, year)) + 1
+
+    def allocate_number(self, prefix, year):
+        key = f"{prefix}-{year}"
+        with _process_lock:
+            self.conn.execute("BEGIN IMMEDIATE")  # takes the database write lock
+            try:
+                row = self.conn.execute("SELECT value FROM sequences WHERE key = ?", (key,)).fetchone()
+                seq = (row[0] if row else self._rebuild_seq(prefix, year)) + 1
+                self.conn.execute("INSERT OR REPLACE INTO sequences VALUES (?, ?)", (key, seq))
+                self.conn.commit()
+            except:
+                self.conn.rollback()
+                raise
+        return seq
+
+    # Queries
+    def doc_numbers(self, table, field, prefix):
+        sql = f"SELECT {field} FROM {table} WHERE {field} >= ? AND {field} < ?"
+        return [r[0] for r in self.conn.execute(sql, (prefix, prefix + "\uffff"))]
+
+    def in_range(self, table, d_from, d_to, client=None):
+        self.load_since(d_from)
+        sql, params = f"SELECT id FROM {table} WHERE date >= ? AND date < ?", [d_from, d_to + "\uffff"]
+        if client is not None: sql, params = sql + " AND client_name = ?", params + [client]
+        with _process_lock:  # not in the middle of a commit's transaction on this connection
+            ids = [r[0] for r in self.conn.execute(sql + " ORDER BY date, rid", params)]
+        by_id = self._by_id[table]
+        return [rec for rec in map(by_id.get, ids) if rec is not None]  # rows another process added since load() are skipped
+
+    def client_names(self, table):
+        def build():
+            sql = f"SELECT DISTINCT client_name FROM {table} WHERE client_name IS NOT NULL ORDER BY client_name"
+            with _process_lock: return [r[0] for r in self.conn.execute(sql)]
+        return self.cached(('clients', table), build)
+
+    # Row mapping
+    def _row_values(self, table, rec):
+        columns = PAYMENT_COLUMNS if table == 'payments' else DOC_COLUMNS
+        skip = set(columns) | {"items", "schedule"}
+        extra = {k: rec[k] for k in rec.keys() if k not in skip}
+        return columns + ("extra",), [rec.get(c) for c in columns] + [json.dumps(extra) if extra else None]
+
+    def _insert(self, table, rec):
+        names, values = self._row_values(table, rec)
+        self.conn.execute(f"INSERT INTO {table} ({', '.join(names)}) VALUES ({', '.join('?' * len(values))})", values)
+        if table != 'payments':
+            self._insert_children(table, rec)
+
+    def _replace(self, table, rec):
+        """Rewrite an existing row in place, keeping its position."""
+        names, values = self._row_values(table, rec)
+        rid = self.conn.execute(f"SELECT MIN(rid) FROM {table} WHERE id = ?", (rec['id'],)).fetchone()[0]
+        self.conn.execute(f"UPDATE {table} SET {', '.join(n + ' = ?' for n in names)} WHERE rid = ?", values + [rid])
+        if table != 'payments':
+            self._delete_children(table, rec['id'])
+            self._insert_children(table, rec)
+
+    def _insert_children(self, table, rec):
+        self.conn.executemany('INSERT INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                              [(table, rec['id'], pos) + tuple(it.get(c) for c in ITEM_COLUMNS)
+                               for pos, it in enumerate(rec.get('items') or [])])
+        self.conn.executemany('INSERT INTO schedules VALUES (?, ?, ?, ?, ?, ?)',
+                              [(table, rec['id'], pos) + tuple(r.get(c) for c in SCHEDULE_COLUMNS)
+                               for pos, r in enumerate(rec.get('schedule') or [])])
+
+    def _delete(self, table, rec_id):
+        rid = self.conn.execute(f"SELECT MIN(rid) FROM {table} WHERE id = ?", (rec_id,)).fetchone()[0]
+        self.conn.execute(f"DELETE FROM {table} WHERE rid = ?", (rid,))
+        if table != 'payments':
+            self._delete_children(table, rec_id)
+
+    def _delete_children(self, table, doc_id):
+        self.conn.execute("DELETE FROM items WHERE doc_table = ? AND doc_id = ?", (table, doc_id))
+        self.conn.execute("DELETE FROM schedules WHERE doc_table = ? AND doc_id = ?", (table, doc_id))
+
+    def _from_row(self, row, columns, record=Payment):
+        rec = record({c: row[c] for c in columns if row[c] is not None})
+        if row['extra']: rec.update(json.loads(row['extra']))
+        return rec
+
+    def _doc_from_row(self, row, children):
+        rec = self._from_row(row, DOC_COLUMNS, Document)
+        rec['items'] = children['items']
+        rec['schedule'] = children['schedule']
+        return rec
+
+
+def migrate_json_to_sqlite(json_path, sqlite_path):
+    """One-shot copy of a sn_billing_db.json (plus its journal) into SQLite.
+
+    Legacy records are upgraded first, so rows without an id get their
+    LEGACY_ id before they are written. The number counters (seq.json)
+    are carried over too, so numbers of deleted documents are never
+    issued again. Returns the new store.
+    """
+    src = JournalStore(json_path)
+    src.load()
+    src.load_since()  # every fiscal year, not just the live partition
+    dst = SqliteStore(sqlite_path)
+    with dst.conn:
+        for t in TABLES:
+            dst.conn.execute(f"DELETE FROM {t}")
+        dst.conn.execute("DELETE FROM items")
+        dst.conn.execute("DELETE FROM schedules")
+        for t in TABLES:
+            for rec in src.records(t): dst._insert(t, rec)
+        src._read_seq()
+        dst.conn.executemany("INSERT INTO sequences VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)",
+                             src._seq.items())
+    dst.load()
+    return dst
+
+
+def open_store(engine, json_path, sqlite_path):
+    """Open the configured storage engine ("json" or "sqlite")."""
+    if engine == "sqlite":
+        if not os.path.exists(sqlite_path) and os.path.exists(json_path):
+            return migrate_json_to_sqlite(json_path, sqlite_path)
+        return SqliteStore(sqlite_path)
+    return JournalStore(json_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        sys.exit("usage: python storage.py migrate [db.json] [db.sqlite3]")
+    here = os.path.dirname(os.path.abspath(__file__))
+    json_path = sys.argv[2] if len(sys.argv) > 2 else os.path.join(here, "sn_billing_db.json")
+    sqlite_path = sys.argv[3] if len(sys.argv) > 3 else os.path.splitext(json_path)[0] + ".sqlite3"
+    store = migrate_json_to_sqlite(json_path, sqlite_path)
+    print(f"Migrated {', '.join(f'{len(store.db[t])} {t}' for t in TABLES)} into {sqlite_path}")
@@ -0,0 +1,37 @@
+import billing_core
+from billing_core import BODY_BOTTOM, pdf_layout
+
+HEIGHTS = {"client_line": 5, "schedule": 20, "sched_thead": 6, "sched_row": 6}
+
+
+def bill(address="1 Lake Rd", items=3):
+    return {"meta": {"type": "FINAL BILL", "date": "2026-10-01", "terms": "Net 15"},
+            "client": {"name": "Client A", "phone": "99", "address": address},
+            "items": [{"desc": f"Item {i}", "unit": "Nos", "qty": 1, "rate": 100.0} for i in range(items)]}
+
+
+def ops(pages, kind):
+    return [(n, op) for n, page in enumerate(pages) for op in page if op[0] == kind]
+
+
+def overflowing(pages):
+    return [op for page in pages for op in page if op[0] in HEIGHTS and op[1] + HEIGHTS[op[0]] > BODY_BOTTOM]
+
+
+def test_long_schedule_splits_across_pages():
+    schedule = [{"Stage": f"Stage {i}", "Amount": 100, "Date": "2026-11-01"} for i in range(60)]
+    pages = pdf_layout(bill(), "18%", False, schedule)
+    assert not overflowing(pages)
+    assert [op[2] for _, op in ops(pages, "sched_row")] == list(range(60))
+    continued = {n for n, _ in ops(pages, "sched_row")} - {n for n, _ in ops(pages, "schedule")}
+    assert continued and continued == {n for n, _ in ops(pages, "sched_thead")}
+    assert billing_core.generate_pdf_bytes(bill(), "18%", False, schedule, "INV-1")
+
+
+def test_long_address_continues_on_the_next_page():
+    address = "\n".join(f"Line {i}" for i in range(70))
+    pages = pdf_layout(bill(address), "18%", False, [])
+    assert not overflowing(pages)
+    shown = len(pages[0][0][2]) + len(ops(pages, "client_line"))
+    assert shown == 71 and ops(pages, "client_line")[0][0] == 1
+    assert billing_core.generate_pdf_bytes(bill(address), "18%", False, [], "INV-1")
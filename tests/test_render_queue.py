@@ -0,0 +1,40 @@
+import time
+
+from billing_core import RenderCache
+from render_queue import RenderQueue
+
+
+def failing():
+    raise OSError("disk full")
+
+
+def settle(queue, job_id):
+    while queue.status(job_id) in ("queued", "running"): time.sleep(0.01)
+    return queue.status(job_id)
+
+
+def test_failure_expires_and_is_retried():
+    queue = RenderQueue(RenderCache(), failure_ttl=0.2)
+    queue.submit("a", failing)
+    assert settle(queue, "a") == "failed" and "disk full" in queue.error("a")
+    queue.submit("a", lambda: b"pdf")
+    assert queue.status("a") == "failed"
+    time.sleep(0.25)
+    assert queue.status("a") is None
+    queue.submit("a", lambda: b"pdf")
+    assert settle(queue, "a") == "done" and queue.result("a") == b"pdf"
+
+
+def test_retry_overrides_failure():
+    queue = RenderQueue(RenderCache())
+    queue.submit("a", failing)
+    settle(queue, "a")
+    queue.submit("a", lambda: b"pdf", retry=True)
+    assert settle(queue, "a") == "done"
+
+
+def test_failures_are_capped():
+    queue = RenderQueue(RenderCache(), workers=1, max_failed=3)
+    for n in range(10): queue.submit(f"job{n}", failing)
+    for n in range(10): settle(queue, f"job{n}")
+    assert [queue.status(f"job{n}") for n in range(10)] == [None] * 7 + ["failed"] * 3
@@ -0,0 +1,276 @@
+import json
+import sys
+import threading
+from datetime import date
+
+import pytest
+
+import storage
+from storage import ConflictError, JournalError, JournalStore, SqliteStore, fiscal_year, migrate_json_to_sqlite
+
+TODAY = str(date.today())
+
+
+def quotation(rec_id, day=TODAY, **fields):
+    return dict({"id": rec_id, "quotation_no": rec_id, "date": day, "type": "QUOTATION", "client_name": "Client A",
+                 "amount": 100.0, "tax": 0.0, "items": [], "schedule": []}, **fields)
+
+
+def invoice(rec_id, day=TODAY, **fields):
+    return dict({"id": rec_id, "invoice_no": rec_id, "date": day, "type": "FINAL BILL", "client_name": "Client A",
+                 "amount": 500.0, "tax": 50.0, "status": "Pending", "items": [], "schedule": []}, **fields)
+
+
+def journal_store(tmp_path, snapshot=None):
+    path = tmp_path / "db.json"
+    if snapshot is not None: path.write_text(json.dumps(snapshot))
+    store = JournalStore(str(path))
+    store.load()
+    return store
+
+
+def open_store(tmp_path, engine):
+    store = JournalStore(str(tmp_path / "db.json")) if engine == "json" else SqliteStore(str(tmp_path / "db.sqlite3"))
+    store.load()
+    return store
+
+
+def ids(store, table):
+    return [r['id'] for r in store.db[table]]
+
+
+def test_replay_after_torn_write(tmp_path):
+    store = journal_store(tmp_path)
+    store.insert('quotations', quotation("Q1"))
+    with open(store.journal_path, 'ab') as f:  # a crash part-way through appending Q2
+        f.write(json.dumps({"op": "insert", "t": "quotations", "rec": quotation("Q2")}).encode()[:40])
+
+    restarted = journal_store(tmp_path)
+    assert ids(restarted, 'quotations') == ["Q1"]
+    restarted.insert('quotations', quotation("Q3"))
+
+    assert ids(journal_store(tmp_path), 'quotations') == ["Q1", "Q3"]
+
+
+def test_unreadable_journal_line_is_an_error(tmp_path):
+    store = journal_store(tmp_path)
+    store.insert('quotations', quotation("Q1"))
+    with open(store.journal_path, 'ab') as f: f.write(b"{not json}\n")
+    with pytest.raises(JournalError):
+        journal_store(tmp_path)
+
+
+def test_crash_between_snapshot_and_journal_truncate(tmp_path):
+    store = journal_store(tmp_path)
+    store.insert('quotations', quotation("Q1"))
+    store.insert('quotations', quotation("Q2"))
+    with open(store.journal_path, 'rb') as f: journal = f.read()
+    store.compact()
+    with open(store.journal_path, 'wb') as f: f.write(journal)  # the journal was never emptied
+
+    restarted = journal_store(tmp_path)
+    assert ids(restarted, 'quotations') == ["Q1", "Q2"]
+    restarted.insert('quotations', quotation("Q3"))
+    assert ids(journal_store(tmp_path), 'quotations') == ["Q1", "Q2", "Q3"]
+
+
+def test_unreadable_snapshot_is_an_error(tmp_path):
+    store = journal_store(tmp_path)
+    store.insert('quotations', quotation("Q1"))
+    store.compact()
+    snapshot = tmp_path / "db.json"
+    snapshot.write_text(snapshot.read_text()[:-10])
+    with pytest.raises(JournalError):
+        journal_store(tmp_path)
+    assert snapshot.read_text().startswith('{"invoices"')  # left as it was, not replaced by an empty db
+
+
+def test_legacy_records_get_indexed_ids(tmp_path):
+    bill = {"date": TODAY, "type": "FINAL BILL", "client_name": "Client A", "amount": 500.0, "tax": 0.0, "items": []}
+    store = journal_store(tmp_path, {"invoices": [bill], "quotations": [quotation("Q1")], "payments": []})
+    legacy_id = store.db['invoices'][0]['id']
+    assert legacy_id.startswith("LEGACY_")
+    assert store.get('invoices', legacy_id)['status'] == "Pending"
+    store.update('invoices', legacy_id, {"status": "Completed"}, rev=0)  # no spurious ConflictError
+
+    reloaded = journal_store(tmp_path)
+    assert ids(reloaded, 'invoices') == [legacy_id]
+    assert reloaded.get('invoices', legacy_id)['status'] == "Completed"
+
+
+@pytest.mark.parametrize("engine", ["json", "sqlite"])
+def test_stale_revision_is_a_conflict(tmp_path, engine):
+    mine, theirs = open_store(tmp_path, engine), open_store(tmp_path, engine)
+    mine.insert('quotations', quotation("Q1"))
+    theirs.refresh()
+    mine.update('quotations', "Q1", {"client_name": "Client B"}, rev=0)
+
+    with pytest.raises(ConflictError):
+        theirs.update('quotations', "Q1", {"client_name": "Client C"}, rev=0)
+    assert theirs.get('quotations', "Q1")['client_name'] == "Client B"
+    theirs.update('quotations', "Q1", {"client_name": "Client C"}, rev=1)
+    assert open_store(tmp_path, engine).get('quotations', "Q1")['client_name'] == "Client C"
+
+
+@pytest.mark.parametrize("engine", ["json", "sqlite"])
+def test_readers_never_see_a_half_loaded_store(tmp_path, engine):
+    store = open_store(tmp_path, engine)
+    store.insert('quotations', quotation("Q1"))
+    done, seen = threading.Event(), []
+
+    def read():
+        while not done.is_set():
+            seen.append(store.get('quotations', "Q1") is not None)
+            store.cached(len(seen) % 5, lambda: store.client_names('quotations'), keep=2)
+
+    readers = [threading.Thread(target=read) for _ in range(4)]
+    for t in readers: t.start()
+    try:
+        for _ in range(200): store.load()
+    finally:
+        done.set()
+        for t in readers: t.join()
+    assert seen and all(seen)
+
+
+@pytest.mark.parametrize("engine", ["json", "sqlite"])
+def test_closed_year_is_archived_and_reopened_once(tmp_path, engine):
+    old = f"{fiscal_year(date.today()) - 2}-06-01"
+    store = open_store(tmp_path, engine)
+    store.commit([
+        {"op": "insert", "t": "invoices", "rec": invoice("B1", old, status="Completed")},
+        {"op": "insert", "t": "invoices", "rec": invoice("B2", old, amount=100.0, tax=0.0, status="Completed (Manual)")},
+        {"op": "insert", "t": "invoices", "rec": invoice("B3", old, amount=200.0, tax=0.0)},
+        {"op": "insert", "t": "payments", "rec": {"id": "P1", "invoice_id": "B1", "client_name": "Client A", "amount": 550.0, "date": old}},
+        {"op": "insert", "t": "quotations", "rec": quotation("Q1", old)},
+        {"op": "insert", "t": "quotations", "rec": quotation("Q2")},
+    ])
+    totals = (800.0, 50.0, 550.0)
+    assert store.all_time_totals() == totals
+
+    store = open_store(tmp_path, engine)
+    assert ids(store, 'invoices') == ["B3"]  # only the open bill stays live
+    assert ids(store, 'quotations') == ["Q2"] and ids(store, 'payments') == []
+    assert store.all_time_totals() == totals
+
+    start = threading.Barrier(4)
+    def open_all():
+        start.wait()
+        store.load_since()
+    openers = [threading.Thread(target=open_all) for _ in range(4)]
+    for t in openers: t.start()
+    for t in openers: t.join()
+    store.load_since()
+
+    assert store.all_time_totals() == totals
+    assert sorted(r['id'] for r in store.records('invoices')) == ["B1", "B2", "B3"]
+    assert store.is_archived('invoices', "B2") and not store.is_archived('invoices', "B3")
+    assert store.get('payments', "P1")['amount'] == 550.0
+
+
+def test_migrate_json_to_sqlite(tmp_path):
+    old = f"{fiscal_year(date.today()) - 1}-05-01"
+    legacy = {"date": TODAY, "type": "FINAL BILL", "client_name": "Client B", "amount": 300.0, "tax": 0.0,
+              "items": [{"desc": "Painting", "unit": "sqft", "qty": 10, "rate": 30}]}
+    store = journal_store(tmp_path, {"invoices": [legacy], "quotations": [], "payments": []})
+    store.insert('invoices', invoice("B1", old, status="Completed"))
+    store.insert('payments', {"id": "P1", "invoice_id": "B1", "client_name": "Client A", "amount": 550.0, "date": old})
+    store.insert('quotations', quotation("Q1", schedule=[{"Stage": "Advance", "Amount": 50.0, "Date": TODAY}]))
+    src = journal_store(tmp_path)  # archives FY of B1 and P1
+    src.load_since()
+    year = date.today().year
+    for _ in range(3): src.allocate_number("QUOT", year)  # e.g. quotations since deleted
+
+    dst = migrate_json_to_sqlite(str(tmp_path / "db.json"), str(tmp_path / "db.sqlite3"))
+    assert dst.all_time_totals() == src.all_time_totals() == (800.0, 50.0, 550.0)
+    dst.load_since()
+    def rows(store, t):  # SQLite spells out the optional fields JSON leaves out
+        return sorted((r['id'], r.get('client_name'), r['amount'], r.get('status'),
+                       [(i['desc'], i['qty'], i['rate']) for i in r.get('items') or []],
+                       [(p['Stage'], p['Amount']) for p in r.get('schedule') or []]) for r in store.records(t))
+    for t in ("invoices", "quotations", "payments"):
+        assert rows(dst, t) == rows(src, t)
+    assert dst.is_archived('invoices', "B1")
+    assert dst.peek_number("QUOT", year) == 4
+    assert [r['id'] for r in dst.in_range('invoices', old, TODAY)] == [r['id'] for r in src.in_range('invoices', old, TODAY)]
+    assert dst.client_names('invoices') == src.client_names('invoices') == ["Client A", "Client B"]
+
+
+def test_line_items_categorize_blank_categories(tmp_path):
+    store = journal_store(tmp_path)
+    items = [{"category": "Supply", "desc": "Tiles", "unit": "Nos", "qty": 2, "rate": 10},
+             {"category": "", "desc": "1. Site Visit", "unit": "Job", "qty": 1, "rate": 500}]
+    store.insert('invoices', invoice("B1", items=items))
+    lines = store.line_items(lambda desc: desc.split(". ")[-1])
+    store.insert('invoices', invoice("B2", items=[{"desc": "2. Walkthrough", "unit": "Job", "qty": 1, "rate": 900}]))
+    assert lines.cols['category'] == ["Supply", "Site Visit", "Walkthrough"]
+
+
+def test_only_low_cardinality_values_are_shared(tmp_path):
+    item = {"category": "Supply", "desc": "Teak door, 7x3 ft", "unit": "Nos", "qty": 1, "rate": 4321.5}
+    store = journal_store(tmp_path, {"invoices": [invoice("B1", terms="Net 15", client_address="1 Lake Rd", items=[item])],
+                                     "quotations": [], "payments": []})
+    assert "Net 15" in storage.TERMS and 4321.5 in storage._RATES
+    rec = store.get('invoices', "B1")
+    assert rec['items'][0]['desc'] == item['desc'] and rec['client_address'] == "1 Lake Rd"
+    store.delete('invoices', "B1")
+    store.maintain()
+    JournalStore(str(tmp_path / "db.json")).load()
+    assert "Net 15" not in storage.TERMS and 4321.5 not in storage._RATES
+
+
+def test_shared_tables_are_bounded():
+    for n in range(storage._SHARED_MAX + 10): storage._rate(n + 0.5)
+    assert len(storage._RATES) <= storage._SHARED_MAX
+
+
+@pytest.mark.parametrize("engine", ["json", "sqlite"])
+def test_readers_alongside_commits(tmp_path, engine):
+    store = open_store(tmp_path, engine)
+    store.commit([{"op": "insert", "t": "quotations", "rec": quotation(f"Q{n}", client_name=f"Client {n}")}
+                  for n in range(2000)])
+    store.line_items()
+    store.search("client")
+    done, errors = threading.Event(), []
+
+    def read():
+        while not done.is_set():
+            try:
+                store.client_names('quotations')
+                store.search("client 1")
+                with store.reading(): list(store.line_items().cols['qty'])
+            except Exception as e:
+                errors.append(e)
+
+    readers = [threading.Thread(target=read) for _ in range(3)]
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-5)  # switch threads often, so readers land mid-commit
+    for t in readers: t.start()
+    try:
+        for n in range(40):
+            store.commit([{"op": "insert", "t": "quotations", "rec": quotation(f"N{n}", client_name=f"New {n}")},
+                          {"op": "insert", "t": "invoices", "rec": invoice(f"B{n}", client_name=f"New {n}",
+                                                                           items=[{"desc": "Supply", "qty": 1, "rate": 5}])}])
+            store.delete('quotations', f"Q{n}")
+    finally:
+        done.set()
+        for t in readers: t.join()
+        sys.setswitchinterval(interval)
+    assert errors == []
+    assert len(store.client_names('quotations')) == 2000
+
+
+def test_loads_write_nothing(tmp_path):
+    old = f"{fiscal_year(date.today()) - 1}-05-01"
+    legacy = {"date": TODAY, "type": "QUOTATION", "client_name": "Client B", "amount": 10.0, "tax": 0.0, "items": []}
+    snapshot = {"invoices": [invoice("B1", old, status="Completed (Manual)")], "quotations": [legacy], "payments": []}
+    store = journal_store(tmp_path, snapshot)
+    before = {p.name: p.read_bytes() for p in tmp_path.iterdir() if p.suffix != ".lock"}
+    again = journal_store(tmp_path)
+    assert {p.name: p.read_bytes() for p in tmp_path.iterdir() if p.suffix != ".lock"} == before
+    assert ids(again, 'quotations') == ids(store, 'quotations')  # legacy ids do not change between loads
+
+    store.insert('quotations', quotation("Q1"))  # the first write archives and saves the upgrade
+    assert ids(journal_store(tmp_path), 'invoices') == []
+    assert ids(journal_store(tmp_path), 'quotations') == ids(store, 'quotations')
+    assert (tmp_path / f"db.fy{fiscal_year(old)}.json").exists()